@@ -0,0 +1,158 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load generator for inference_server.py.
+
+Every client thread sends requests back to back over its own keep-alive
+connection, for every requested concurrency level. Client side QPS and latency
+percentiles are printed together with the mean batch size the server formed.
+
+    python benchmark_inference_server.py --port 8000 --concurrency 1 8 32 --duration 30 \\
+        --squad_file dev-v1.1.json
+    python benchmark_inference_server.py --uds /tmp/bert_qa.sock --concurrency 16
+"""
+
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_QUESTION = "Most antibiotics target bacteria and don't affect what class of organisms?"
+DEFAULT_CONTEXT = ("Within the genitourinary and gastrointestinal tracts, commensal flora serve as biological "
+                   "barriers by competing with pathogenic bacteria for food and space and, in some cases, by "
+                   "changing the conditions in their environment, such as pH or available iron. However, since "
+                   "most antibiotics non-specifically target bacteria and do not affect fungi, oral antibiotics "
+                   "can lead to an overgrowth of fungi and cause conditions such as a vaginal candidiasis.")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(args):
+    if args.uds is not None:
+        return UnixHTTPConnection(args.uds)
+    return http.client.HTTPConnection(args.host, args.port, timeout=60)
+
+
+def call(connection, method, path, body=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read().decode("utf-8"))
+
+
+def read_squad_requests(squad_file, max_requests):
+    with open(squad_file, "r", encoding="utf-8") as reader:
+        data = json.load(reader)["data"]
+    requests = []
+    for entry in data:
+        for paragraph in entry["paragraphs"]:
+            for qa in paragraph["qas"]:
+                requests.append({"question": qa["question"], "context": paragraph["context"]})
+                if len(requests) >= max_requests:
+                    return requests
+    return requests
+
+
+def client(args, requests, offset, deadline, latencies, errors):
+    connection = connect(args)
+    i = offset
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            status, _ = call(connection, "POST", "/predict", requests[i % len(requests)])
+        except (OSError, http.client.HTTPException):
+            errors.append(i)
+            connection.close()
+            connection = connect(args)
+            continue
+        if status != 200:
+            errors.append(i)
+        else:
+            latencies.append(time.perf_counter() - start)
+        i += 1
+    connection.close()
+
+
+def run(args, requests, concurrency):
+    connection = connect(args)
+    call(connection, "POST", "/stats/reset")
+    latencies = []
+    errors = []
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target=client, args=(args, requests, i * 97, deadline, latencies, errors))
+               for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    _, server_stats = call(connection, "GET", "/stats")
+    connection.close()
+
+    latencies = np.array(latencies) * 1000
+    percentiles = [np.percentile(latencies, p) if len(latencies) else float("nan") for p in (50, 90, 99)]
+    print("{:>11} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.2f} {:>7}".format(
+        concurrency, len(latencies) / elapsed, *percentiles, server_stats["mean_batch_size"], len(errors)),
+        flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--uds", default=None, type=str,
+                        help="Connect to this unix domain socket instead of host:port")
+    parser.add_argument("--concurrency", default=[1, 8, 32], type=int, nargs="+",
+                        help="Numbers of concurrent clients to measure")
+    parser.add_argument("--duration", default=20.0, type=float,
+                        help="Seconds per concurrency level")
+    parser.add_argument("--warmup", default=5, type=int,
+                        help="Requests sent before measuring")
+    parser.add_argument("--squad_file", default=None, type=str,
+                        help="Ask the questions of this SQuAD json file, a fixed question if not given")
+    parser.add_argument("--max_requests", default=10000, type=int,
+                        help="Number of distinct questions read from --squad_file")
+    args = parser.parse_args()
+
+    if args.squad_file is not None:
+        requests = read_squad_requests(args.squad_file, args.max_requests)
+    else:
+        requests = [{"question": DEFAULT_QUESTION, "context": DEFAULT_CONTEXT}]
+
+    connection = connect(args)
+    for i in range(args.warmup):
+        call(connection, "POST", "/predict", requests[i % len(requests)])
+    connection.close()
+
+    print("{:>11} {:>9} {:>9} {:>9} {:>9} {:>10} {:>7}".format(
+        "concurrency", "qps", "p50_ms", "p90_ms", "p99_ms", "batch_size", "errors"))
+    for concurrency in args.concurrency:
+        run(args, requests, concurrency)
+
+
+if __name__ == "__main__":
+    main()
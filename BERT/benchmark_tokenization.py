@@ -0,0 +1,114 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the reference and the fast (trie + cache) BertTokenizer.
+
+Times tokenization of a pretraining text shard (one sentence per line, empty
+lines between documents, as fed to create_pretraining_data.py) and, optionally,
+SQuAD feature conversion as done by run_squad.py. Outputs of both tokenizers
+are checked to be identical.
+
+    python benchmark_tokenization.py --vocab_file vocab/vocab --input_file shard.txt \\
+        --squad_file train-v1.1.json --n_processes 1 8
+"""
+
+import argparse
+import time
+
+from tokenization import BertTokenizer
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def read_lines(input_file, max_lines):
+    lines = []
+    with open(input_file, "r", encoding="utf-8") as reader:
+        for line in reader:
+            line = line.strip()
+            if line:
+                lines.append(line)
+            if max_lines is not None and len(lines) >= max_lines:
+                break
+    return lines
+
+
+def benchmark_text(lines, reference, args):
+    expected, reference_time = timed(reference.tokenize_batch, lines)
+    num_tokens = sum(len(tokens) for tokens in expected)
+    print("text: {} lines, {} tokens".format(len(lines), num_tokens))
+    print("  reference       {:8.2f}s {:10.0f} tokens/s".format(reference_time, num_tokens / reference_time))
+    for n in args.n_processes:
+        # a new tokenizer per run so the word caches start cold
+        tokenizer = BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case)
+        output, elapsed = timed(tokenizer.tokenize_batch, lines, n)
+        if output != expected:
+            raise RuntimeError("fast tokenizer output differs from the reference with n_processes={}".format(n))
+        print("  fast x{:<3}       {:8.2f}s {:10.0f} tokens/s {:6.1f}x".format(
+            n, elapsed, num_tokens / elapsed, reference_time / elapsed))
+
+
+def benchmark_squad(squad_file, reference, fast, args):
+    # run_squad pulls in torch and apex, only import it when asked to
+    from run_squad import read_squad_examples, convert_examples_to_features
+
+    examples = read_squad_examples(squad_file, is_training=True, version_2_with_negative=args.version_2_with_negative)
+    print("squad: {} examples".format(len(examples)))
+    results = []
+    for name, tokenizer in (("reference", reference), ("fast", fast)):
+        features, elapsed = timed(convert_examples_to_features, examples, tokenizer, args.max_seq_length,
+                                  args.doc_stride, args.max_query_length, True)
+        results.append([(f.tokens, f.input_ids, f.start_position, f.end_position) for f in features])
+        print("  {:<15} {:8.2f}s {:10.0f} features/s".format(name, elapsed, len(features) / elapsed))
+    if results[0] != results[1]:
+        raise RuntimeError("fast tokenizer SQuAD features differ from the reference")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", type=str, required=True,
+                        help="The vocabulary file that the BERT model was trained on.")
+    parser.add_argument("--input_file", type=str, default=None,
+                        help="Pretraining text shard to tokenize.")
+    parser.add_argument("--squad_file", type=str, default=None,
+                        help="SQuAD json file to convert to features.")
+    parser.add_argument("--do_lower_case", action='store_true', default=True,
+                        help="Whether to lower case the input text (the default, for uncased vocabularies).")
+    parser.add_argument("--no_lower_case", action='store_false', dest='do_lower_case',
+                        help="Keep the case of the input text, for cased vocabularies.")
+    parser.add_argument("--max_lines", type=int, default=None,
+                        help="Only tokenize the first max_lines non empty lines of input_file.")
+    parser.add_argument("--n_processes", type=int, nargs='+', default=[1],
+                        help="Pool sizes to time tokenize_batch with.")
+    parser.add_argument("--version_2_with_negative", action='store_true')
+    parser.add_argument("--max_seq_length", default=384, type=int)
+    parser.add_argument("--doc_stride", default=128, type=int)
+    parser.add_argument("--max_query_length", default=64, type=int)
+    args = parser.parse_args()
+    if args.input_file is None and args.squad_file is None:
+        parser.error("at least one of --input_file and --squad_file is required")
+
+    reference = BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case, fast=False)
+
+    if args.input_file is not None:
+        benchmark_text(read_lines(args.input_file, args.max_lines), reference, args)
+    if args.squad_file is not None:
+        benchmark_squad(args.squad_file, reference, BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case),
+                        args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Length bucketed batching for fine-tuning and inference.
+
+Features are padded to max_seq_length when they are converted. The batch
+sampler groups features of similar length into a batch, and `TrimPadding`
+cuts every batch down to its longest sequence, so little compute is spent
+on padding tokens. Use both with a `TensorDataset` as
+
+    batch_sampler = LengthBucketBatchSampler(sequence_lengths(all_input_mask), batch_size)
+    DataLoader(dataset, sampler=batch_sampler, batch_size=None, collate_fn=TrimPadding())
+
+which indexes the dataset once per batch.
+"""
+
+import math
+
+import numpy as np
+from torch.utils.data import Sampler
+
+from utils import get_rank, get_world_size
+
+
+def sequence_lengths(input_mask):
+    """Number of real tokens of every feature, the longest choice for multiple choice features."""
+    lengths = input_mask.sum(-1)
+    if lengths.dim() > 1:
+        lengths = lengths.max(-1)[0]
+    return lengths.numpy()
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Yields lists of indices of features with similar lengths.
+
+    With `shuffle` the features are shuffled, split into buckets of
+    `bucket_size` batches and sorted by length within a bucket, then the
+    batches are shuffled. This keeps the batches random while packing
+    similar lengths together. Without `shuffle`, the batches cover the
+    features sorted by length, which suits inference.
+
+    Args:
+        lengths: number of real tokens per feature
+        batch_size: maximum number of features per batch
+        max_tokens: if set, also close a batch when its features padded to the
+            longest one would exceed this many tokens
+        shuffle: shuffle features and batches, differently every epoch
+        bucket_size: batches per sorted bucket
+        num_replicas, rank: split the batches over data parallel processes,
+            default to the distributed world size and rank
+        seed: base seed of the shuffle, combined with the epoch
+    """
+
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=True, bucket_size=100,
+                 num_replicas=None, rank=None, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.seed = seed
+        self.epoch = 0
+        if max_tokens is not None and max_tokens < self.lengths.max(initial=0):
+            raise ValueError("max_tokens {} is smaller than the longest feature ({} tokens)".format(
+                max_tokens, self.lengths.max()))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _split(self, order):
+        """Splits length sorted `order` into batches"""
+        if self.max_tokens is None:
+            return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batches = []
+        start = 0
+        longest = 0
+        for end, idx in enumerate(order):
+            longest = max(longest, self.lengths[idx])
+            if end - start == self.batch_size or (end - start + 1) * longest > self.max_tokens:
+                batches.append(order[start:end])
+                start = end
+                longest = self.lengths[idx]
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def _batches(self):
+        if not self.shuffle:
+            return self._split(np.argsort(self.lengths, kind='stable'))
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths))
+        bucket = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(order), bucket):
+            chunk = order[start:start + bucket]
+            batches.extend(self._split(chunk[np.argsort(self.lengths[chunk], kind='stable')]))
+        rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        if self.num_replicas > 1:
+            # every process takes the same number of batches
+            num_batches = len(batches) // self.num_replicas
+            batches = batches[self.rank:num_batches * self.num_replicas:self.num_replicas]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.max_tokens is None:
+            num_batches = int(math.ceil(len(self.lengths) / float(self.batch_size)))
+        else:
+            # the number of batches depends on the order, count them
+            num_batches = len(self._batches())
+        return num_batches if self.num_replicas == 1 else num_batches // self.num_replicas
+
+
+def num_optimization_steps(batch_sampler, num_epochs, gradient_accumulation_steps=1):
+    """
+    Optimizer steps of ``num_epochs`` epochs over the batches of ``batch_sampler``.
+
+    With ``max_tokens`` the number of batches depends on the shuffle of the
+    epoch, so every epoch is counted.
+    """
+    epoch = batch_sampler.epoch
+    num_steps = 0
+    for e in range(num_epochs):
+        batch_sampler.set_epoch(e)
+        num_steps += len(batch_sampler) // gradient_accumulation_steps
+    batch_sampler.set_epoch(epoch)
+    return num_steps
+
+
+class TrimPadding(object):
+    """
+    Collate for batches of a `TensorDataset` indexed with a list of indices.
+
+    Cuts the sequence tensors (the last dim of the fields in `sequence_fields`)
+    to the longest sequence in the batch, rounded up to `multiple_of` tokens
+    so that fp16 GEMMs keep using tensor cores.
+    """
+
+    def __init__(self, sequence_fields=(0, 1, 2), mask_field=1, multiple_of=8):
+        self.sequence_fields = sequence_fields
+        self.mask_field = mask_field
+        self.multiple_of = multiple_of
+
+    def __call__(self, batch):
+        max_seq_length = batch[self.mask_field].size(-1)
+        length = int(batch[self.mask_field].sum(-1).max())
+        length = min(int(math.ceil(length / float(self.multiple_of))) * self.multiple_of, max_seq_length)
+        return tuple(t[..., :length].contiguous() if i in self.sequence_fields else t
+                     for i, t in enumerate(batch))
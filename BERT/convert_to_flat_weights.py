@@ -0,0 +1,69 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Convert a checkpoint into a flat, memory mappable weights file.
+
+Pretraining checkpoints hold the optimizer state next to the model and are
+unpickled as a whole by torch.load. The flat file (safetensors layout) only
+holds the model weights and is memory mapped by run_squad.py, run_glue.py and
+inference.py when passed as --init_checkpoint, so that startup does not read
+the whole file and all ranks of a node share one copy of it in the page cache.
+
+    python convert_to_flat_weights.py --checkpoint ckpt_8601.pt --output bert_large.safetensors
+
+Saved as model.safetensors next to bert_config.json, the file is also picked up
+by BertPreTrainedModel.from_pretrained.
+"""
+
+import argparse
+import time
+
+import torch
+
+from modeling import load_flat_weights, save_flat_weights
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="torch.save'd checkpoint, a dict with the state dict under 'model' or a state dict")
+    parser.add_argument("--output",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The flat weights file to write, should end with .safetensors")
+    parser.add_argument("--fp16",
+                        action='store_true',
+                        help="Store floating point weights in half precision")
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    state_dict = checkpoint.get('model', checkpoint)
+    if args.fp16:
+        state_dict = {name: t.half() if t.is_floating_point() else t for name, t in state_dict.items()}
+    save_flat_weights(state_dict, args.output)
+
+    start = time.time()
+    loaded = load_flat_weights(args.output)
+    elapsed = time.time() - start
+    for name, tensor in state_dict.items():
+        if not torch.equal(loaded[name], tensor.cpu()):
+            raise RuntimeError("{} differs after the conversion".format(name))
+    print("wrote {} tensors to {}, memory mapped again in {:.3f}s".format(len(loaded), args.output, elapsed))
+
+
+if __name__ == "__main__":
+    main()
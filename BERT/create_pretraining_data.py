@@ -17,7 +17,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import argparse
+import array
 import logging
+import multiprocessing
 import os
 import random
 from io import open
@@ -63,8 +65,12 @@ class TrainingInstance(object):
 
 
 def write_instance_to_example_file(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_file):
-  """Create TF example files from `TrainingInstance`s."""
+                                    max_predictions_per_seq, output_file, compression='gzip'):
+  """Create TF example files from `TrainingInstance`s.
+
+  With compression=None the datasets are stored contiguous and uncompressed,
+  which run_pretraining.py memory maps instead of reading through h5py.
+  """
  
 
   total_written = 0
@@ -134,12 +140,12 @@ def write_instance_to_example_file(instances, tokenizer, max_seq_length,
  
   print("saving data")
   f= h5py.File(output_file, 'w')
-  f.create_dataset("input_ids", data=features["input_ids"], dtype='i4', compression='gzip')
-  f.create_dataset("input_mask", data=features["input_mask"], dtype='i1', compression='gzip')
-  f.create_dataset("segment_ids", data=features["segment_ids"], dtype='i1', compression='gzip')
-  f.create_dataset("masked_lm_positions", data=features["masked_lm_positions"], dtype='i4', compression='gzip')
-  f.create_dataset("masked_lm_ids", data=features["masked_lm_ids"], dtype='i4', compression='gzip')
-  f.create_dataset("next_sentence_labels", data=features["next_sentence_labels"], dtype='i1', compression='gzip')
+  f.create_dataset("input_ids", data=features["input_ids"], dtype='i4', compression=compression)
+  f.create_dataset("input_mask", data=features["input_mask"], dtype='i1', compression=compression)
+  f.create_dataset("segment_ids", data=features["segment_ids"], dtype='i1', compression=compression)
+  f.create_dataset("masked_lm_positions", data=features["masked_lm_positions"], dtype='i4', compression=compression)
+  f.create_dataset("masked_lm_ids", data=features["masked_lm_ids"], dtype='i4', compression=compression)
+  f.create_dataset("next_sentence_labels", data=features["next_sentence_labels"], dtype='i1', compression=compression)
   f.flush()
   f.close()
 
@@ -190,8 +196,14 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
 
 def create_instances_from_document(
     all_documents, document_index, max_seq_length, short_seq_prob,
-    masked_lm_prob, max_predictions_per_seq, vocab_words, rng):
-  """Creates `TrainingInstance`s for a single document."""
+    masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+    special_tokens=("[CLS]", "[SEP]", "[MASK]")):
+  """Creates `TrainingInstance`s for a single document.
+
+  `special_tokens` are the ([CLS], [SEP], [MASK]) tokens, ids when the documents
+  hold token ids (see `create_pretraining_file`).
+  """
+  cls_token, sep_token, _ = special_tokens
   document = all_documents[document_index]
 
   # Account for [CLS], [SEP], [SEP]
@@ -275,24 +287,25 @@ def create_instances_from_document(
 
         tokens = []
         segment_ids = []
-        tokens.append("[CLS]")
+        tokens.append(cls_token)
         segment_ids.append(0)
         for token in tokens_a:
           tokens.append(token)
           segment_ids.append(0)
 
-        tokens.append("[SEP]")
+        tokens.append(sep_token)
         segment_ids.append(0)
 
         for token in tokens_b:
           tokens.append(token)
           segment_ids.append(1)
-        tokens.append("[SEP]")
+        tokens.append(sep_token)
         segment_ids.append(1)
 
         (tokens, masked_lm_positions,
          masked_lm_labels) = create_masked_lm_predictions(
-             tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng)
+             tokens, masked_lm_prob, max_predictions_per_seq, vocab_words, rng,
+             special_tokens)
         instance = TrainingInstance(
             tokens=tokens,
             segment_ids=segment_ids,
@@ -312,12 +325,14 @@ MaskedLmInstance = collections.namedtuple("MaskedLmInstance",
 
 
 def create_masked_lm_predictions(tokens, masked_lm_prob,
-                                 max_predictions_per_seq, vocab_words, rng):
+                                 max_predictions_per_seq, vocab_words, rng,
+                                 special_tokens=("[CLS]", "[SEP]", "[MASK]")):
   """Creates the predictions for the masked LM objective."""
+  cls_token, sep_token, mask_token = special_tokens
 
   cand_indexes = []
   for (i, token) in enumerate(tokens):
-    if token == "[CLS]" or token == "[SEP]":
+    if token == cls_token or token == sep_token:
       continue
     cand_indexes.append(i)
 
@@ -340,7 +355,7 @@ def create_masked_lm_predictions(tokens, masked_lm_prob,
     masked_token = None
     # 80% of the time, replace with [MASK]
     if rng.random() < 0.8:
-      masked_token = "[MASK]"
+      masked_token = mask_token
     else:
       # 10% of the time, keep original
       if rng.random() < 0.5:
@@ -382,6 +397,164 @@ def truncate_seq_pair(tokens_a, tokens_b, max_num_tokens, rng):
       trunc_tokens.pop()
 
 
+class InstanceWriter(object):
+  """Appends token id instances to resizable HDF5 datasets in chunks of `chunk_size` rows.
+
+  Rows are shuffled within a chunk, the pretraining loader samples randomly over
+  the whole file anyway. With compression=None the datasets are rewritten
+  contiguous on close so that run_pretraining.py can memory map them.
+  """
+
+  def __init__(self, output_file, max_seq_length, max_predictions_per_seq,
+               rng, compression='gzip', chunk_size=8192):
+    self.output_file = output_file
+    self.rng = rng
+    self.compression = compression
+    self.chunk_size = chunk_size
+    self.max_seq_length = max_seq_length
+    self.max_predictions_per_seq = max_predictions_per_seq
+    self.shapes = collections.OrderedDict([
+        ("input_ids", ((max_seq_length,), 'i4')),
+        ("input_mask", ((max_seq_length,), 'i1')),
+        ("segment_ids", ((max_seq_length,), 'i1')),
+        ("masked_lm_positions", ((max_predictions_per_seq,), 'i4')),
+        ("masked_lm_ids", ((max_predictions_per_seq,), 'i4')),
+        ("next_sentence_labels", ((), 'i1')),
+    ])
+    self.f = h5py.File(output_file, 'w')
+    for key, (shape, dtype) in self.shapes.items():
+      self.f.create_dataset(key, shape=(0,) + shape, maxshape=(None,) + shape,
+                            chunks=(min(chunk_size, 1024),) + shape,
+                            dtype=dtype, compression=compression)
+    self._reset()
+    self.total_written = 0
+
+  def _reset(self):
+    self.buffer = {key: np.zeros((self.chunk_size,) + shape, dtype=dtype)
+                   for key, (shape, dtype) in self.shapes.items()}
+    self.num_buffered = 0
+
+  def add(self, instance):
+    row = self.num_buffered
+    num_tokens = len(instance.tokens)
+    assert num_tokens <= self.max_seq_length
+    self.buffer["input_ids"][row, :num_tokens] = instance.tokens
+    self.buffer["input_mask"][row, :num_tokens] = 1
+    self.buffer["segment_ids"][row, :num_tokens] = instance.segment_ids
+    num_predictions = len(instance.masked_lm_positions)
+    self.buffer["masked_lm_positions"][row, :num_predictions] = instance.masked_lm_positions
+    self.buffer["masked_lm_ids"][row, :num_predictions] = instance.masked_lm_labels
+    self.buffer["next_sentence_labels"][row] = 1 if instance.is_random_next else 0
+    self.num_buffered += 1
+    if self.num_buffered == self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if self.num_buffered == 0:
+      return
+    order = np.arange(self.num_buffered)
+    self.rng.shuffle(order)
+    start = self.total_written
+    end = start + self.num_buffered
+    for key, dataset in self.f.items():
+      dataset.resize(end, axis=0)
+      dataset[start:end] = self.buffer[key][order]
+    self.total_written = end
+    self._reset()
+
+  def close(self):
+    self.flush()
+    self.f.flush()
+    if self.compression is None:
+      # resizable datasets are always chunked, copy them contiguous (one at a time) into a
+      # fresh file, HDF5 would not reclaim the space of datasets deleted in place
+      contiguous_file = self.output_file + ".contiguous"
+      with h5py.File(contiguous_file, 'w') as out:
+        for key in self.shapes:
+          data = self.f[key][:]
+          out.create_dataset(key, data=data, dtype=data.dtype)
+      self.f.close()
+      os.replace(contiguous_file, self.output_file)
+    else:
+      self.f.close()
+
+
+def read_documents(input_file, tokenizer):
+  """Tokenizes `input_file` line by line into documents of sentences of token ids.
+
+  Sentences are kept as compact int arrays instead of lists of token strings,
+  which bounds the memory of a shard to a few bytes per token.
+  """
+  all_documents = [[]]
+  with open(input_file, "r") as reader:
+    for line in reader:
+      line = tokenization.convert_to_unicode(line).strip()
+
+      # Empty lines are used as document delimiters
+      if not line:
+        all_documents.append([])
+        continue
+      tokens = tokenizer.tokenize(line)
+      if tokens:
+        all_documents[-1].append(array.array('i', tokenizer.convert_tokens_to_ids(tokens)))
+
+  # Remove empty documents
+  return [x for x in all_documents if x]
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(vocab_file, do_lower_case):
+  global _worker_tokenizer
+  _worker_tokenizer = BertTokenizer(vocab_file, do_lower_case=do_lower_case, max_len=512)
+
+
+def create_pretraining_file(input_file, output_file, args, tokenizer=None):
+  """Creates one HDF5 file of masked LM/next sentence instances from one text shard.
+
+  Instances are built from token ids and streamed into the output in chunks,
+  only the tokenized documents of the shard are held in memory.
+  """
+  tokenizer = tokenizer or _worker_tokenizer
+  rng = random.Random(args.random_seed)
+  all_documents = read_documents(input_file, tokenizer)
+  rng.shuffle(all_documents)
+
+  vocab_ids = list(tokenizer.vocab.values())
+  special_tokens = tuple(tokenizer.vocab[token] for token in ("[CLS]", "[SEP]", "[MASK]"))
+  writer = InstanceWriter(output_file, args.max_seq_length, args.max_predictions_per_seq, rng,
+                          compression=None if args.no_compression else 'gzip')
+  for _ in range(args.dupe_factor):
+    for document_index in range(len(all_documents)):
+      for instance in create_instances_from_document(
+          all_documents, document_index, args.max_seq_length, args.short_seq_prob,
+          args.masked_lm_prob, args.max_predictions_per_seq, vocab_ids, rng,
+          special_tokens):
+        writer.add(instance)
+  writer.close()
+  return output_file, writer.total_written
+
+
+def _create_pretraining_file(task):
+  input_file, output_file, args = task
+  return create_pretraining_file(input_file, output_file, args)
+
+
+def create_pretraining_files(input_files, output_files, args, n_processes=None):
+  """Creates the output files of all shards on a process pool.
+
+  Shards are handed out one at a time, largest first, so that every worker keeps
+  pulling work until the last shard and no worker is left with a long tail.
+  """
+  tasks = sorted(zip(input_files, output_files), key=lambda t: os.path.getsize(t[0]), reverse=True)
+  with multiprocessing.Pool(n_processes, initializer=_init_worker,
+                            initargs=(args.vocab_file, args.do_lower_case)) as pool:
+    for output_file, num_instances in pool.imap_unordered(
+        _create_pretraining_file, [(i, o, args) for i, o in tasks], chunksize=1):
+      print("wrote {} instances to {}".format(num_instances, output_file))
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -399,7 +572,6 @@ def main():
     parser.add_argument("--output_file",
                         default=None,
                         type=str,
-                        required=True,
                         help="The output file where the model checkpoints will be written.")
 
     ## Other parameters
@@ -446,8 +618,33 @@ def main():
                         type=int,
                         default=12345,
                         help="random seed for initialization")
+    parser.add_argument('--no_compression',
+                        action='store_true',
+                        default=False,
+                        help="Write uncompressed contiguous datasets that can be memory mapped during pretraining")
+    parser.add_argument('--output_dir',
+                        default=None,
+                        type=str,
+                        help="Create one .hdf5 file per .txt shard of the --input_file dir in this dir, "
+                             "streaming and in parallel, instead of a single --output_file")
+    parser.add_argument('--n_processes',
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of shards processed in parallel with --output_dir")
 
     args = parser.parse_args()
+    if (args.output_file is None) == (args.output_dir is None):
+      parser.error("exactly one of --output_file and --output_dir is required")
+
+    if args.output_dir is not None:
+      if not os.path.isdir(args.input_file):
+        parser.error("--output_dir requires --input_file to be a directory of .txt shards")
+      os.makedirs(args.output_dir, exist_ok=True)
+      names = sorted(f for f in os.listdir(args.input_file) if f.endswith('.txt'))
+      create_pretraining_files([os.path.join(args.input_file, f) for f in names],
+                               [os.path.join(args.output_dir, f[:-len('.txt')] + '.hdf5') for f in names],
+                               args, args.n_processes)
+      return
 
     tokenizer = BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case, max_len=512)
     
@@ -469,7 +666,8 @@ def main():
 
 
     write_instance_to_example_file(instances, tokenizer, args.max_seq_length,
-                                    args.max_predictions_per_seq, output_file)
+                                    args.max_predictions_per_seq, output_file,
+                                    compression=None if args.no_compression else 'gzip')
 
 
 if __name__ == "__main__":
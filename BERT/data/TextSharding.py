@@ -11,11 +11,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
-from itertools import islice
-
+import heapq
 import multiprocessing
-import statistics
+
+
+# set in every worker of the segmentation pool
+_segmenter = None
+
+
+def _init_segmenter(segmenter):
+    global _segmenter
+    _segmenter = segmenter
+
+
+def _segment_chunk(chunk):
+    return [_segmenter.segment_string(article) for article in chunk]
+
 
 class Sharding:
     def __init__(self, input_files, output_name_prefix, n_training_shards, n_test_shards, fraction_test_set):
@@ -58,60 +69,31 @@ class Sharding:
         print('End: Loading Articles: There are', len(self.articles), 'articles.')
 
 
-    def segment_articles_into_sentences(self, segmenter):
+    def segment_articles_into_sentences(self, segmenter, n_processes=1, chunk_size=1000):
         print('Start: Sentence Segmentation')
-        if len(self.articles) is 0:
+        if len(self.articles) == 0:
             self.load_articles()
 
-        assert len(self.articles) is not 0, 'Please check that input files are present and contain data.'
-
-        # TODO: WIP: multiprocessing (create independent ranges and spawn processes)
-        use_multiprocessing = 'serial'
-
-        def chunks(data, size=len(self.articles)):
-            it = iter(data)
-            for i in range(0, len(data), size):
-                yield {k: data[k] for k in islice(it, size)}
-
-        if use_multiprocessing == 'manager':
-            manager = multiprocessing.Manager()
-            return_dict = manager.dict()
-            jobs = []
-            n_processes = 7    # in addition to the main process, total = n_proc+1
-
-            def work(articles, return_dict):
-                sentences = {}
-                for i, article in enumerate(articles):
-                    sentences[i] = segmenter.segment_string(articles[article])
-
-                    if i % 5000 == 0:
-                        print('Segmenting article', i)
-
-                return_dict.update(sentences)
-
-            for item in chunks(self.articles, len(self.articles)):
-                p = multiprocessing.Process(target=work, args=(item, return_dict))
+        assert len(self.articles) != 0, 'Please check that input files are present and contain data.'
 
-                # Busy wait
-                while len(jobs) >= n_processes:
-                    pass
+        article_ids = list(self.articles.keys())
 
-                jobs.append(p)
-                p.start()
-
-            for proc in jobs:
-                proc.join()
-
-        elif use_multiprocessing == 'queue':
-            work_queue = multiprocessing.Queue()
-            jobs = []
-
-            for item in chunks(self.articles, len(self.articles)):
-                pass
+        if n_processes > 1:
+            # contiguous ranges of articles are segmented in a pool and merged back in order
+            chunks = (
+                [self.articles[article_id] for article_id in article_ids[start:start + chunk_size]]
+                for start in range(0, len(article_ids), chunk_size))
+            with multiprocessing.Pool(n_processes, initializer=_init_segmenter, initargs=(segmenter,)) as pool:
+                start = 0
+                for sentences in pool.imap(_segment_chunk, chunks):
+                    for offset, article_sentences in enumerate(sentences):
+                        self.sentences[article_ids[start + offset]] = article_sentences
+                    start += len(sentences)
+                    print('Segmented', start, 'of', len(article_ids), 'articles')
 
         else:    # serial option
-            for i, article in enumerate(self.articles):
-                self.sentences[i] = segmenter.segment_string(self.articles[article])
+            for i, article_id in enumerate(article_ids):
+                self.sentences[article_id] = segmenter.segment_string(self.articles[article_id])
 
                 if i % 5000 == 0:
                     print('Segmenting article', i)
@@ -147,149 +129,56 @@ class Sharding:
         print('Start: Distribute Articles Over Shards')
         assert len(self.articles) >= self.n_training_shards + self.n_test_shards, 'There are fewer articles than shards. Please add more data or reduce the number of shards requested.'
 
-        # Create dictionary with - key: sentence count per article, value: article id number
-        sentence_counts = defaultdict(lambda: [])
-
-        max_sentences = 0
-        total_sentences = 0
-
-        for article_id in self.sentences:
-            current_length = len(self.sentences[article_id])
-            sentence_counts[current_length].append(article_id)
-            max_sentences = max(max_sentences, current_length)
-            total_sentences += current_length
+        sentence_counts = {article_id: len(sentences) for article_id, sentences in self.sentences.items()}
+        total_sentences = sum(sentence_counts.values())
 
         n_sentences_assigned_to_training = int((1 - self.fraction_test_set) * total_sentences)
         nominal_sentences_per_training_shard = n_sentences_assigned_to_training // self.n_training_shards
         nominal_sentences_per_test_shard = (total_sentences - n_sentences_assigned_to_training) // self.n_test_shards
 
-        consumed_article_set = set({})
-        unused_article_set = set(self.articles.keys())
-
-        # Make first pass and add one article worth of lines per file
-        for file in self.output_training_files:
-            current_article_id = sentence_counts[max_sentences][-1]
-            sentence_counts[max_sentences].pop(-1)
-            self.output_training_files[file].append(current_article_id)
-            consumed_article_set.add(current_article_id)
-            unused_article_set.remove(current_article_id)
-
-            # Maintain the max sentence count
-            while len(sentence_counts[max_sentences]) == 0 and max_sentences > 0:
-                max_sentences -= 1
-
-            if len(self.sentences[current_article_id]) > nominal_sentences_per_training_shard:
-                nominal_sentences_per_training_shard = len(self.sentences[current_article_id])
-                print('Warning: A single article contains more than the nominal number of sentences per training shard.')
-
-        for file in self.output_test_files:
-            current_article_id = sentence_counts[max_sentences][-1]
-            sentence_counts[max_sentences].pop(-1)
-            self.output_test_files[file].append(current_article_id)
-            consumed_article_set.add(current_article_id)
-            unused_article_set.remove(current_article_id)
-
-            # Maintain the max sentence count
-            while len(sentence_counts[max_sentences]) == 0 and max_sentences > 0:
-                max_sentences -= 1
-
-            if len(self.sentences[current_article_id]) > nominal_sentences_per_test_shard:
-                nominal_sentences_per_test_shard = len(self.sentences[current_article_id])
-                print('Warning: A single article contains more than the nominal number of sentences per test shard.')
-
-        training_counts = []
-        test_counts = []
-
-        for shard in self.output_training_files:
-            training_counts.append(self.get_sentences_per_shard(self.output_training_files[shard]))
-
-        for shard in self.output_test_files:
-            test_counts.append(self.get_sentences_per_shard(self.output_test_files[shard]))
-
-        training_median = statistics.median(training_counts)
-        test_median = statistics.median(test_counts)
-
-        # Make subsequent passes over files to find articles to add without going over limit
-        history_remaining = []
-        n_history_remaining = 4
-
-        while len(consumed_article_set) < len(self.articles):
-            for fidx, file in enumerate(self.output_training_files):
-                nominal_next_article_size = min(nominal_sentences_per_training_shard - training_counts[fidx], max_sentences)
-
-                # Maintain the max sentence count
-                while len(sentence_counts[max_sentences]) == 0 and max_sentences > 0:
-                    max_sentences -= 1
-
-                while len(sentence_counts[nominal_next_article_size]) == 0 and nominal_next_article_size > 0:
-                    nominal_next_article_size -= 1
-
-                if nominal_next_article_size not in sentence_counts or nominal_next_article_size is 0 or training_counts[fidx] > training_median:
-                    continue    # skip adding to this file, will come back later if no file can accept unused articles
-
-                current_article_id = sentence_counts[nominal_next_article_size][-1]
-                sentence_counts[nominal_next_article_size].pop(-1)
-
-                self.output_training_files[file].append(current_article_id)
-                consumed_article_set.add(current_article_id)
-                unused_article_set.remove(current_article_id)
-
-            for fidx, file in enumerate(self.output_test_files):
-                nominal_next_article_size = min(nominal_sentences_per_test_shard - test_counts[fidx], max_sentences)
-
-                # Maintain the max sentence count
-                while len(sentence_counts[max_sentences]) == 0 and max_sentences > 0:
-                    max_sentences -= 1
-
-                while len(sentence_counts[nominal_next_article_size]) == 0 and nominal_next_article_size > 0:
-                    nominal_next_article_size -= 1
-
-                if nominal_next_article_size not in sentence_counts or nominal_next_article_size is 0 or test_counts[fidx] > test_median:
-                    continue    # skip adding to this file, will come back later if no file can accept unused articles
-
-                current_article_id = sentence_counts[nominal_next_article_size][-1]
-                sentence_counts[nominal_next_article_size].pop(-1)
-
-                self.output_test_files[file].append(current_article_id)
-                consumed_article_set.add(current_article_id)
-                unused_article_set.remove(current_article_id)
-
-            # If unable to place articles a few times, bump up nominal sizes by fraction until articles get placed
-            if len(history_remaining) == n_history_remaining:
-                history_remaining.pop(0)
-            history_remaining.append(len(unused_article_set))
-
-            history_same = True
-            for i in range(1, len(history_remaining)):
-                history_same = history_same and (history_remaining[i-1] == history_remaining[i])
-
-            if history_same:
-                nominal_sentences_per_training_shard += 1
-                # nominal_sentences_per_test_shard += 1
-
-            training_counts = []
-            test_counts = []
-            for shard in self.output_training_files:
-                training_counts.append(self.get_sentences_per_shard(self.output_training_files[shard]))
-
-            for shard in self.output_test_files:
-                test_counts.append(self.get_sentences_per_shard(self.output_test_files[shard]))
-
-            training_median = statistics.median(training_counts)
-            test_median = statistics.median(test_counts)
-
-            print('Distributing data over shards:', len(unused_article_set), 'articles remaining.')
-
-
-        if len(unused_article_set) != 0:
-            print('Warning: Some articles did not make it into output files.')
-
-
-        for shard in self.output_training_files:
-            print('Training shard:', self.get_sentences_per_shard(self.output_training_files[shard]))
-
-        for shard in self.output_test_files:
-            print('Test shard:', self.get_sentences_per_shard(self.output_test_files[shard]))
+        # Min-heaps of (sentence count, shard index) per split. Largest articles first, each goes to the
+        # least filled shard of the split that is furthest below its share of all sentences, which
+        # balances the shards to within one article at O(log k) per article.
+        training_files = list(self.output_training_files)
+        test_files = list(self.output_test_files)
+        training_heap = [(0, i) for i in range(len(training_files))]
+        test_heap = [(0, i) for i in range(len(test_files))]
+        training_assigned = 0
+        test_assigned = 0
+        test_target = total_sentences - n_sentences_assigned_to_training
+
+        for article_id in sorted(sentence_counts, key=sentence_counts.get, reverse=True):
+            n_sentences = sentence_counts[article_id]
+            # every shard gets at least one article
+            if test_heap[0][0] == 0 and training_heap[0][0] > 0:
+                use_test = True
+            elif training_heap[0][0] == 0:
+                use_test = False
+            else:
+                use_test = test_assigned * n_sentences_assigned_to_training < training_assigned * test_target
+
+            if use_test:
+                count, shard = heapq.heappop(test_heap)
+                self.output_test_files[test_files[shard]].append(article_id)
+                heapq.heappush(test_heap, (count + n_sentences, shard))
+                test_assigned += n_sentences
+            else:
+                count, shard = heapq.heappop(training_heap)
+                self.output_training_files[training_files[shard]].append(article_id)
+                heapq.heappush(training_heap, (count + n_sentences, shard))
+                training_assigned += n_sentences
+
+        largest_article = max(sentence_counts.values())
+        if largest_article > nominal_sentences_per_training_shard:
+            print('Warning: A single article contains more than the nominal number of sentences per training shard.')
+        if largest_article > nominal_sentences_per_test_shard:
+            print('Warning: A single article contains more than the nominal number of sentences per test shard.')
+
+        for count, shard in sorted(training_heap, key=lambda item: item[1]):
+            print('Training shard:', count)
+
+        for count, shard in sorted(test_heap, key=lambda item: item[1]):
+            print('Test shard:', count)
 
         print('End: Distribute Articles Over Shards')
 
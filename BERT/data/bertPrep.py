@@ -22,6 +22,7 @@ import multiprocessing
 import os
 import pprint
 import subprocess
+import sys
 
 
 def main(args):
@@ -133,7 +134,7 @@ def main(args):
             sharding = TextSharding.Sharding(args.input_files, output_file_prefix, args.n_training_shards, args.n_test_shards, args.fraction_test_set)
 
             sharding.load_articles()
-            sharding.segment_articles_into_sentences(segmenter)
+            sharding.segment_articles_into_sentences(segmenter, args.n_processes)
             sharding.distribute_articles_over_shards()
             sharding.write_shards_to_disk()
 
@@ -180,42 +181,35 @@ def main(args):
 
 
     elif args.action == 'create_hdf5_files':
-        last_process = None
-
         if not os.path.exists(directory_structure['hdf5'] + "/" + args.dataset):
             os.makedirs(directory_structure['hdf5'] + "/" + args.dataset)
 
-        def create_record_worker(filename_prefix, shard_id, output_format='hdf5'):
-            bert_preprocessing_command = 'python /workspace/bert/create_pretraining_data.py'
-            bert_preprocessing_command += ' --input_file=' + directory_structure['sharded'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.txt'
-            bert_preprocessing_command += ' --output_file=' + directory_structure['hdf5'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.' + output_format
-            bert_preprocessing_command += ' --vocab_file=' + args.vocab_file
-            bert_preprocessing_command += ' --do_lower_case' if args.do_lower_case else ''
-            bert_preprocessing_command += ' --max_seq_length=' + str(args.max_seq_length)
-            bert_preprocessing_command += ' --max_predictions_per_seq=' + str(args.max_predictions_per_seq)
-            bert_preprocessing_command += ' --masked_lm_prob=' + str(args.masked_lm_prob)
-            bert_preprocessing_command += ' --random_seed=' + str(args.random_seed)
-            bert_preprocessing_command += ' --dupe_factor=' + str(args.dupe_factor)
-            bert_preprocessing_process = subprocess.Popen(bert_preprocessing_command, shell=True)
-
-            last_process = bert_preprocessing_process
-
-            # This could be better optimized (fine if all take equal time)
-            if shard_id % args.n_processes == 0 and shard_id > 0:
-                bert_preprocessing_process.wait()
-            return last_process
-
+        # create_pretraining_data.py lives in the parent dir
+        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import create_pretraining_data
+
+        hdf5_args = argparse.Namespace(
+            vocab_file=args.vocab_file,
+            do_lower_case=bool(args.do_lower_case),
+            max_seq_length=args.max_seq_length,
+            max_predictions_per_seq=args.max_predictions_per_seq,
+            masked_lm_prob=args.masked_lm_prob,
+            short_seq_prob=0.1,
+            random_seed=args.random_seed,
+            dupe_factor=args.dupe_factor,
+            no_compression=bool(args.hdf5_no_compression))
+
+        input_files = []
+        output_files = []
         output_file_prefix = args.dataset
+        for filename_prefix, n_shards in [(output_file_prefix + '_training', args.n_training_shards),
+                                          (output_file_prefix + '_test', args.n_test_shards)]:
+            for shard_id in range(n_shards):
+                input_files.append(directory_structure['sharded'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.txt')
+                output_files.append(directory_structure['hdf5'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.hdf5')
 
-        for i in range(args.n_training_shards):
-            last_process = create_record_worker(output_file_prefix + '_training', i)
-
-        last_process.wait()
-
-        for i in range(args.n_test_shards):
-            last_process = create_record_worker(output_file_prefix + '_test', i)
-
-        last_process.wait()
+        # one pool over all training and test shards, workers pick up the next shard as soon as they are done
+        create_pretraining_data.create_pretraining_files(input_files, output_files, hdf5_args, args.n_processes)
 
 
 if __name__ == "__main__":
@@ -346,6 +340,13 @@ if __name__ == "__main__":
         help='Specify absolute path to vocab file to use)'
     )
 
+    parser.add_argument(
+        '--hdf5_no_compression',
+        type=int,
+        help='Specify whether to write uncompressed hdf5 files that can be memory mapped during pretraining 0=False, 1=True',
+        default=0
+    )
+
     parser.add_argument(
         '--skip_wikiextractor',
         type=int,
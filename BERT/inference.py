@@ -33,7 +33,7 @@ from tqdm import tqdm, trange
 from types import SimpleNamespace
 
 from file_utils import PYTORCH_PRETRAINED_BERT_CACHE
-from modeling import BertForQuestionAnswering, BertConfig, WEIGHTS_NAME, CONFIG_NAME
+from modeling import BertForQuestionAnswering, BertConfig, WEIGHTS_NAME, CONFIG_NAME, load_checkpoint_state_dict
 from tokenization import (BasicTokenizer, BertTokenizer, whitespace_tokenize)
 from run_squad import _get_best_indices, _compute_softmax, get_valid_prelim_predictions, get_answer_text
 
@@ -54,22 +54,28 @@ import numpy as np
 import collections
 
 
-def preprocess_tokenized_text(doc_tokens, query_tokens, tokenizer, 
-                              max_seq_length, max_query_length):
-    """ converts an example into a feature """
-    
-    if len(query_tokens) > max_query_length:
-        query_tokens = query_tokens[0:max_query_length]
-    
+def tokenize_document(doc_tokens, tokenizer):
+    """ sub tokens of the words in doc_tokens and the index of the word of every sub token """
     tok_to_orig_index = []
-    orig_to_tok_index = []
     all_doc_tokens = []
     for (i, token) in enumerate(doc_tokens):
-        orig_to_tok_index.append(len(all_doc_tokens))
         sub_tokens = tokenizer.tokenize(token)
         for sub_token in sub_tokens:
             tok_to_orig_index.append(i)
             all_doc_tokens.append(sub_token)
+    return all_doc_tokens, tok_to_orig_index
+
+
+def preprocess_tokenized_text(doc_tokens, query_tokens, tokenizer, 
+                              max_seq_length, max_query_length, tokenized_doc=None):
+    """ converts an example into a feature, tokenized_doc is tokenize_document(doc_tokens) if already known """
+    
+    if len(query_tokens) > max_query_length:
+        query_tokens = query_tokens[0:max_query_length]
+    
+    if tokenized_doc is None:
+        tokenized_doc = tokenize_document(doc_tokens, tokenizer)
+    all_doc_tokens, tok_to_orig_index = tokenized_doc
     
     # The -3 accounts for [CLS], [SEP] and [SEP]
     max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
@@ -190,6 +196,10 @@ def get_answer(doc_tokens, tokens_for_postprocessing,
                    key=lambda x: (x.start_logit + x.end_logit),
                    reverse=True)[:args.n_best_size]
     
+    # no valid span among the n best start and end logits, answer like run_squad does
+    if not nbest:
+        nbest.append(Prediction(text="empty", start_logit=0.0, end_logit=0.0))
+    
     total_scores = []
     best_non_null_entry = None
     for entry in nbest:
@@ -297,8 +307,9 @@ def main():
     
     # initialize model
     model = BertForQuestionAnswering(config)
-    model.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu')["model"])
+    # on the device first, memory mapped weights are then copied to it without a host copy
     model.to(device)
+    model.load_state_dict(load_checkpoint_state_dict(args.init_checkpoint))
     if args.fp16:
         model.half()
     model.eval()
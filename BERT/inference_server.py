@@ -0,0 +1,393 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long running BERT question answering service with dynamic batching.
+
+Unlike inference.py, which answers one question per launch, the model is loaded
+once and requests are answered concurrently:
+
+  - a thread pool tokenizes the requests, the tokenized contexts are cached since
+    many questions are usually asked about the same context
+  - one batcher thread collects the tokenized requests for up to max_delay_ms
+    (or until max_batch_size are pending), pads them to the longest one in the
+    batch and runs one forward
+  - the thread pool turns the logits into answers
+
+It is served over HTTP, on a TCP port or on a unix domain socket:
+
+    python inference_server.py --config_file bert_config.json --vocab_file vocab/vocab \\
+        --init_checkpoint bert_squad.safetensors --do_lower_case --port 8000
+
+    curl -d '{"question": "...", "context": "..."}' localhost:8000/predict
+    curl localhost:8000/stats
+
+Without --init_checkpoint the weights are random, which is enough to measure
+latency and throughput, e.g. on CPU, with benchmark_inference_server.py.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import math
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from inference import get_answer, preprocess_tokenized_text, tokenize_document
+from modeling import BertForQuestionAnswering, BertConfig, load_checkpoint_state_dict
+from tokenization import BertTokenizer, LRUCache
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PendingRequest = collections.namedtuple("PendingRequest",
+                                        ["doc_tokens", "tensors", "tokens", "future", "start_time"])
+
+
+class LatencyStats(object):
+    """Latencies of the last `window` answered requests and throughput since the last reset, thread safe."""
+
+    def __init__(self, window=100000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = collections.deque(maxlen=self.window)
+            self.num_requests = 0
+            self.num_errors = 0
+            self.num_batches = 0
+            self.num_batched_requests = 0
+            self.start_time = time.time()
+
+    def add_request(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+
+    def add_error(self):
+        with self.lock:
+            self.num_errors += 1
+
+    def add_batch(self, batch_size):
+        with self.lock:
+            self.num_batches += 1
+            self.num_batched_requests += batch_size
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+            elapsed = time.time() - self.start_time
+            summary = collections.OrderedDict()
+            summary["requests"] = self.num_requests
+            summary["errors"] = self.num_errors
+            summary["qps"] = self.num_requests / elapsed if elapsed > 0 else 0.0
+            summary["mean_batch_size"] = self.num_batched_requests / float(max(self.num_batches, 1))
+            for p in (50, 90, 99):
+                summary["p{}_ms".format(p)] = float(np.percentile(latencies, p)) if len(latencies) else None
+            return summary
+
+
+class QAService(object):
+    """
+    Answers (question, context) pairs with dynamic batching, see the module docstring.
+
+    `submit` returns a concurrent.futures.Future of a dict with the "answer" and the
+    "nbest" answers as inference.py computes them. `args` holds the SQuAD post
+    processing options of inference.py (n_best_size, max_answer_length, ...).
+    """
+
+    def __init__(self, model, tokenizer, args, device, max_batch_size=32, max_delay_ms=5.0,
+                 num_workers=4, cache_size=1024, pad_to_multiple_of=8):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.args = args
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.0
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.documents = LRUCache(cache_size)
+        self.stats = LatencyStats()
+        self.pending = queue.Queue()
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.batcher = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self.batcher.start()
+
+    def submit(self, question, context):
+        future = Future()
+        self.pool.submit(self._preprocess, question, context, future, time.time())
+        return future
+
+    def predict(self, question, context, timeout=None):
+        return self.submit(question, context).result(timeout)
+
+    def close(self):
+        self.pending.put(None)
+        self.batcher.join()
+        self.pool.shutdown()
+
+    def _document(self, context):
+        document = self.documents.get(context)
+        if document is None:
+            doc_tokens = context.split()
+            document = (doc_tokens, tokenize_document(doc_tokens, self.tokenizer))
+            self.documents.put(context, document)
+        return document
+
+    def _preprocess(self, question, context, future, start_time):
+        try:
+            doc_tokens, tokenized_doc = self._document(context)
+            tensors, tokens = preprocess_tokenized_text(doc_tokens,
+                                                        self.tokenizer.tokenize(question),
+                                                        self.tokenizer,
+                                                        max_seq_length=self.args.max_seq_length,
+                                                        max_query_length=self.args.max_query_length,
+                                                        tokenized_doc=tokenized_doc)
+        except Exception as e:
+            self.stats.add_error()
+            future.set_exception(e)
+            return
+        self.pending.put(PendingRequest(doc_tokens, tensors, tokens, future, start_time))
+
+    def _next_batch(self):
+        """Blocks for a request, then collects more for up to max_delay. None once closed."""
+        request = self.pending.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # answer what was collected, stop on the next call
+                self.pending.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _forward(self, batch):
+        # features are padded to max_seq_length, only keep up to the longest one of the batch
+        length = max(sum(request.tensors.input_mask) for request in batch)
+        length = int(math.ceil(length / float(self.pad_to_multiple_of))) * self.pad_to_multiple_of
+        length = min(length, self.args.max_seq_length)
+        inputs = [torch.tensor([getattr(request.tensors, name)[:length] for request in batch], dtype=torch.long)
+                  for name in ("input_ids", "segment_ids", "input_mask")]
+        input_ids, segment_ids, input_mask = [t.to(self.device, non_blocking=True) for t in inputs]
+        with torch.no_grad():
+            start_logits, end_logits = self.model(input_ids, segment_ids, input_mask)
+        # one copy to the host per batch
+        return start_logits.float().cpu().numpy(), end_logits.float().cpu().numpy()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                start_logits, end_logits = self._forward(batch)
+            except Exception as e:
+                logger.exception("forward of a batch of {} failed".format(len(batch)))
+                for request in batch:
+                    self.stats.add_error()
+                    request.future.set_exception(e)
+                continue
+            self.stats.add_batch(len(batch))
+            for i, request in enumerate(batch):
+                self.pool.submit(self._postprocess, request, start_logits[i], end_logits[i])
+
+    def _postprocess(self, request, start_logits, end_logits):
+        try:
+            answer, nbest = get_answer(request.doc_tokens, request.tokens,
+                                       start_logits.tolist(), end_logits.tolist(), self.args)
+        except Exception as e:
+            logger.exception("postprocessing of a request failed")
+            self.stats.add_error()
+            request.future.set_exception(e)
+            return
+        self.stats.add_request(time.time() - request.start_time)
+        request.future.set_result({"answer": answer, "nbest": nbest})
+
+
+class QARequestHandler(BaseHTTPRequestHandler):
+    """POST /predict with a {"question", "context"} json body, GET /stats and POST /stats/reset"""
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self._reply(200, self.server.service.stats.summary())
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/stats/reset":
+            self.server.service.stats.reset()
+            self._reply(200, {})
+            return
+        if self.path != "/predict":
+            self._reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            request = json.loads(body.decode("utf-8"))
+            question, context = request["question"], request["context"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": "expected a json object with question and context: {}".format(e)})
+            return
+        try:
+            self._reply(200, self.server.service.predict(question, context))
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+
+    def address_string(self):
+        # unix domain socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "uds"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        return request, ("uds", 0)
+
+
+def make_server(service, host="127.0.0.1", port=8000, uds=None):
+    """HTTP server of `service` on a unix domain socket if `uds` is given, else on host:port"""
+    if uds is not None:
+        if os.path.exists(uds):
+            os.remove(uds)
+        server = UnixHTTPServer(uds, QARequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QARequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def load_model(args, device):
+    config = BertConfig.from_json_file(args.config_file)
+    # Padding for divisibility by 8
+    if config.vocab_size % 8 != 0:
+        config.vocab_size += 8 - (config.vocab_size % 8)
+    model = BertForQuestionAnswering(config)
+    model.to(device)
+    if args.init_checkpoint is not None:
+        model.load_state_dict(load_checkpoint_state_dict(args.init_checkpoint))
+    else:
+        logger.warning("no --init_checkpoint, answering with random weights")
+    if args.fp16:
+        model.half()
+    model.eval()
+    return model
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_file", default=None, type=str, required=True,
+                        help="The BERT model config")
+    parser.add_argument("--vocab_file", default=None, type=str, required=True,
+                        help="Vocabulary mapping/file BERT was pretrainined on")
+    parser.add_argument("--init_checkpoint", default=None, type=str,
+                        help="The fine tuned SQuAD checkpoint, random weights if not given")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--uds", default=None, type=str,
+                        help="Serve on this unix domain socket instead of host:port")
+    parser.add_argument("--max_batch_size", default=32, type=int,
+                        help="Maximum number of requests per forward")
+    parser.add_argument("--max_delay_ms", default=5.0, type=float,
+                        help="How long the first request of a batch waits for more requests")
+    parser.add_argument("--num_workers", default=4, type=int,
+                        help="Threads for tokenization and answer post-processing")
+    parser.add_argument("--cache_size", default=1024, type=int,
+                        help="Number of tokenized contexts kept")
+    parser.add_argument("--num_threads", default=None, type=int,
+                        help="torch intra-op threads, for CPU inference")
+    parser.add_argument("--max_seq_length", default=384, type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--max_query_length", default=64, type=int,
+                        help="The maximum number of tokens for the question.")
+    parser.add_argument("--n_best_size", default=20, type=int,
+                        help="The total number of n-best predictions to generate. ")
+    parser.add_argument("--max_answer_length", default=30, type=int,
+                        help="The maximum length of an answer that can be generated.")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Whether to lower case the input text. True for uncased models, False for cased models.")
+    parser.add_argument('--version_2_with_negative', action='store_true',
+                        help='If true, then the model can reply with "unknown". ')
+    parser.add_argument('--null_score_diff_threshold', type=float, default=-11.0,
+                        help="If null_score - best_non_null is greater than the threshold predict 'unknown'. ")
+    parser.add_argument("--verbose_logging", action='store_true',
+                        help="If true, all of the warnings related to data processing will be printed. ")
+    parser.add_argument("--no_cuda", action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--fp16', action='store_true',
+                        help="Run the model in half precision")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    tokenizer = BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case, max_len=512)
+    model = load_model(args, device)
+    service = QAService(model, tokenizer, args, device,
+                        max_batch_size=args.max_batch_size,
+                        max_delay_ms=args.max_delay_ms,
+                        num_workers=args.num_workers,
+                        cache_size=args.cache_size)
+    server = make_server(service, args.host, args.port, args.uds)
+    logger.info("serving on {}".format(args.uds if args.uds is not None else "{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -17,17 +17,23 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
 import copy
+import inspect
 import json
 import logging
 import math
 import os
 import shutil
+import struct
 import tarfile
 import tempfile
 import sys
+import zipfile
 from io import open
+from typing import Optional, Tuple
 
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss
@@ -54,8 +60,91 @@ PRETRAINED_MODEL_ARCHIVE_MAP = {
 }
 CONFIG_NAME = 'bert_config.json'
 WEIGHTS_NAME = 'pytorch_model.bin'
+FLAT_WEIGHTS_NAME = 'model.safetensors'
 TF_WEIGHTS_NAME = 'model.ckpt'
 
+# dtype names of the flat weights header, the same as safetensors uses
+FLAT_DTYPES = {
+    torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+    torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8',
+    torch.uint8: 'U8', torch.bool: 'BOOL',
+}
+FLAT_NUMPY_DTYPES = {
+    'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16,
+    'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8,
+    'U8': np.uint8, 'BOOL': np.bool_,
+}
+
+
+def save_flat_weights(state_dict, weights_path):
+    """
+    Saves a state dict as one flat file in the safetensors layout: the size of the header as
+    8 byte little endian integer, a JSON header with dtype, shape and byte range of every
+    tensor, then the raw tensor bytes. See `load_flat_weights`.
+    """
+    header = collections.OrderedDict()
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': FLAT_DTYPES[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + num_bytes]}
+        tensors.append(tensor)
+        offset += num_bytes
+    header = json.dumps(header).encode('utf-8')
+    # pad with spaces so that the tensor data is 8 byte aligned
+    header += b' ' * (-len(header) % 8)
+    with open(weights_path, 'wb') as writer:
+        writer.write(struct.pack('<Q', len(header)))
+        writer.write(header)
+        for tensor in tensors:
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            writer.write(tensor.numpy().tobytes())
+
+
+def load_flat_weights(weights_path):
+    """
+    Loads a state dict saved by `save_flat_weights` (or any safetensors file) without reading it.
+
+    The tensors are copy-on-write memory maps of the file, so loading them into a model copies
+    the weights straight from the page cache to the parameters, on whatever device those are,
+    and all processes on a node that load the same file share one copy of it in memory.
+    """
+    with open(weights_path, 'rb') as reader:
+        header_size = struct.unpack('<Q', reader.read(8))[0]
+        header = json.loads(reader.read(header_size).decode('utf-8'), object_pairs_hook=collections.OrderedDict)
+    header.pop('__metadata__', None)
+    state_dict = collections.OrderedDict()
+    if not header:
+        return state_dict
+    data = np.memmap(weights_path, dtype=np.uint8, mode='c', offset=8 + header_size)
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        array = data[start:end].view(FLAT_NUMPY_DTYPES[info['dtype']]).reshape(info['shape'])
+        tensor = torch.from_numpy(array)
+        if info['dtype'] == 'BF16':
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor
+    return state_dict
+
+
+def load_checkpoint_state_dict(checkpoint_path):
+    """
+    Model weights of a checkpoint, either a flat `.safetensors` weights file (see
+    `load_flat_weights`) or a torch.save'd dict with the state dict under "model" as written by
+    run_pretraining.py. The latter is memory mapped too where torch.load supports it, so that
+    the optimizer state it also holds is not read.
+    """
+    if checkpoint_path.endswith('.safetensors'):
+        return load_flat_weights(checkpoint_path)
+    # only the zip format of PyTorch 1.6+ can be memory mapped
+    if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(checkpoint_path):
+        return torch.load(checkpoint_path, map_location='cpu', mmap=True)["model"]
+    return torch.load(checkpoint_path, map_location='cpu')["model"]
+
+
 def load_tf_weights_in_bert(model, tf_checkpoint_path):
     """ Load tf checkpoints in a pytorch model
     """
@@ -87,12 +176,17 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
             print("Skipping {}".format("/".join(name)))
             continue
         pointer = model
+        qkv_part = None
         for m_name in name:
             if re.fullmatch(r'[A-Za-z]+_\d+', m_name):
                 l = re.split(r'_(\d+)', m_name)
             else:
                 l = [m_name]
-            if l[0] == 'kernel' or l[0] == 'gamma':
+            if l[0] in QKV_NAMES and hasattr(pointer, 'qkv'):
+                # fused projection, query, key and value are stacked along the output features
+                qkv_part = QKV_NAMES.index(l[0])
+                pointer = getattr(pointer, 'qkv')
+            elif l[0] == 'kernel' or l[0] == 'gamma':
                 pointer = getattr(pointer, 'weight')
             elif l[0] == 'output_bias' or l[0] == 'beta':
                 pointer = getattr(pointer, 'bias')
@@ -107,13 +201,18 @@ def load_tf_weights_in_bert(model, tf_checkpoint_path):
             pointer = getattr(pointer, 'weight')
         elif m_name == 'kernel':
             array = np.ascontiguousarray(np.transpose(array))
+        if qkv_part is not None:
+            pointer = pointer.data.chunk(len(QKV_NAMES))[qkv_part]
         try:
             assert pointer.shape == array.shape
         except AssertionError as e:
             e.args += (pointer.shape, array.shape)
             raise
         print("Initialize PyTorch weight {}".format(name))
-        pointer.data = torch.from_numpy(array)
+        if qkv_part is not None:
+            pointer.copy_(torch.from_numpy(array))
+        else:
+            pointer.data = torch.from_numpy(array)
     return model
 
 def gelu(x):
@@ -201,7 +300,10 @@ class BertConfig(object):
                  max_position_embeddings=512,
                  type_vocab_size=2,
                  initializer_range=0.02,
-                 output_all_encoded_layers=False):
+                 output_all_encoded_layers=False,
+                 attention_backend="default",
+                 attention_chunk_size=128,
+                 fused_qkv=False):
         """Constructs BertConfig.
 
         Args:
@@ -225,6 +327,16 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attention_backend: How self attention is computed, the weights are the same for all of them.
+                "default" materializes the [batch_size, num_heads, seq_length, seq_length] scores,
+                "sdpa" uses torch.nn.functional.scaled_dot_product_attention (flash/memory efficient
+                kernels with the mask and dropout fused), "chunked" computes the scores for
+                `attention_chunk_size` queries at a time, which bounds the scores memory without
+                dedicated kernels (e.g. on CPU).
+            attention_chunk_size: Queries per chunk of the "chunked" backend.
+            fused_qkv: Compute query, key and value with a single linear layer. State dicts are still
+                saved and loaded with separate query, key and value weights, but the order of the
+                parameters changes, so optimizer states saved without it cannot be resumed with it.
         """
         if isinstance(vocab_size_or_config_json_file, str) or (sys.version_info[0] == 2
                         and isinstance(vocab_size_or_config_json_file, unicode)):
@@ -245,6 +357,9 @@ class BertConfig(object):
             self.type_vocab_size = type_vocab_size
             self.initializer_range = initializer_range
             self.output_all_encoded_layers = output_all_encoded_layers
+            self.attention_backend = attention_backend
+            self.attention_chunk_size = attention_chunk_size
+            self.fused_qkv = fused_qkv
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -332,6 +447,18 @@ class BertLayerNorm(Module):
             x = self.weight * x + self.bias
         return x
 
+
+def packed_attention_mask(sequence_ids):
+    """
+    Block diagonal [batch_size, seq_length, seq_length] attention mask for packed rows.
+
+    `sequence_ids` numbers the sequences of a row 1, 2, ... and is 0 on padding, a
+    token may only attend to tokens of its own sequence.
+    """
+    same_sequence = sequence_ids.unsqueeze(2) == sequence_ids.unsqueeze(1)
+    return same_sequence & (sequence_ids > 0).unsqueeze(1)
+
+
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
     """
@@ -346,10 +473,12 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids, position_ids: Optional[torch.Tensor] = None):
+        # packed rows pass explicit position ids that restart at every sequence
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
 
         words_embeddings = self.word_embeddings(input_ids)
         position_embeddings = self.position_embeddings(position_ids)
@@ -361,6 +490,12 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+ATTENTION_BACKENDS = ("default", "sdpa", "chunked")
+
+# scaled_dot_product_attention exists from PyTorch 2.0 on
+SDPA_IS_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -378,6 +513,16 @@ class BertSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+        # configs saved before the backends were added do not have these
+        self.attention_backend = getattr(config, "attention_backend", "default")
+        self.attention_chunk_size = getattr(config, "attention_chunk_size", 128)
+        if self.attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError("Unknown attention_backend {}, expected one of {}".format(
+                self.attention_backend, ", ".join(ATTENTION_BACKENDS)))
+        if self.attention_backend == "sdpa" and not SDPA_IS_AVAILABLE:
+            logger.warning("scaled_dot_product_attention needs PyTorch 2.0, using the chunked attention backend")
+            self.attention_backend = "chunked"
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = torch.reshape(x, new_x_shape)
@@ -388,10 +533,49 @@ class BertSelfAttention(nn.Module):
         x = torch.reshape(x, new_x_shape)
         return x.permute(0, 2, 3, 1)
 
+    @torch.jit.unused
+    def sdpa_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        # the additive mask has to match the dtype of the queries under autocast
+        return F.scaled_dot_product_attention(query_layer, key_layer, value_layer,
+                                              attn_mask=attention_mask.to(query_layer.dtype),
+                                              dropout_p=self.dropout.p if self.training else 0.0)
+
+    def chunked_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """Same as the default backend, with only [batch_size, num_heads, attention_chunk_size, seq_length] scores live"""
+        seq_length = query_layer.size(2)
+        contexts = []
+        for start in range(0, seq_length, self.attention_chunk_size):
+            end = min(start + self.attention_chunk_size, seq_length)
+            chunk_mask = attention_mask
+            if attention_mask.size(2) > 1:
+                # block diagonal mask of packed rows, one row per query
+                chunk_mask = attention_mask[:, :, start:end]
+            attention_scores = torch.matmul(query_layer[:, :, start:end], key_layer)
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            attention_probs = self.dropout(F.softmax(attention_scores + chunk_mask, dim=-1))
+            contexts.append(torch.matmul(attention_probs, value_layer))
+        return torch.cat(contexts, dim=2)
+
+    def project(self, hidden_states) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return self.query(hidden_states), self.key(hidden_states), self.value(hidden_states)
+
     def forward(self, hidden_states, attention_mask):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
+        mixed_query_layer, mixed_key_layer, mixed_value_layer = self.project(hidden_states)
+
+        if self.attention_backend != "default":
+            query_layer = self.transpose_for_scores(mixed_query_layer)
+            value_layer = self.transpose_for_scores(mixed_value_layer)
+            if self.attention_backend == "sdpa" and not torch.jit.is_scripting():
+                context_layer = self.sdpa_attention(query_layer, self.transpose_for_scores(mixed_key_layer),
+                                                    value_layer, attention_mask)
+            else:
+                # TorchScript falls back to the chunked backend
+                context_layer = self.chunked_attention(query_layer, self.transpose_key_for_scores(mixed_key_layer),
+                                                       value_layer, attention_mask)
+            # [batch_size, seq_length, all_head_size], reshape only copies if the kernel did not
+            # already return the heads interleaved
+            context_layer = context_layer.transpose(1, 2)
+            return torch.reshape(context_layer, context_layer.size()[:-2] + (self.all_head_size,))
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_key_for_scores(mixed_key_layer)
@@ -417,6 +601,48 @@ class BertSelfAttention(nn.Module):
         return context_layer
 
 
+QKV_NAMES = ("query", "key", "value")
+
+
+def split_qkv_state_dict(module, state_dict, prefix, local_metadata):
+    """State dict hook that saves a fused projection as separate query, key and value weights"""
+    for name in ("weight", "bias"):
+        fused = state_dict.pop(prefix + "qkv." + name)
+        for qkv_name, tensor in zip(QKV_NAMES, fused.chunk(len(QKV_NAMES))):
+            state_dict[prefix + qkv_name + "." + name] = tensor
+    return state_dict
+
+
+class BertFusedSelfAttention(BertSelfAttention):
+    """
+    Self attention with query, key and value computed by one [3 * all_head_size, hidden_size]
+    linear layer, i.e. one GEMM instead of three. The query, key and value views of its output
+    are strided, the heads are split without copies.
+
+    The state dict keeps the layout of `BertSelfAttention`, so checkpoints load and save
+    interchangeably with the unfused module.
+    """
+    def __init__(self, config):
+        super(BertFusedSelfAttention, self).__init__(config)
+        del self.query, self.key, self.value
+        self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
+        self._register_state_dict_hook(split_qkv_state_dict)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        for name in ("weight", "bias"):
+            keys = [prefix + qkv_name + "." + name for qkv_name in QKV_NAMES]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + "qkv." + name] = torch.cat([state_dict.pop(key) for key in keys])
+        super(BertFusedSelfAttention, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def project(self, hidden_states) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        mixed_layer = self.qkv(hidden_states)
+        size = self.all_head_size
+        return mixed_layer[..., :size], mixed_layer[..., size:2 * size], mixed_layer[..., 2 * size:]
+
+
 class BertSelfOutput(nn.Module):
     def __init__(self, config):
         super(BertSelfOutput, self).__init__()
@@ -434,7 +660,10 @@ class BertSelfOutput(nn.Module):
 class BertAttention(nn.Module):
     def __init__(self, config):
         super(BertAttention, self).__init__()
-        self.self = BertSelfAttention(config)
+        if getattr(config, "fused_qkv", False):
+            self.self = BertFusedSelfAttention(config)
+        else:
+            self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
     def forward(self, input_tensor, attention_mask):
@@ -474,18 +703,115 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def feed_forward(self, attention_output):
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
 
+    def forward(self, hidden_states, attention_mask):
+        attention_output = self.attention(hidden_states, attention_mask)
+        return self.feed_forward(attention_output)
+
+    @torch.jit.unused
+    def checkpointed_forward(self, hidden_states, attention_mask, policy: str):
+        """Recomputes the attention block, the feed forward block or the whole layer (any other `policy`) in backward"""
+        if policy == "attention":
+            attention_output = checkpoint.checkpoint(self.attention, hidden_states, attention_mask)
+            return self.feed_forward(attention_output)
+        if policy == "mlp":
+            attention_output = self.attention(hidden_states, attention_mask)
+            return checkpoint.checkpoint(self.feed_forward, attention_output)
+        return checkpoint.checkpoint(self.forward, hidden_states, attention_mask)
+
+
+# "chunks" checkpoints chunks of sqrt(num_layers) layers, "attention" and "mlp" that block of
+# every layer and "every_k" every k-th layer
+CHECKPOINT_POLICIES = ("chunks", "attention", "mlp", "every_k")
+
+
+def activation_memory(config, batch_size, seq_length, policy=None, every=1, bytes_per_element=2):
+    """
+    Rough estimate of the activation memory the encoder keeps for backward, in bytes.
+
+    `policy` is one of CHECKPOINT_POLICIES or None for no checkpointing. Only the tensors
+    that scale with the batch are counted: a checkpointed block keeps its input and one
+    block at a time is recomputed in backward.
+    """
+    tokens = batch_size * seq_length
+    hidden = tokens * config.hidden_size
+    # query, key, value, context, output projection input, dropout mask and layer norm input
+    attention = 7 * hidden
+    if getattr(config, "attention_backend", "default") != "sdpa":
+        # softmax output, dropout mask and dropped out probabilities of the scores
+        attention += 2.5 * batch_size * config.num_attention_heads * seq_length * seq_length
+    # gelu input and output, output projection, dropout mask and layer norm input
+    mlp = hidden + 2 * tokens * config.intermediate_size + 2 * hidden
+    layer = attention + mlp
+    num_layers = config.num_hidden_layers
+    if policy is None:
+        elements = num_layers * layer
+    elif policy == "attention":
+        elements = num_layers * (hidden + mlp) + attention
+    elif policy == "mlp":
+        elements = num_layers * (attention + hidden) + mlp
+    elif policy == "every_k":
+        checkpointed = int(math.ceil(num_layers / float(every)))
+        elements = checkpointed * hidden + (num_layers - checkpointed) * layer + layer
+    elif policy == "chunks":
+        chunk_length = int(math.ceil(math.sqrt(num_layers)))
+        elements = int(math.ceil(num_layers / float(chunk_length))) * hidden + chunk_length * layer
+    else:
+        raise ValueError("Unknown checkpoint policy {}, expected one of {}".format(
+            policy, ", ".join(CHECKPOINT_POLICIES)))
+    return int(elements * bytes_per_element)
+
+
+def recompute_flops(config, batch_size, seq_length, policy=None, every=1):
+    """Forward FLOPs a checkpoint policy recomputes in backward, see `activation_memory`"""
+    tokens = batch_size * seq_length
+    hidden_size = config.hidden_size
+    # query, key, value and output projections plus the scores and the context
+    attention = 8 * tokens * hidden_size * hidden_size + 4 * tokens * seq_length * hidden_size
+    mlp = 4 * tokens * hidden_size * config.intermediate_size
+    num_layers = config.num_hidden_layers
+    if policy is None:
+        return 0
+    if policy == "attention":
+        return num_layers * attention
+    if policy == "mlp":
+        return num_layers * mlp
+    if policy == "every_k":
+        return int(math.ceil(num_layers / float(every))) * (attention + mlp)
+    return num_layers * (attention + mlp)
+
+
+def select_checkpoint_policy(config, batch_size, seq_length, memory_budget, bytes_per_element=2):
+    """
+    Returns the (policy, every) that recomputes the least and whose activations fit in
+    `memory_budget` bytes, policy None meaning no checkpointing. Falls back to the policy
+    needing the least memory if none fits.
+    """
+    candidates = [(None, 1), ("attention", 1), ("mlp", 1), ("chunks", 1)]
+    candidates += [("every_k", every) for every in range(1, config.num_hidden_layers + 1)]
+    fitting = [(policy, every) for policy, every in candidates
+               if activation_memory(config, batch_size, seq_length, policy, every, bytes_per_element) <= memory_budget]
+    if not fitting:
+        policy, every = min(candidates, key=lambda c: activation_memory(
+            config, batch_size, seq_length, c[0], c[1], bytes_per_element))
+        logger.warning("No checkpoint policy fits the activations into {} bytes, using {}".format(
+            memory_budget, policy))
+        return policy, every
+    return min(fitting, key=lambda c: recompute_flops(config, batch_size, seq_length, c[0], c[1]))
+
+
 class BertEncoder(nn.Module):
     def __init__(self, config):
         super(BertEncoder, self).__init__()
         self.layer = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
         self.output_all_encoded_layers = config.output_all_encoded_layers
         self._checkpoint_activations = False
+        self._checkpoint_policy = "chunks"
+        self._checkpoint_every = 1
 
     @torch.jit.unused
     def checkpointed_forward(self, hidden_states, attention_mask):
@@ -510,16 +836,22 @@ class BertEncoder(nn.Module):
     def forward(self, hidden_states, attention_mask):
         all_encoder_layers = []
 
-        if self._checkpoint_activations:
+        chunked = self._checkpoint_activations and self._checkpoint_policy == "chunks"
+        if chunked:
             hidden_states = self.checkpointed_forward(hidden_states, attention_mask)
         else:
             for i,layer_module in enumerate(self.layer):
-                hidden_states = layer_module(hidden_states, attention_mask)
+                if self._checkpoint_activations and \
+                        (self._checkpoint_policy != "every_k" or i % self._checkpoint_every == 0):
+                    hidden_states = layer_module.checkpointed_forward(hidden_states, attention_mask*1,
+                                                                      self._checkpoint_policy)
+                else:
+                    hidden_states = layer_module(hidden_states, attention_mask)
 
                 if self.output_all_encoded_layers:
                     all_encoder_layers.append(hidden_states)
 
-        if not self.output_all_encoded_layers or self._checkpoint_activations:
+        if not self.output_all_encoded_layers or chunked:
             all_encoder_layers.append(hidden_states)
         return all_encoder_layers
 
@@ -528,10 +860,15 @@ class BertPooler(nn.Module):
         super(BertPooler, self).__init__()
         self.dense_act = LinearActivation(config.hidden_size, config.hidden_size, act="tanh")
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, pooled_positions: Optional[torch.Tensor] = None):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token.
-        first_token_tensor = hidden_states[:, 0]
+        if pooled_positions is None:
+            first_token_tensor = hidden_states[:, 0]
+        else:
+            # packed rows: [CLS] of every sequence, [batch_size, sequences_per_pack, hidden_size]
+            index = pooled_positions.unsqueeze(-1).expand(-1, -1, hidden_states.size(-1))
+            first_token_tensor = torch.gather(hidden_states, 1, index)
         pooled_output = self.dense_act(first_token_tensor)
         return pooled_output
 
@@ -627,10 +964,16 @@ class BertPreTrainedModel(nn.Module):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
-    def checkpoint_activations(self, val):
+    def checkpoint_activations(self, val, policy="chunks", every=1):
+        """Enables activation checkpointing with one of CHECKPOINT_POLICIES, `every` is the k of "every_k" """
+        if policy not in CHECKPOINT_POLICIES:
+            raise ValueError("Unknown checkpoint policy {}, expected one of {}".format(
+                policy, ", ".join(CHECKPOINT_POLICIES)))
         def _apply_flag(module):
             if hasattr(module, "_checkpoint_activations"):
                 module._checkpoint_activations=val
+                module._checkpoint_policy=policy
+                module._checkpoint_every=every
         self.apply(_apply_flag)
     def enable_apex(self, val):
         def _apply_flag(module):
@@ -666,7 +1009,11 @@ class BertPreTrainedModel(nn.Module):
             state_dict: an optional state dictionnary (collections.OrderedDict object) to use instead of Google pre-trained models
             *inputs, **kwargs: additional input for the specific Bert class
                 (ex: num_labels for BertForSequenceClassification)
+            device: an optional device to load the weights to, the model is moved there before
+                loading so that weights memory mapped from a `model.safetensors` are copied
+                to it directly
         """
+        device = kwargs.pop('device', None)
         if pretrained_model_name_or_path in PRETRAINED_MODEL_ARCHIVE_MAP:
             archive_file = PRETRAINED_MODEL_ARCHIVE_MAP[pretrained_model_name_or_path]
         else:
@@ -705,9 +1052,16 @@ class BertPreTrainedModel(nn.Module):
         logger.info("Model config {}".format(config))
         # Instantiate model.
         model = cls(config, *inputs, **kwargs)
+        if device is not None:
+            model.to(device)
         if state_dict is None and not from_tf:
-            weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-            state_dict = torch.load(weights_path, map_location='cpu' if not torch.cuda.is_available() else None)
+            flat_weights_path = os.path.join(serialization_dir, FLAT_WEIGHTS_NAME)
+            if os.path.exists(flat_weights_path):
+                # stays valid after the temp dir is removed, the mapping keeps the file
+                state_dict = load_flat_weights(flat_weights_path)
+            else:
+                weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
+                state_dict = torch.load(weights_path, map_location='cpu' if not torch.cuda.is_available() else None)
         if tempdir:
             # Clean up temp dir
             shutil.rmtree(tempdir)
@@ -778,7 +1132,13 @@ class BertModel(BertPreTrainedModel):
         `attention_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length] with indices
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
-            a batch has varying length sentences.
+            a batch has varying length sentences. For packed rows a [batch_size, sequence_length, sequence_length]
+            mask (see `packed_attention_mask`) that only lets tokens attend within their own sequence.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length], defaults to
+            0..sequence_length-1. Packed rows restart positions at every sequence.
+        `pooled_positions`: an optional torch.LongTensor of shape [batch_size, sequences_per_pack] with the
+            position of the `CLS` token of every sequence in a packed row, the pooled output is then
+            of shape [batch_size, sequences_per_pack, hidden_size].
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -813,13 +1173,19 @@ class BertModel(BertPreTrainedModel):
         self.apply(self.init_bert_weights)
         self.output_all_encoded_layers = config.output_all_encoded_layers
 
-    def forward(self, input_ids, token_type_ids, attention_mask):
+    def forward(self, input_ids, token_type_ids, attention_mask,
+                position_ids: Optional[torch.Tensor] = None,
+                pooled_positions: Optional[torch.Tensor] = None):
         # We create a 3D attention mask from a 2D tensor mask.
         # Sizes are [batch_size, 1, 1, to_seq_length]
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        if attention_mask.dim() == 3:
+            # block diagonal [batch_size, from_seq_length, to_seq_length] mask of packed rows
+            extended_attention_mask = attention_mask.unsqueeze(1)
+        else:
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -829,10 +1195,10 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = extended_attention_mask.to(dtype=self.embeddings.word_embeddings.weight.dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         encoded_layers = self.encoder(embedding_output, extended_attention_mask)
         sequence_output = encoded_layers[-1]
-        pooled_output = self.pooler(sequence_output)
+        pooled_output = self.pooler(sequence_output, pooled_positions)
         if not self.output_all_encoded_layers:
             encoded_layers = encoded_layers[-1:]
         return encoded_layers, pooled_output
@@ -864,6 +1230,12 @@ class BertForPreTraining(BertPreTrainedModel):
         `next_sentence_label`: optional next sentence classification loss: torch.LongTensor of shape [batch_size]
             with indices selected in [0, 1].
             0 => next sentence is the continuation, 1 => next sentence is a random sentence.
+        `position_ids`, `next_sentence_positions`: optional inputs for packed rows, see `BertModel`
+            (`next_sentence_positions` is passed as `pooled_positions`). The next sentence classification
+            logits are then of shape [batch_size, sequences_per_pack, 2].
+        `masked_lm_positions`: optional torch.LongTensor of shape [batch_size, max_predictions_per_seq] with
+            the positions of the masked tokens. The masked language modeling head then only runs on these
+            and its logits are of shape [batch_size, max_predictions_per_seq, vocab_size].
 
     Outputs:
         if `masked_lm_labels` and `next_sentence_label` are not `None`:
@@ -894,9 +1266,19 @@ class BertForPreTraining(BertPreTrainedModel):
         self.cls = BertPreTrainingHeads(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids, attention_mask):
-        encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask)
+    def forward(self, input_ids, token_type_ids, attention_mask,
+                position_ids: Optional[torch.Tensor] = None,
+                next_sentence_positions: Optional[torch.Tensor] = None,
+                masked_lm_positions: Optional[torch.Tensor] = None):
+        encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
+                                                  position_ids, next_sentence_positions)
         sequence_output = encoded_layers[-1]
+        if masked_lm_positions is not None:
+            # the vocab projection is the largest matmul of the model, only run it
+            # (and the transform before it) on the ~15% masked tokens. Positions have
+            # a fixed size per batch so this does not sync with the host.
+            index = masked_lm_positions.unsqueeze(-1).expand(-1, -1, sequence_output.size(-1))
+            sequence_output = torch.gather(sequence_output, 1, index)
         prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output)
 
         return prediction_scores, seq_relationship_score
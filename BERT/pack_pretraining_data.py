@@ -0,0 +1,172 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pack the padded sequences of pretraining HDF5 shards into full rows.
+
+Every input sequence is padded to max_seq_length by create_pretraining_data.py,
+with short_seq_prob a large fraction of the tokens of a shard are padding that
+the model still computes attention over. This bins several sequences into one
+row (best fit decreasing on the sequence lengths) and writes, per row:
+
+    input_ids, segment_ids          concatenated sequences, zero padded
+    position_ids                    restart at 0 for every sequence
+    sequence_ids                    1, 2, ... per sequence, 0 on padding
+    masked_lm_positions/_ids        shifted into row coordinates
+    next_sentence_positions/_labels [CLS] position and label per sequence, label -1 if absent
+
+run_pretraining.py detects packed shards by their sequence_ids dataset, builds a
+block diagonal attention mask from it and computes one next sentence prediction
+per sequence.
+
+    python pack_pretraining_data.py --input_dir <hdf5 dir> --output_dir <packed dir>
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+
+def pack_sequences(lengths, max_seq_length, max_sequences_per_pack):
+    """
+    Best fit decreasing bin packing.
+
+    Returns a list of packs, each a list of indices into ``lengths`` whose lengths
+    sum to at most ``max_seq_length``.
+    """
+    packs = []
+    # open_packs[r] holds packs with r free tokens and room for another sequence
+    open_packs = [[] for _ in range(max_seq_length + 1)]
+    num_open = np.zeros(max_seq_length + 1, dtype=np.int64)
+    for idx in np.argsort(-lengths, kind='stable'):
+        length = int(lengths[idx])
+        candidates = np.flatnonzero(num_open[length:])
+        if len(candidates) > 0:
+            free = length + int(candidates[0])
+            pack_id = open_packs[free].pop()
+            num_open[free] -= 1
+        else:
+            pack_id = len(packs)
+            packs.append([])
+            free = max_seq_length
+        packs[pack_id].append(idx)
+        free -= length
+        if free > 0 and len(packs[pack_id]) < max_sequences_per_pack:
+            open_packs[free].append(pack_id)
+            num_open[free] += 1
+    return packs
+
+
+def pack_file(input_file, output_file, max_sequences_per_pack, compression):
+    with h5py.File(input_file, 'r') as f:
+        input_ids = f['input_ids'][:]
+        input_mask = f['input_mask'][:]
+        segment_ids = f['segment_ids'][:]
+        masked_lm_positions = f['masked_lm_positions'][:]
+        masked_lm_ids = f['masked_lm_ids'][:]
+        next_sentence_labels = f['next_sentence_labels'][:]
+
+    num_sequences, max_seq_length = input_ids.shape
+    max_predictions = masked_lm_positions.shape[1] * max_sequences_per_pack
+    lengths = input_mask.astype(np.int64).sum(axis=1)
+    packs = pack_sequences(lengths, max_seq_length, max_sequences_per_pack)
+    num_packs = len(packs)
+
+    features = {
+        'input_ids': np.zeros([num_packs, max_seq_length], dtype='i4'),
+        'segment_ids': np.zeros([num_packs, max_seq_length], dtype='i1'),
+        'position_ids': np.zeros([num_packs, max_seq_length], dtype='i2'),
+        'sequence_ids': np.zeros([num_packs, max_seq_length], dtype='i1'),
+        'masked_lm_positions': np.zeros([num_packs, max_predictions], dtype='i4'),
+        'masked_lm_ids': np.zeros([num_packs, max_predictions], dtype='i4'),
+        'next_sentence_positions': np.zeros([num_packs, max_sequences_per_pack], dtype='i2'),
+        'next_sentence_labels': np.full([num_packs, max_sequences_per_pack], -1, dtype='i1'),
+    }
+    for row, pack in enumerate(packs):
+        offset = 0
+        num_predictions = 0
+        for k, idx in enumerate(pack):
+            length = lengths[idx]
+            end = offset + length
+            features['input_ids'][row, offset:end] = input_ids[idx, :length]
+            features['segment_ids'][row, offset:end] = segment_ids[idx, :length]
+            features['position_ids'][row, offset:end] = np.arange(length)
+            features['sequence_ids'][row, offset:end] = k + 1
+            # zeros pad masked_lm_positions, position 0 ([CLS]) is never masked
+            masked = masked_lm_positions[idx] != 0
+            n = int(masked.sum())
+            features['masked_lm_positions'][row, num_predictions:num_predictions + n] = \
+                masked_lm_positions[idx][masked] + offset
+            features['masked_lm_ids'][row, num_predictions:num_predictions + n] = masked_lm_ids[idx][masked]
+            features['next_sentence_positions'][row, k] = offset
+            features['next_sentence_labels'][row, k] = next_sentence_labels[idx]
+            num_predictions += n
+            offset = end
+
+    with h5py.File(output_file, 'w') as f:
+        for key, value in features.items():
+            f.create_dataset(key, data=value, dtype=value.dtype, compression=compression)
+
+    packed_tokens = int(lengths.sum())
+    return input_file, num_sequences, num_packs, packed_tokens / float(num_sequences * max_seq_length), \
+        packed_tokens / float(num_packs * max_seq_length)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Dir with the .hdf5 shards written by create_pretraining_data.py")
+    parser.add_argument("--output_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Dir the packed shards are written to, file names are kept")
+    parser.add_argument("--max_sequences_per_pack",
+                        default=3,
+                        type=int,
+                        help="Maximum number of sequences packed into one row")
+    parser.add_argument("--n_processes",
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of shards packed in parallel")
+    parser.add_argument('--no_compression',
+                        action='store_true',
+                        default=False,
+                        help="Write uncompressed contiguous datasets that can be memory mapped during pretraining")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    input_files = sorted(f for f in os.listdir(args.input_dir)
+                         if os.path.isfile(os.path.join(args.input_dir, f)) and f.endswith('.hdf5'))
+    compression = None if args.no_compression else 'gzip'
+
+    with ProcessPoolExecutor(args.n_processes) as pool:
+        futures = [pool.submit(pack_file,
+                               os.path.join(args.input_dir, f),
+                               os.path.join(args.output_dir, f),
+                               args.max_sequences_per_pack,
+                               compression)
+                   for f in input_files]
+        for future in futures:
+            input_file, num_sequences, num_packs, fill_before, fill_after = future.result()
+            print("{}: {} sequences -> {} rows, non padding tokens {:.1%} -> {:.1%}".format(
+                input_file, num_sequences, num_packs, fill_before, fill_after))
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,7 @@ from sklearn.metrics import matthews_corrcoef, f1_score
 from utils import (is_main_process, mkdir_by_main_process, format_step,
                    get_world_size)
 from processors.glue import PROCESSORS, convert_examples_to_features
+from bucketing import LengthBucketBatchSampler, TrimPadding, num_optimization_steps, sequence_lengths
 
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
@@ -292,6 +293,16 @@ def parse_args(parser=argparse.ArgumentParser()):
                         default=False,
                         action='store_true',
                         help="Whether to save checkpoints")
+    parser.add_argument('--length_bucketing',
+                        default=False,
+                        action='store_true',
+                        help="Batch sequences of similar length and trim "
+                        "every batch to its longest sequence")
+    parser.add_argument('--max_tokens_per_batch',
+                        default=None,
+                        type=int,
+                        help="With --length_bucketing, also limit batches to "
+                        "this many (padded) tokens")
     return parser.parse_args()
 
 
@@ -533,12 +544,44 @@ def main(args):
             tokenizer,
             processor,
         )
-        num_train_optimization_steps = int(
-            len(train_features) / args.train_batch_size /
-            args.gradient_accumulation_steps) * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = (num_train_optimization_steps //
-                                            torch.distributed.get_world_size())
+        train_data = gen_tensor_dataset(train_features)
+        if args.length_bucketing:
+            train_sampler = LengthBucketBatchSampler(
+                sequence_lengths(train_data.tensors[1]),
+                args.train_batch_size,
+                max_tokens=args.max_tokens_per_batch,
+                seed=args.seed,
+            )
+            train_dataloader = DataLoader(
+                train_data,
+                sampler=train_sampler,
+                batch_size=None,
+                collate_fn=TrimPadding(),
+            )
+            # the token budget decides the number of batches, already split
+            # over the ranks
+            num_train_optimization_steps = num_optimization_steps(
+                train_sampler,
+                int(args.num_train_epochs),
+                args.gradient_accumulation_steps,
+            )
+        else:
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(
+                train_data,
+                sampler=train_sampler,
+                batch_size=args.train_batch_size,
+            )
+            num_train_optimization_steps = int(
+                len(train_features) / args.train_batch_size /
+                args.gradient_accumulation_steps) * args.num_train_epochs
+            if args.local_rank != -1:
+                num_train_optimization_steps = (
+                    num_train_optimization_steps //
+                    torch.distributed.get_world_size())
 
     # Prepare model
     config = modeling.BertConfig.from_json_file(args.config_file)
@@ -552,8 +595,10 @@ def main(args):
         num_labels=num_labels,
     )
     logger.info("USING CHECKPOINT from {}".format(args.init_checkpoint))
+    # on the device first, memory mapped weights are then copied to it without a host copy
+    model.to(device)
     model.load_state_dict(
-        torch.load(args.init_checkpoint, map_location='cpu')["model"],
+        modeling.load_checkpoint_state_dict(args.init_checkpoint),
         strict=False,
     )
     logger.info("USED CHECKPOINT from {}".format(args.init_checkpoint))
@@ -565,7 +610,6 @@ def main(args):
         },
     )
 
-    model.to(device)
     # Prepare optimizer
     model, optimizer, scheduler = init_optimizer_and_amp(
         model,
@@ -595,16 +639,6 @@ def main(args):
         logger.info("  Num examples = %d", len(train_features))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        train_data = gen_tensor_dataset(train_features)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(
-            train_data,
-            sampler=train_sampler,
-            batch_size=args.train_batch_size,
-        )
 
         global_step = 0
         nb_tr_steps = 0
@@ -613,7 +647,9 @@ def main(args):
         nb_tr_examples = 0
         model.train()
         tic_train = time.perf_counter()
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            if args.length_bucketing:
+                train_sampler.set_epoch(epoch)
             tr_loss, nb_tr_steps = 0, 0
             for step, batch in enumerate(
                     tqdm(train_dataloader, desc="Iteration")):
@@ -690,12 +726,30 @@ def main(args):
         logger.info("  Batch size = %d", args.eval_batch_size)
         eval_data = gen_tensor_dataset(eval_features)
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(
-            eval_data,
-            sampler=eval_sampler,
-            batch_size=args.eval_batch_size,
-        )
+        if args.length_bucketing:
+            # batches in length order, predictions are put back in the
+            # order of the examples after the loop
+            eval_sampler = LengthBucketBatchSampler(
+                sequence_lengths(eval_data.tensors[1]),
+                args.eval_batch_size,
+                max_tokens=args.max_tokens_per_batch,
+                shuffle=False,
+                num_replicas=1,
+                rank=0,
+            )
+            eval_dataloader = DataLoader(
+                eval_data,
+                sampler=eval_sampler,
+                batch_size=None,
+                collate_fn=TrimPadding(),
+            )
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(
+                eval_data,
+                sampler=eval_sampler,
+                batch_size=args.eval_batch_size,
+            )
 
         model.eval()
         preds = None
@@ -737,6 +791,10 @@ def main(args):
                     axis=0,
                 )
         torch.cuda.synchronize()
+        if args.length_bucketing:
+            inverse_order = np.argsort(np.concatenate(list(eval_sampler)))
+            preds = preds[inverse_order]
+            out_label_ids = out_label_ids[inverse_order]
         eval_latencies = [
             event_start.elapsed_time(event_end)
             for event_start, event_end in cuda_events
@@ -20,7 +20,9 @@ from __future__ import division
 from __future__ import print_function
 
 # ==================
+import collections
 import csv
+import itertools
 import os
 import time
 import argparse
@@ -30,10 +32,11 @@ from tqdm import tqdm, trange
 import os
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Dataset
+from torch.utils.data import DataLoader, SequentialSampler, Dataset, Sampler
 from torch.utils.data.distributed import DistributedSampler
 import math
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 from tokenization import BertTokenizer
 import modeling
@@ -48,7 +51,6 @@ from schedulers import LinearWarmUpScheduler
 from automl.autoscaler import AdaScale
 from torch.utils.tensorboard import SummaryWriter
 import dllogger
-from concurrent.futures import ProcessPoolExecutor
 
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
@@ -81,60 +83,431 @@ class WorkerInitObj(object):
         random.seed(self.seed + id)
 
 
-def create_pretraining_dataset(input_file, max_pred_length, shared_list, args,
-                               worker_init):
-    train_data = pretraining_dataset(input_file=input_file,
-                                     max_pred_length=max_pred_length)
-    train_sampler = RandomSampler(train_data)
-    train_dataloader = DataLoader(train_data,
-                                  sampler=train_sampler,
-                                  batch_size=args.train_batch_size * args.n_gpu,
-                                  num_workers=4,
-                                  worker_init_fn=worker_init,
-                                  pin_memory=True)
-    return train_dataloader, input_file
+class ShardSwitchTimer(object):
+    """
+    Measures the shard switch latency that the data loader did not hide.
+
+    ``batches`` yields the batches of a loader and sums up in ``blocked_time``
+    the time spent waiting for the batches that read the first samples of a
+    shard (see ``StreamBatchSampler.shard_starts``).
+    """
+
+    def __init__(self):
+        self.blocked_time = 0.0
+        self.num_switches = 0
+
+    def batches(self, train_dataloader, shard_starts):
+        iterator = iter(train_dataloader)
+        for i in itertools.count():
+            start = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            if i in shard_starts:
+                self.blocked_time += time.time() - start
+                self.num_switches += 1
+            yield batch
+
+
+def shard_seed(seed, epoch, file_index, rank):
+    """Seed of the sample order within a shard, see ``PretrainingStream``"""
+    return (seed + 1000003 * epoch + 1009 * file_index + rank) % 2 ** 32
+
+
+def count_samples(files, counts):
+    """
+    Number of samples of every file, remembered in ``counts``. Only rank 0 opens
+    the files not counted yet and broadcasts their counts, so that startup does
+    not open every shard on every rank.
+    """
+    missing = sorted(set(files) - set(counts))
+    if missing:
+        new_counts = {}
+        if get_rank() == 0:
+            for input_file in missing:
+                with h5py.File(input_file, "r") as f:
+                    new_counts[input_file] = len(f['input_ids'])
+        if get_world_size() > 1:
+            payload = [new_counts]
+            torch.distributed.broadcast_object_list(payload, src=0)
+            new_counts = payload[0]
+        counts.update(new_counts)
+    return [counts[input_file] for input_file in files]
+
+
+def files_in_segments(offsets, segments):
+    """Indices of the files that the stream positions in ``segments`` fall into, in reading order"""
+    file_indices = []
+    for start, end in segments:
+        first = np.searchsorted(offsets, start, side='right') - 1
+        last = np.searchsorted(offsets, end - 1, side='right') - 1
+        for file_index in range(int(first), int(last) + 1):
+            if not file_indices or file_indices[-1] != file_index:
+                file_indices.append(file_index)
+    return file_indices
+
+
+def partition_segments(segments, num_parts):
+    """
+    Splits the stream positions covered by ``segments`` (ordered [start, end)
+    pairs) into ``num_parts`` contiguous parts of equal length, each a list of
+    segments. The remainder of the division is dropped, so that every rank
+    runs the same number of steps.
+    """
+    part_length = sum(end - start for start, end in segments) // num_parts
+    parts = [[] for _ in range(num_parts)]
+    part = 0
+    needed = part_length
+    for start, end in segments:
+        while start < end and part < num_parts:
+            take = min(needed, end - start)
+            if take > 0:
+                parts[part].append([start, start + take])
+            start += take
+            needed -= take
+            if needed == 0:
+                part += 1
+                needed = part_length
+    return parts
+
+
+def consume_segments(parts, consumed):
+    """Segments left once every part of ``partition_segments`` had its first ``consumed`` positions read"""
+    remaining = []
+    for part in parts:
+        skip = consumed
+        for start, end in part:
+            skipped = min(skip, end - start)
+            skip -= skipped
+            if start + skipped < end:
+                remaining.append([start + skipped, end])
+    return remaining
+
+
+class PretrainingStream(Dataset):
+    """
+    All shards of an epoch as one stream of samples.
+
+    Position ``p`` of the stream is sample ``p - offsets[i]`` of the shard ``i``
+    it falls into, with the samples of every shard in a random order that only
+    depends on ``seed``, ``epoch`` and the shard. Ranks read contiguous ranges
+    of positions (see ``partition_segments``), so a rank reads mostly from one
+    shard at a time while the ranks together cover every sample once, however
+    many files and ranks there are.
+
+    Indexed with a list of positions. A batch that crosses the end of a shard
+    is read from both. Every worker keeps the two most recent shards open.
+    When a worker opens a shard, a background thread warms up the next shard
+    the worker reads (the next one in ``segments``, the positions of this
+    rank): the file is read ahead into the page cache, opened, its sample
+    order computed and its first batch read, so that the switch to it does
+    not wait for any of this.
+    """
+
+    def __init__(self, files, num_samples, epoch, args, rank=0, segments=None):
+        self.files = files
+        self.offsets = np.concatenate([[0], np.cumsum(num_samples)]).astype(np.int64)
+        self.epoch = epoch
+        self.seed = args.seed
+        self.rank = rank
+        self.max_pred_length = args.max_predictions_per_seq
+        self.dense_mlm_labels = args.dense_mlm_head
+        self.warmup_rows = args.train_batch_size * args.n_gpu
+        if segments is None:
+            segments = [[0, len(self)]]
+        read_order = files_in_segments(self.offsets, segments)
+        self._next_file = dict(zip(read_order[:-1], read_order[1:]))
+        self._shards = collections.OrderedDict()
+        self._pending = {}
+        self._warmup = None
+
+    def __getstate__(self):
+        # every worker process warms up its own shards
+        state = self.__dict__.copy()
+        state['_shards'] = collections.OrderedDict()
+        state['_pending'] = {}
+        state['_warmup'] = None
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _load(self, file_index):
+        """Opens shard ``file_index``, returns its dataset and sample order"""
+        dataset = pretraining_dataset(input_file=self.files[file_index],
+                                      max_pred_length=self.max_pred_length,
+                                      dense_mlm_labels=self.dense_mlm_labels)
+        dataset.prefetch()
+        seed = shard_seed(self.seed, self.epoch, file_index, self.rank)
+        order = np.random.RandomState(seed).permutation(len(dataset))
+        if len(order) > 0:
+            # opens the file and pulls the first rows into the page cache and the chunk cache
+            dataset.read(np.sort(order[:self.warmup_rows]))
+        return dataset, order
+
+    def _shard(self, file_index):
+        """The dataset of shard ``file_index`` and its sample order"""
+        if file_index not in self._shards:
+            pending = self._pending.pop(file_index, None)
+            self._shards[file_index] = pending.result() if pending is not None else self._load(file_index)
+            while len(self._shards) > 2:
+                self._shards.popitem(last=False)
+            next_index = self._next_file.get(file_index)
+            if next_index is not None and next_index not in self._shards and next_index not in self._pending:
+                if self._warmup is None:
+                    self._warmup = ThreadPoolExecutor(max_workers=1)
+                self._pending[next_index] = self._warmup.submit(self._load, next_index)
+        return self._shards[file_index]
+
+    def __getitem__(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        file_indices = np.searchsorted(self.offsets, positions, side='right') - 1
+        batches = []
+        for file_index in np.unique(file_indices):
+            dataset, order = self._shard(int(file_index))
+            selected = file_indices == file_index
+            batches.append(dataset.get_batch(order[positions[selected] - self.offsets[file_index]]))
+        if len(batches) == 1:
+            return batches[0]
+        return {name: torch.cat([batch[name] for batch in batches]) for name in batches[0]}
+
+
+class StreamBatchSampler(Sampler):
+    """
+    Consecutive batches of the stream positions in ``segments``, skipping the
+    first ``start`` positions. A last partial batch is dropped.
+    """
+
+    def __init__(self, segments, batch_size, start=0):
+        self.segments = segments
+        self.batch_size = batch_size
+        self.start = start
+
+    def __iter__(self):
+        skip = self.start
+        batch = []
+        for start, end in self.segments:
+            skipped = min(skip, end - start)
+            skip -= skipped
+            start += skipped
+            while start < end:
+                take = min(self.batch_size - len(batch), end - start)
+                batch.extend(range(start, start + take))
+                start += take
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+
+    def __len__(self):
+        num_positions = sum(end - start for start, end in self.segments)
+        return max(num_positions - self.start, 0) // self.batch_size
+
+    def shard_starts(self, offsets):
+        """Numbers of the batches that read the first position of a shard in ``segments``, and the first batch"""
+        starts = {0}
+        read = -self.start
+        for start, end in self.segments:
+            first = np.searchsorted(offsets, start, side='right') - 1
+            last = np.searchsorted(offsets, end - 1, side='right') - 1
+            for file_index in range(first, last + 1):
+                position = read + max(start, offsets[file_index]) - start
+                if position >= 0:
+                    starts.add(int(position) // self.batch_size)
+            read += end - start
+        return starts
+
+
+def create_pretraining_dataloader(train_data, batch_sampler, args, worker_init):
+    """
+    Whole batches of stream positions are handed to the dataset, which reads
+    them with one fancy-indexed read per shard and builds the batch vectorised,
+    so the loader does not collate per sample and needs only a few workers.
+    """
+    return DataLoader(train_data,
+                      sampler=batch_sampler,
+                      batch_size=None,
+                      num_workers=args.num_data_workers,
+                      worker_init_fn=worker_init,
+                      pin_memory=True)
+
+
+PRETRAINING_KEYS = [
+    'input_ids', 'input_mask', 'segment_ids', 'masked_lm_positions',
+    'masked_lm_ids', 'next_sentence_labels'
+]
+
+# shards written by pack_pretraining_data.py, several sequences per row
+PACKED_PRETRAINING_KEYS = [
+    'input_ids', 'sequence_ids', 'segment_ids', 'masked_lm_positions',
+    'masked_lm_ids', 'next_sentence_labels', 'position_ids', 'next_sentence_positions'
+]
+
+
+def open_pretraining_array(input_file, dataset):
+    """
+    Returns an np.memmap over ``dataset`` if it is stored contiguous and uncompressed
+    (see ``create_pretraining_data.py --no_compression``), else the h5py dataset itself.
+    """
+    if dataset.chunks is None and dataset.compression is None:
+        offset = dataset.id.get_offset()
+        # offset is None for datasets without allocated storage (empty shards)
+        if offset is not None:
+            return np.memmap(input_file, dtype=dataset.dtype, mode='r',
+                             offset=offset, shape=dataset.shape)
+    return dataset
+
+
+def prefetch_file(input_file):
+    """Hint the OS to read ``input_file`` ahead into the page cache, a no-op where unsupported"""
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(input_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
 
 
 class pretraining_dataset(Dataset):
-    def __init__(self, input_file, max_pred_length):
+    """
+    Lazily opened HDF5 shard.
+
+    Only the number of samples is read on construction, so the dataset is cheap
+    to pickle into DataLoader workers.
+    Every process opens the file on first access and reads rows on demand,
+    contiguous uncompressed shards are memory mapped so all workers of a node
+    share the page cache instead of holding private copies of the shard.
+    """
+    # h5py chunk cache per open file, gzip chunks are decompressed once and
+    # then served from here for neighbouring rows
+    chunk_cache_bytes = 64 * 1024 * 1024
+
+    def __init__(self, input_file, max_pred_length, dense_mlm_labels=False):
         self.input_file = input_file
         self.max_pred_length = max_pred_length
-        f = h5py.File(input_file, "r")
-        keys = [
-            'input_ids', 'input_mask', 'segment_ids', 'masked_lm_positions',
-            'masked_lm_ids', 'next_sentence_labels'
-        ]
-        self.inputs = [np.asarray(f[key][:]) for key in keys]
-        f.close()
+        self.dense_mlm_labels = dense_mlm_labels
+        with h5py.File(input_file, "r") as f:
+            self.num_samples = len(f['input_ids'])
+            self.packed = 'sequence_ids' in f
+        self._file = None
+        self._arrays = None
+        self._pid = None
+
+    def __getstate__(self):
+        # open handles are not shared across processes, each one reopens
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_arrays'] = None
+        state['_pid'] = None
+        return state
+
+    def _open(self):
+        if self._arrays is None or self._pid != os.getpid():
+            self._file = h5py.File(self.input_file, "r", rdcc_nbytes=self.chunk_cache_bytes)
+            keys = PACKED_PRETRAINING_KEYS if self.packed else PRETRAINING_KEYS
+            self._arrays = [open_pretraining_array(self.input_file, self._file[key])
+                            for key in keys]
+            self._pid = os.getpid()
+        return self._arrays
+
+    def prefetch(self):
+        """Hint the OS to read the whole shard ahead, a no-op where unsupported"""
+        prefetch_file(self.input_file)
+
+    def read(self, indices):
+        """
+        Rows ``indices`` of every array (in the order given) as numpy arrays.
+
+        Indices are sorted and split into runs of consecutive rows, every run is
+        read with a single slice.
+        """
+        arrays = self._open()
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(indices, kind='stable')
+        sorted_indices = indices[order]
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        breaks = np.flatnonzero(np.diff(sorted_indices) != 1) + 1
+        starts = np.concatenate([[0], breaks])
+        ends = np.concatenate([breaks, [len(sorted_indices)]])
+        rows = []
+        for array in arrays:
+            if isinstance(array, np.ndarray):
+                rows.append(array[sorted_indices][inverse])
+            else:
+                runs = [array[sorted_indices[s]:sorted_indices[e - 1] + 1] for s, e in zip(starts, ends)]
+                rows.append(np.concatenate(runs)[inverse])
+        return rows
 
     def __len__(self):
         'Denotes the total number of samples'
-        return len(self.inputs[0])
+        return self.num_samples
 
     def __getitem__(self, index):
+        if np.ndim(index) == 0:
+            return {name: t[0] for name, t in self.get_batch([index]).items()}
+        return self.get_batch(index)
+
+    def get_batch(self, indices):
+        """
+        Dict of input_ids, segment_ids, input_mask, masked_lm_labels and next_sentence_labels.
+
+        masked_lm_labels are [batch_size, max_pred_length] labels of the tokens at
+        masked_lm_positions (also returned) and -1 on padding, so that the MLM head
+        only runs on masked tokens. With dense_mlm_labels they are [batch_size, seq_length]
+        with -1 on every unmasked token instead.
+
+        For packed shards input_mask holds the sequence ids of the tokens, position_ids and
+        next_sentence_positions are added and next_sentence_labels is [batch_size, sequences_per_pack]
+        with -1 for absent sequences.
+        """
+        keys = PACKED_PRETRAINING_KEYS if self.packed else PRETRAINING_KEYS
+        arrays = dict(zip(keys, [np.asarray(input, dtype=np.int64) for input in self.read(indices)]))
+        input_ids = arrays['input_ids']
+        masked_lm_positions = arrays.pop('masked_lm_positions')
+        masked_lm_ids = arrays.pop('masked_lm_ids')
+
+        # position 0 ([CLS]) is never masked, zeros pad masked_lm_positions up to max_pred_length
+        if self.dense_mlm_labels:
+            masked_lm_labels = np.full(input_ids.shape, -1, dtype=np.int64)
+            rows, cols = np.nonzero(masked_lm_positions)
+            masked_lm_labels[rows, masked_lm_positions[rows, cols]] = masked_lm_ids[rows, cols]
+        else:
+            masked_lm_labels = np.where(masked_lm_positions != 0, masked_lm_ids, -1)
+            arrays['masked_lm_positions'] = masked_lm_positions
+        arrays['masked_lm_labels'] = masked_lm_labels
+        arrays['input_mask'] = arrays.pop('sequence_ids', arrays.get('input_mask'))
+
+        return {name: torch.from_numpy(array) for name, array in arrays.items()}
+
+
+class DeferredScalars(object):
+    """
+    Reads logging-only scalars off the GPU without stalling the host.
+
+    ``push`` queues a non-blocking copy of the scalars into pinned memory and
+    records an event, ``ready`` returns the values (with whatever context was
+    pushed along) once their copy has completed. The host keeps dispatching
+    micro-batches in the meantime instead of waiting for the GPU to drain.
+    """
 
-        [
-            input_ids, input_mask, segment_ids, masked_lm_positions,
-            masked_lm_ids, next_sentence_labels
-        ] = [
-            torch.from_numpy(input[index].astype(np.int64)) if indice < 5 else
-            torch.from_numpy(np.asarray(input[index].astype(np.int64)))
-            for indice, input in enumerate(self.inputs)
-        ]
-
-        masked_lm_labels = torch.ones(input_ids.shape, dtype=torch.long) * -1
-        index = self.max_pred_length
-        # store number of  masked tokens in index
-        padded_mask_indices = (masked_lm_positions == 0).nonzero(
-            as_tuple=False)
-        if len(padded_mask_indices) != 0:
-            index = padded_mask_indices[0].item()
-        masked_lm_labels[masked_lm_positions[:index]] = masked_lm_ids[:index]
-
-        return [
-            input_ids, segment_ids, input_mask, masked_lm_labels,
-            next_sentence_labels
-        ]
+    def __init__(self):
+        self.pending = collections.deque()
+
+    def push(self, values, **context):
+        values = torch.stack([v.detach().float() for v in values])
+        host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+        host.copy_(values, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self.pending.append((host, event, context))
+
+    def ready(self, block=False):
+        """Values and context of the completed copies, in push order. ``block`` waits for all of them"""
+        while self.pending and (block or self.pending[0][1].query()):
+            host, event, context = self.pending.popleft()
+            event.synchronize()
+            yield host.tolist(), context
 
 
 class BertPretrainingCriterion(torch.nn.Module):
@@ -148,6 +521,8 @@ class BertPretrainingCriterion(torch.nn.Module):
         masked_lm_loss = self.loss_fn(
             prediction_scores.view(-1, self.vocab_size),
             masked_lm_labels.view(-1))
+        # packed rows have one score per sequence, [batch_size, sequences_per_pack, 2] with
+        # label -1 for absent sequences, which flattens like the unpacked [batch_size, 2]
         next_sentence_loss = self.loss_fn(seq_relationship_score.view(-1, 2),
                                           next_sentence_labels.view(-1))
         total_loss = masked_lm_loss + next_sentence_loss
@@ -355,6 +730,21 @@ def parse_arguments():
                         default=False,
                         action='store_true',
                         help="Whether to use gradient checkpointing")
+    parser.add_argument('--checkpoint_policy',
+                        default='chunks',
+                        choices=modeling.CHECKPOINT_POLICIES,
+                        help="What --checkpoint_activations recomputes: chunks of sqrt(num_layers) layers, "
+                             "the attention or the feed forward block of every layer, or every k-th layer")
+    parser.add_argument('--checkpoint_every',
+                        type=int,
+                        default=2,
+                        help="k of --checkpoint_policy every_k")
+    parser.add_argument('--activation_memory_budget',
+                        type=float,
+                        default=None,
+                        help="Activation memory per GPU in GB. If set, the checkpoint policy that recomputes "
+                             "the least while fitting into it is chosen, overriding --checkpoint_activations "
+                             "and --checkpoint_policy")
 
     # This should always be True for elastic training case
     parser.add_argument("--resume_from_checkpoint",
@@ -457,6 +847,16 @@ def parse_arguments():
                         action='store_true',
                         help='Each rank sees a different shuffle of full dataset - if enabled then sharding is not done')
 
+    parser.add_argument('--dense_mlm_head',
+                        default=False,
+                        action='store_true',
+                        help='Compute masked LM logits for every token instead of only the masked ones')
+
+    parser.add_argument('--num_data_workers',
+                        type=int,
+                        default=4,
+                        help='DataLoader workers per process, each one reads and builds whole batches')
+
 
     args = parser.parse_args()
     args.fp16 = args.fp16 or args.amp
@@ -621,7 +1021,16 @@ def prepare_model_and_optimizer(args, device):
         degree=args.lr_poly_power if args.use_adamw else 0.5,
         do_poly_warmup=True if args.use_adamw else False)
 
-    model.checkpoint_activations(args.checkpoint_activations)
+    if args.activation_memory_budget is not None:
+        policy, every = modeling.select_checkpoint_policy(config, args.train_batch_size, args.max_seq_length,
+                                                          args.activation_memory_budget * 2 ** 30,
+                                                          bytes_per_element=2 if args.fp16 else 4)
+        args.checkpoint_activations = policy is not None
+        if policy is not None:
+            args.checkpoint_policy, args.checkpoint_every = policy, every
+        if is_main_process():
+            dllogger.log(step="PARAMETER", data={"checkpoint_policy": policy, "checkpoint_every": every})
+    model.checkpoint_activations(args.checkpoint_activations, args.checkpoint_policy, args.checkpoint_every)
 
     ###############################################################################
     #TODO: Migrate checkpointing functionality to AutoScaler checkpoint State class
@@ -689,6 +1098,23 @@ def take_optimizer_step(args, scaler, optimizer, model, global_step):
     return global_step
 
 
+def list_training_files(args, epoch):
+    """Training shards of ``epoch`` in the order they are consumed, deterministic given the seed"""
+    files = [
+        os.path.join(args.input_dir, f)
+        for f in os.listdir(args.input_dir)
+        if os.path.isfile(os.path.join(args.input_dir, f))
+        and 'training' in f
+    ]
+    files.sort()
+    if args.sampling_with_replacement:
+        # different shuffle per rank per epoch (since we have multiple epochs for wiki+books)
+        random.Random(args.seed + epoch + get_rank()).shuffle(files)
+    else:
+        random.Random(args.seed + epoch).shuffle(files)
+    return files
+
+
 def main():
     global timeout_sent
 
@@ -720,237 +1146,250 @@ def main():
 
         model.train()
         most_recent_ckpts_paths = []
-        average_loss = 0.0  # averaged loss every args.log_freq steps
+        # summed on device and only reduced every args.log_freq steps, reading the
+        # loss every micro-batch would sync the host with the GPU each time
+        average_loss = torch.zeros((), dtype=torch.float32, device=device)
+        loss_logs = DeferredScalars()
+        phase = 2 if args.phase2 else 1
+
+        def log_losses(block=False):
+            for (average, step_loss), context in loss_logs.ready(block):
+                if is_main_process():
+                    dllogger.log(step=(context['epoch'], context['global_step'],),
+                        data={
+                            "average_loss": average,
+                            "step_loss": step_loss,
+                            "learning_rate": context['learning_rate'],
+                            "gain": context['gain'],
+                            "gns": context['gns'],
+                            "effective_lr": context['learning_rate'] * context['gain'],
+                            "scale_invariant_steps": context['adascale_step'],
+                            "shard_switch_blocked_time": context['shard_switch_blocked_time']
+                        })
+                    writer.add_scalar(f'Train{phase}/Loss', average, context['adascale_step'])
+                    writer.add_scalar(f'Train{phase}/ShardSwitchBlockedTime', context['shard_switch_blocked_time'],
+                                      context['adascale_step'])
+
         epoch = 0
         training_steps = 0
         adascale_step = args.scale_invariant_steps
         accumulate_gradients = args.gradient_accumulation_steps > 1
 
-        pool = ProcessPoolExecutor(1)
+        shards = ShardSwitchTimer()
+        sample_counts = {}
+        # samples every rank reads per micro-batch
+        batch_size = args.train_batch_size * args.n_gpu
 
         # Note: We loop infinitely over epochs, termination is handled via iteration count
         while True:
             thread = None
-            restored_data_loader = None
             if not args.resume_from_checkpoint or epoch > 0 or \
                     (args.phase2 and global_step < 1) or \
                     args.init_checkpoint:
-                files = [
-                    os.path.join(args.input_dir, f)
-                    for f in os.listdir(args.input_dir)
-                    if os.path.isfile(os.path.join(args.input_dir, f))
-                    and 'training' in f
-                ]
-                files.sort()
-                num_files = len(files)
-                if args.sampling_with_replacement:
-                    # different shuffle per rank per epoch (since we have multiple epochs for wiki+books)
-                    random.Random(args.seed + epoch + get_rank()).shuffle(files)
-                else:
-                    random.Random(args.seed + epoch).shuffle(files)
-                f_start_id = 0
+                files = list_training_files(args, epoch)
+                num_samples = count_samples(files, sample_counts)
+                segments = [[0, sum(num_samples)]]
             else:
-                f_start_id = checkpoint['files'][0]
-                files = checkpoint['files'][1:]
+                # continue at the data position of the checkpoint, the file order and
+                # the sample order within the files are recomputed from the seed
                 args.resume_from_checkpoint = False
-                num_files = len(files)
-                # may not exist in all checkpoints
-                epoch = checkpoint.get('epoch', 0)
-                restored_data_loader = checkpoint.get('data_loader', None)
-                # if sampling with replacement shuffle files so that workers start from different points
-                random.Random(args.seed + epoch + get_rank()).shuffle(files)
-
-            shared_file_list = {}
-
-            if torch.distributed.is_initialized() and get_world_size() > num_files:
-                remainder = get_world_size() % num_files
-                data_file = files[(f_start_id * get_world_size() + get_rank() + remainder * f_start_id) % num_files]
-            elif args.sampling_with_replacement:
-                data_file = files[f_start_id]
-                print("worker", get_rank(), data_file)
-            else:
-                data_file = files[(f_start_id * get_world_size() + get_rank()) % num_files]
-
-            previous_file = data_file
-
-            if restored_data_loader is None:
-                train_data = pretraining_dataset(data_file, args.max_predictions_per_seq)
-                train_sampler = RandomSampler(train_data)
-                train_dataloader = DataLoader(train_data,
-                                    sampler=train_sampler,
-                                    batch_size=args.train_batch_size * args.n_gpu,
-                                    num_workers=12,
-                                    worker_init_fn=worker_init,
-                                    pin_memory=True)
-                # shared_file_list["0"] = (train_dataloader, data_file)
-            else:
-                train_dataloader = restored_data_loader
-                restored_data_loader = None
-
-            for f_id in range(f_start_id + 1, len(files)):
-
-                if get_world_size() > num_files:
-                    data_file = files[(f_id * get_world_size() + get_rank() + remainder * f_id) % num_files]
+                position = checkpoint.get('data_position')
+                if position is not None:
+                    args.seed = position['seed']
+                    epoch = position['epoch']
                 else:
-                    data_file = files[(f_id * get_world_size() + get_rank()) % num_files]
-
-                # overwrite data file to look at current index
-                if args.sampling_with_replacement:
-                    data_file = files[f_id]
-                print("inside loop worker", get_rank(), data_file)
-
-                previous_file = data_file
-
-                dataset_future = pool.submit(create_pretraining_dataset,
-                                             data_file,
-                                             args.max_predictions_per_seq,
-                                             shared_file_list, args,
-                                             worker_init)
-
-                train_iter = tqdm(train_dataloader, desc="Iteration", disable=args.disable_progress_bar) \
-                        if is_main_process() else train_dataloader
-
-                if raw_train_start is None:
-                    raw_train_start = time.time()
-
-                for step, batch in enumerate(train_iter):  # produce batch per gpu
-                    training_steps += 1
-                    is_last_accumulation_step = training_steps % args.gradient_accumulation_steps == 0
-                    batch = [t.to(device) for t in batch]
-                    input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels = batch
-                    with torch.cuda.amp.autocast(enabled=args.fp16):
-                        if not is_last_accumulation_step:
-                            with model.no_sync():
-                                prediction_scores, seq_relationship_score = model(input_ids=input_ids,
-                                                                                token_type_ids=segment_ids,
-                                                                                attention_mask=input_mask)
-                                loss = criterion(prediction_scores,
-                                                 seq_relationship_score,
-                                                 masked_lm_labels,
-                                                 next_sentence_labels)
-                        else:
+                    # may not exist in all checkpoints
+                    epoch = checkpoint.get('epoch', 0)
+                files = list_training_files(args, epoch)
+                num_samples = count_samples(files, sample_counts)
+                if position is not None and 'segments' in position:
+                    if sorted(files) != sorted(position['files']):
+                        print("WARNING: training files changed since the checkpoint, the data position is approximate")
+                    # what the ranks of the checkpointed run had left to read, it is split
+                    # again below over the ranks of this run, however many there are now
+                    segments = consume_segments(partition_segments(position['segments'], position['num_parts']),
+                                                position['samples_consumed'])
+                else:
+                    # older checkpoints only record the shard, restart at its beginning
+                    file_index = position['file_index'] if position is not None else checkpoint['files'][0]
+                    segments = [[sum(num_samples[:file_index]), sum(num_samples)]]
+
+            # the ranks split the samples left in the epoch into contiguous ranges of equal
+            # length, with sampling with replacement every rank reads its own stream instead
+            if args.sampling_with_replacement:
+                num_parts, part, stream_rank = 1, 0, get_rank()
+            else:
+                num_parts, part, stream_rank = get_world_size(), get_rank(), 0
+            rank_segments = partition_segments(segments, num_parts)[part]
+            train_data = PretrainingStream(files, num_samples, epoch, args, rank=stream_rank,
+                                           segments=rank_segments)
+            batch_sampler = StreamBatchSampler(rank_segments, batch_size)
+            train_dataloader = create_pretraining_dataloader(train_data, batch_sampler, args, worker_init)
+            print("worker", get_rank(), "reads", len(batch_sampler), "batches from", len(files), "files")
+
+            train_iter = shards.batches(train_dataloader, batch_sampler.shard_starts(train_data.offsets))
+            if is_main_process():
+                train_iter = tqdm(train_iter, total=len(batch_sampler), desc="Iteration",
+                                  disable=args.disable_progress_bar)
+
+            if raw_train_start is None:
+                raw_train_start = time.time()
+
+            for step, batch in enumerate(train_iter):  # produce batch per gpu
+                training_steps += 1
+                is_last_accumulation_step = training_steps % args.gradient_accumulation_steps == 0
+                batch = {name: t.to(device) for name, t in batch.items()}
+                input_ids = batch['input_ids']
+                segment_ids = batch['segment_ids']
+                input_mask = batch['input_mask']
+                masked_lm_labels = batch['masked_lm_labels']
+                next_sentence_labels = batch['next_sentence_labels']
+                # gather masked tokens before the MLM head unless --dense_mlm_head
+                masked_lm_positions = batch.get('masked_lm_positions')
+                position_ids = batch.get('position_ids')
+                next_sentence_positions = batch.get('next_sentence_positions')
+                if position_ids is not None:
+                    # packed shard, input_mask holds the sequence id of every token
+                    input_mask = modeling.packed_attention_mask(input_mask)
+                with torch.cuda.amp.autocast(enabled=args.fp16):
+                    if not is_last_accumulation_step:
+                        with model.no_sync():
                             prediction_scores, seq_relationship_score = model(input_ids=input_ids,
                                                                             token_type_ids=segment_ids,
-                                                                            attention_mask=input_mask)
+                                                                            attention_mask=input_mask,
+                                                                            position_ids=position_ids,
+                                                                            next_sentence_positions=next_sentence_positions,
+                                                                            masked_lm_positions=masked_lm_positions)
                             loss = criterion(prediction_scores,
                                              seq_relationship_score,
                                              masked_lm_labels,
                                              next_sentence_labels)
-                        if args.n_gpu > 1:
-                            loss = loss.mean()  # DataParallel case
-
-                    divisor = args.gradient_accumulation_steps
-                    if accumulate_gradients:
-                        if not args.allreduce_post_accumulation:
-                            # this division was merged into predivision
-                            loss = loss / args.gradient_accumulation_steps
-                            divisor = 1.0
-                    if accumulate_gradients and not is_last_accumulation_step:
-                        with model.no_sync():
-                            # for this to work correctly ensure that loss calc is in similar context
-                            scaler.scale(loss).backward()
                     else:
+                        prediction_scores, seq_relationship_score = model(input_ids=input_ids,
+                                                                        token_type_ids=segment_ids,
+                                                                        attention_mask=input_mask,
+                                                                        position_ids=position_ids,
+                                                                        next_sentence_positions=next_sentence_positions,
+                                                                        masked_lm_positions=masked_lm_positions)
+                        loss = criterion(prediction_scores,
+                                         seq_relationship_score,
+                                         masked_lm_labels,
+                                         next_sentence_labels)
+                    if args.n_gpu > 1:
+                        loss = loss.mean()  # DataParallel case
+
+                divisor = args.gradient_accumulation_steps
+                if accumulate_gradients:
+                    if not args.allreduce_post_accumulation:
+                        # this division was merged into predivision
+                        loss = loss / args.gradient_accumulation_steps
+                        divisor = 1.0
+                if accumulate_gradients and not is_last_accumulation_step:
+                    with model.no_sync():
+                        # for this to work correctly ensure that loss calc is in similar context
                         scaler.scale(loss).backward()
-                    average_loss += loss.item()
-
-                    # take one optimizer step for gradient accumulation steps
-                    if training_steps % args.gradient_accumulation_steps == 0:
-                        if args.enable_autoscaler:
-                            scheduler_progress = optimizer.get_step_increment()
-                            adascale_step += scheduler_progress
-                            lr_scheduler.step(step_increment=scheduler_progress)
-                        else:
-                            lr_scheduler.step()
-                        global_step = take_optimizer_step(args, scaler, optimizer, model, global_step)
-
-                    learning_rate = optimizer.param_groups[0]['lr']
-                    if adascale_step >= args.steps_this_run or timeout_sent:
-                        train_time_raw = time.time() - raw_train_start
-                        last_num_steps = int(training_steps / args.gradient_accumulation_steps) % args.log_freq
-                        last_num_steps = args.log_freq if last_num_steps == 0 else last_num_steps
-                        average_loss = torch.tensor(average_loss, dtype=torch.float32).cuda()
-                        average_loss = average_loss / (last_num_steps * divisor)
-                        if (torch.distributed.is_initialized()):
-                            average_loss /= get_world_size()
-                            torch.distributed.all_reduce(average_loss)
-                        final_loss = average_loss.item()
-                        if is_main_process():
-                            dllogger.log(step=(epoch, global_step,), data={"final_loss": final_loss})
-                        adascale_step += 1
-                    elif training_steps % (args.log_freq * args.gradient_accumulation_steps) == 0:
-                        average_loss /= (args.log_freq * divisor)
+                else:
+                    scaler.scale(loss).backward()
+                average_loss += loss.detach().float()
+
+                # take one optimizer step for gradient accumulation steps
+                if training_steps % args.gradient_accumulation_steps == 0:
+                    if args.enable_autoscaler:
+                        scheduler_progress = optimizer.get_step_increment()
+                        adascale_step += scheduler_progress
+                        lr_scheduler.step(step_increment=scheduler_progress)
+                    else:
+                        lr_scheduler.step()
+                    global_step = take_optimizer_step(args, scaler, optimizer, model, global_step)
+
+                learning_rate = optimizer.param_groups[0]['lr']
+                if adascale_step >= args.steps_this_run or timeout_sent:
+                    train_time_raw = time.time() - raw_train_start
+                    last_num_steps = int(training_steps / args.gradient_accumulation_steps) % args.log_freq
+                    last_num_steps = args.log_freq if last_num_steps == 0 else last_num_steps
+                    average_loss = average_loss / (last_num_steps * divisor)
+                    if (torch.distributed.is_initialized()):
+                        average_loss /= get_world_size()
+                        torch.distributed.all_reduce(average_loss)
+                    final_loss = average_loss.item()
+                    log_losses(block=True)
+                    if is_main_process():
+                        dllogger.log(step=(epoch, global_step,), data={"final_loss": final_loss})
+                    adascale_step += 1
+                elif training_steps % (args.log_freq * args.gradient_accumulation_steps) == 0:
+                    # gain and gns are computed on the host from the AdaScale state
+                    if args.enable_autoscaler:
+                        gain = optimizer.gain()
+                        gns = optimizer.gns()
+                    else:
+                        gain = 1.0
+                        gns = 0
+                        adascale_step = global_step
+
+                    # the all-reduce is queued on the GPU like the rest of the step,
+                    # the values are logged by log_losses once they reached the host
+                    log_loss = average_loss / (args.log_freq * divisor)
+                    if torch.distributed.is_initialized():
+                        log_loss /= get_world_size()
+                        torch.distributed.all_reduce(log_loss)
+                    loss_logs.push([log_loss, loss * args.gradient_accumulation_steps / divisor],
+                                   epoch=epoch, global_step=global_step, learning_rate=learning_rate,
+                                   gain=gain, gns=gns, adascale_step=adascale_step,
+                                   shard_switch_blocked_time=shards.blocked_time)
+                    if get_rank() == 0:
                         if args.enable_autoscaler:
-                            gain = optimizer.gain()
-                            gns = optimizer.gns()
+                            optimizer.log_to_tensorboard(adascale_step, phase)
+                        writer.flush()
+                    # pushing to S3 is a sync call at the moment and is very expensive so we reduce the frequency of push
+                    if training_steps % 10 == 0:
+                        # update the tensorboard log in s3 bucket
+                        res = upload_dir(f'{args.log_dir}/{args.label}', args.bucket, f'BERT/{args.label}')
+                        if not res:
+                            print("Failed to push to S3")
+                    # reset average loss for next print loop
+                    average_loss.zero_()
+                log_losses()
+                if adascale_step >= args.steps_this_run or \
+                        training_steps % (args.num_steps_per_checkpoint * args.gradient_accumulation_steps) == 0 or \
+                        timeout_sent:
+                    if is_main_process() and not args.skip_checkpoint:
+                        # Save a trained model
+                        dllogger.log(step="PARAMETER", data={"checkpoint_step": global_step})
+                        model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+                        if args.resume_step < 0 or not args.phase2:
+                            output_save_file = os.path.join(args.output_dir, f"ckpt_{global_step}.pt")
                         else:
-                            gain = 1.0
-                            gns = 0
-                            adascale_step = global_step
-
-                        if is_main_process():
-                            dllogger.log(step=(epoch, global_step,),
-                                data={
-                                    "average_loss": average_loss,
-                                    "step_loss": loss.item() * args.gradient_accumulation_steps / divisor,
-                                    "learning_rate": learning_rate,
-                                    "gain": gain,
-                                    "gns": gns,
-                                    "effective_lr": learning_rate * gain,
-                                    "scale_invariant_steps": adascale_step
-                                })
-                        # for all workers log tensorboard summary
-                        phase = 2 if args.phase2 else 1
-                        if get_rank() == 0:
-                            writer.add_scalar(f'Train{phase}/Loss', average_loss, adascale_step)
-                            if args.enable_autoscaler:
-                                optimizer.log_to_tensorboard(adascale_step, phase)
-                            writer.flush()
-                        # pushing to S3 is a sync call at the moment and is very expensive so we reduce the frequency of push
-                        if training_steps % 10 == 0:
-                            # update the tensorboard log in s3 bucket
-                            res = upload_dir(f'{args.log_dir}/{args.label}', args.bucket, f'BERT/{args.label}')
-                            if not res:
-                                print("Failed to push to S3")
-                        # reset average loss for next print loop
-                        average_loss = 0
-                    if adascale_step >= args.steps_this_run or \
-                            training_steps % (args.num_steps_per_checkpoint * args.gradient_accumulation_steps) == 0 or \
-                            timeout_sent:
-                        if is_main_process() and not args.skip_checkpoint:
-                            # Save a trained model
-                            dllogger.log(step="PARAMETER", data={"checkpoint_step": global_step})
-                            model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
-                            if args.resume_step < 0 or not args.phase2:
-                                output_save_file = os.path.join(args.output_dir, f"ckpt_{global_step}.pt")
-                            else:
-                                output_save_file = os.path.join(args.output_dir,f"ckpt_{global_step+args.phase1_end_step}.pt")
-                            if args.do_train:
-                                #TODO: Migrate to new ckpt class for AutoScaler
-                                torch.save({'model': model_to_save.state_dict(),
-                                            'optimizer': optimizer.state_dict(),
-                                            'scaler': scaler.state_dict(),
-                                            'files': [f_id] + files,
+                            output_save_file = os.path.join(args.output_dir,f"ckpt_{global_step+args.phase1_end_step}.pt")
+                        if args.do_train:
+                            #TODO: Migrate to new ckpt class for AutoScaler
+                            torch.save({'model': model_to_save.state_dict(),
+                                        'optimizer': optimizer.state_dict(),
+                                        'scaler': scaler.state_dict(),
+                                        'epoch': epoch,
+                                        # the same on every rank, all of them read batch_size samples per step
+                                        'data_position': {
                                             'epoch': epoch,
-                                            'data_loader': None if adascale_step >= args.max_steps else train_dataloader,
-                                            'phase': 2 if args.phase2 else 1, # using this to differentiate between phase1 and phase2 restarts
-                                            'phase1_end_step': args.phase1_end_step,}, output_save_file)
-
-                                most_recent_ckpts_paths.append(output_save_file)
-                                if len(most_recent_ckpts_paths) > 30:
-                                    ckpt_to_be_removed = most_recent_ckpts_paths.pop(0)
-                                    os.remove(ckpt_to_be_removed)
-
-                        # Exiting the training due to hitting max steps, or being sent a
-                        # timeout from the cluster scheduler
-                        if adascale_step > args.steps_this_run or timeout_sent:
-                            del train_dataloader
-                            writer.close()
-                            return args, final_loss, train_time_raw, global_step
-
-                del train_dataloader
-                # Make sure pool has finished and switch train_dataloader
-                # NOTE: Will block until complete
-                train_dataloader, data_file = dataset_future.result(timeout=None)
+                                            'seed': args.seed,
+                                            'files': files,
+                                            'segments': segments,
+                                            'num_parts': num_parts,
+                                            'samples_consumed': (step + 1) * batch_size,
+                                        },
+                                        'phase': 2 if args.phase2 else 1, # using this to differentiate between phase1 and phase2 restarts
+                                        'phase1_end_step': args.phase1_end_step,}, output_save_file)
+
+                            most_recent_ckpts_paths.append(output_save_file)
+                            if len(most_recent_ckpts_paths) > 30:
+                                ckpt_to_be_removed = most_recent_ckpts_paths.pop(0)
+                                os.remove(ckpt_to_be_removed)
+
+                    # Exiting the training due to hitting max steps, or being sent a
+                    # timeout from the cluster scheduler
+                    if adascale_step > args.steps_this_run or timeout_sent:
+                        del train_iter, train_dataloader
+                        writer.close()
+                        return args, final_loss, train_time_raw, global_step
+
             epoch += 1
     writer.close()
 
@@ -19,11 +19,14 @@ from __future__ import absolute_import, division, print_function
 
 import argparse
 import collections
+import hashlib
 import json
 import logging
 import math
+import multiprocessing
 import os
 import random
+import shutil
 import sys
 from io import open
 
@@ -41,16 +44,12 @@ import modeling
 from optimization import BertAdam, warmup_linear
 from tokenization import (BasicTokenizer, BertTokenizer, whitespace_tokenize)
 from utils import is_main_process, format_step
+from bucketing import LengthBucketBatchSampler, TrimPadding, num_optimization_steps, sequence_lengths
 import dllogger, time
 
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
 
-if sys.version_info[0] == 2:
-    import cPickle as pickle
-else:
-    import pickle
-
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -344,6 +343,162 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     return features
 
 
+# Per feature arrays written to (and memory mapped from) the feature cache
+FEATURE_ARRAYS = ('unique_ids', 'example_index', 'doc_span_index', 'input_ids', 'input_mask', 'segment_ids',
+                  'token_to_orig', 'token_is_max_context', 'start_positions', 'end_positions')
+
+
+def features_to_arrays(features, max_seq_length):
+    """Packs a list of `InputFeatures` into numpy arrays.
+
+    `tokens` are not stored, they are the vocab entries of the non padding
+    `input_ids`. `token_to_orig` is -1 for tokens without an original token.
+    """
+    num_features = len(features)
+    arrays = {
+        'unique_ids': np.zeros([num_features], dtype=np.int64),
+        'example_index': np.zeros([num_features], dtype=np.int32),
+        'doc_span_index': np.zeros([num_features], dtype=np.int32),
+        'input_ids': np.zeros([num_features, max_seq_length], dtype=np.int32),
+        'input_mask': np.zeros([num_features, max_seq_length], dtype=np.int8),
+        'segment_ids': np.zeros([num_features, max_seq_length], dtype=np.int8),
+        'token_to_orig': np.full([num_features, max_seq_length], -1, dtype=np.int32),
+        'token_is_max_context': np.zeros([num_features, max_seq_length], dtype=np.bool_),
+        'start_positions': np.zeros([num_features], dtype=np.int32),
+        'end_positions': np.zeros([num_features], dtype=np.int32),
+    }
+    for i, feature in enumerate(features):
+        arrays['unique_ids'][i] = feature.unique_id
+        arrays['example_index'][i] = feature.example_index
+        arrays['doc_span_index'][i] = feature.doc_span_index
+        arrays['input_ids'][i] = feature.input_ids
+        arrays['input_mask'][i] = feature.input_mask
+        arrays['segment_ids'][i] = feature.segment_ids
+        positions = list(feature.token_to_orig_map.keys())
+        arrays['token_to_orig'][i, positions] = list(feature.token_to_orig_map.values())
+        arrays['token_is_max_context'][i, positions] = [feature.token_is_max_context[p] for p in positions]
+        if feature.start_position is not None:
+            arrays['start_positions'][i] = feature.start_position
+            arrays['end_positions'][i] = feature.end_position
+    return arrays
+
+
+def arrays_to_features(arrays, tokenizer):
+    """Rebuilds the list of `InputFeatures` used for post-processing predictions."""
+    features = []
+    num_tokens = arrays['input_mask'].sum(axis=1)
+    for i in range(len(arrays['unique_ids'])):
+        input_ids = arrays['input_ids'][i]
+        token_to_orig = arrays['token_to_orig'][i]
+        positions = np.flatnonzero(token_to_orig >= 0).tolist()
+        is_max_context = arrays['token_is_max_context'][i, positions].tolist()
+        features.append(
+            InputFeatures(
+                unique_id=int(arrays['unique_ids'][i]),
+                example_index=int(arrays['example_index'][i]),
+                doc_span_index=int(arrays['doc_span_index'][i]),
+                tokens=tokenizer.convert_ids_to_tokens(input_ids[:num_tokens[i]].tolist()),
+                token_to_orig_map=dict(zip(positions, token_to_orig[positions].tolist())),
+                token_is_max_context=dict(zip(positions, is_max_context)),
+                input_ids=input_ids.tolist(),
+                input_mask=arrays['input_mask'][i].tolist(),
+                segment_ids=arrays['segment_ids'][i].tolist(),
+                start_position=int(arrays['start_positions'][i]),
+                end_position=int(arrays['end_positions'][i])))
+    return features
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _convert_chunk(task):
+    examples, max_seq_length, doc_stride, max_query_length, is_training = task
+    features = convert_examples_to_features(examples, _worker_tokenizer, max_seq_length,
+                                            doc_stride, max_query_length, is_training)
+    return features_to_arrays(features, max_seq_length)
+
+
+def convert_examples_to_arrays(examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training,
+                               n_processes=1, chunk_size=256):
+    """Same features as `convert_examples_to_features`, as arrays and converted on `n_processes` processes."""
+    tasks = [(examples[start:start + chunk_size], max_seq_length, doc_stride, max_query_length, is_training)
+             for start in range(0, len(examples), chunk_size)]
+    if n_processes > 1:
+        with multiprocessing.Pool(n_processes, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+            chunks = list(pool.imap(_convert_chunk, tasks))
+    else:
+        _init_worker(tokenizer)
+        chunks = [_convert_chunk(task) for task in tasks]
+
+    if not chunks:
+        return features_to_arrays([], max_seq_length)
+    # example indices and unique ids restart in every chunk
+    for k, chunk in enumerate(chunks):
+        chunk['example_index'] += k * chunk_size
+    arrays = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in FEATURE_ARRAYS}
+    arrays['unique_ids'] = 1000000000 + np.arange(len(arrays['unique_ids']), dtype=np.int64)
+    return arrays
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def features_cache_path(input_file, vocab_file, args, is_training, cache_dir=None):
+    """Cache dir for the features of `input_file`, keyed by everything the features depend on."""
+    key = hashlib.sha1()
+    key.update(_file_digest(input_file).encode())
+    key.update(_file_digest(vocab_file).encode())
+    key.update(str((args.max_seq_length, args.doc_stride, args.max_query_length, args.do_lower_case,
+                    args.version_2_with_negative, is_training)).encode())
+    cache_dir = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(input_file))
+    return os.path.join(cache_dir, '{}_features_{}'.format(os.path.basename(input_file), key.hexdigest()[:16]))
+
+
+def load_features_cache(path):
+    """Memory maps the arrays of a feature cache, None if it does not exist."""
+    if not os.path.isdir(path):
+        return None
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in FEATURE_ARRAYS}
+
+
+def save_features_cache(path, arrays):
+    # write into a temporary dir and rename it so that readers never see a partial cache
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in FEATURE_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # written concurrently by another process
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_or_convert_features(input_file, examples, tokenizer, args, is_training, write_cache=True):
+    """Feature arrays of `examples` read from `input_file`, from the cache if present."""
+    path = features_cache_path(input_file, args.vocab_file, args, is_training, args.cache_dir)
+    arrays = None if args.skip_cache else load_features_cache(path)
+    if arrays is not None:
+        dllogger.log(step="PARAMETER", data={"loaded_features_cache": path})
+        return arrays
+    arrays = convert_examples_to_arrays(examples, tokenizer, args.max_seq_length, args.doc_stride,
+                                        args.max_query_length, is_training, n_processes=args.n_processes)
+    if write_cache and not args.skip_cache:
+        dllogger.log(step="PARAMETER", data={"saved_features_cache": path})
+        save_features_cache(path, arrays)
+    return arrays
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
     """Returns tokenized answer spans that better match the annotated answer."""
@@ -422,24 +577,91 @@ RawResult = collections.namedtuple("RawResult",
                                    ["unique_id", "start_logits", "end_logits"])
 
 
-def get_answers(examples, features, results, args):
+_PrelimPrediction = collections.namedtuple(
+    "PrelimPrediction",
+    ["start_index", "end_index", "start_logit", "end_logit"])
+
+
+def batched_prelim_predictions(features, results, args, feature_arrays=None):
+    """
+    `get_valid_prelim_predictions` for all matched features at once.
+
+    Takes the n best start and end logits of every feature, scores all
+    (start, end) pairs with an outer sum masked to the valid spans and sorts
+    them, in the same order as the per feature implementation.
+    Yields (feature row, result, prelim predictions) in unique_id order.
+    """
+    if feature_arrays is None:
+        feature_arrays = features_to_arrays(features, len(features[0].input_ids) if features else 0)
+    # match features and results by unique_id as in `match_results`
+    unique_ids = np.asarray(feature_arrays['unique_ids'])
+    result_ids = np.array([r.unique_id for r in results], dtype=np.int64)
+    rows = np.flatnonzero(np.isin(unique_ids, result_ids))
+    rows = rows[np.argsort(unique_ids[rows], kind='stable')]
+    result_order = np.argsort(result_ids, kind='stable')
+    result_order = result_order[np.isin(result_ids[result_order], unique_ids)]
+    num_matched = min(len(rows), len(result_order))
+    rows, result_order = rows[:num_matched], result_order[:num_matched]
+    if num_matched == 0:
+        return
+
+    matched_results = [results[i] for i in result_order]
+    seq_length = max(len(r.start_logits) for r in matched_results)
+    # -inf pads results of batches trimmed to a shorter length, these positions are never valid
+    start_logits = np.full([num_matched, seq_length], -np.inf)
+    end_logits = np.full([num_matched, seq_length], -np.inf)
+    for i, result in enumerate(matched_results):
+        start_logits[i, :len(result.start_logits)] = result.start_logits
+        end_logits[i, :len(result.end_logits)] = result.end_logits
+
+    n_best = min(args.n_best_size, seq_length)
+    # stable sort on the negated logits keeps the lower index first on ties, as sorted(reverse=True) does
+    start_indices = np.argsort(-start_logits, axis=1, kind='stable')[:, :n_best]
+    end_indices = np.argsort(-end_logits, axis=1, kind='stable')[:, :n_best]
+    start_top = np.take_along_axis(start_logits, start_indices, axis=1)
+    end_top = np.take_along_axis(end_logits, end_indices, axis=1)
+
+    num_tokens = np.asarray(feature_arrays['input_mask'])[rows].sum(axis=1)
+    token_to_orig = np.asarray(feature_arrays['token_to_orig'])[rows]
+    is_max_context = np.asarray(feature_arrays['token_is_max_context'])[rows]
+    max_position = token_to_orig.shape[1] - 1
+    start_in_doc = (start_indices < num_tokens[:, None]) & \
+        (np.take_along_axis(token_to_orig, np.minimum(start_indices, max_position), axis=1) >= 0) & \
+        np.take_along_axis(is_max_context, np.minimum(start_indices, max_position), axis=1)
+    end_in_doc = (end_indices < num_tokens[:, None]) & \
+        (np.take_along_axis(token_to_orig, np.minimum(end_indices, max_position), axis=1) >= 0)
+    length = end_indices[:, None, :] - start_indices[:, :, None] + 1
+    valid = start_in_doc[:, :, None] & end_in_doc[:, None, :] & (length >= 1) & (length <= args.max_answer_length)
+
+    scores = np.where(valid, start_top[:, :, None] + end_top[:, None, :], -np.inf).reshape(num_matched, -1)
+    # flattened (start rank, end rank) pairs are in the nested loop order of the per feature implementation
+    order = np.argsort(-scores, axis=1, kind='stable')
+    num_valid = valid.reshape(num_matched, -1).sum(axis=1)
+    for i in range(num_matched):
+        pairs = order[i, :num_valid[i]]
+        starts = start_indices[i, pairs // n_best].tolist()
+        ends = end_indices[i, pairs % n_best].tolist()
+        prelim_predictions = [
+            _PrelimPrediction(start_index=s, end_index=e,
+                              start_logit=float(start_logits[i, s]), end_logit=float(end_logits[i, e]))
+            for s, e in zip(starts, ends)]
+        yield rows[i], matched_results[i], prelim_predictions
+
+
+def get_answers(examples, features, results, args, feature_arrays=None):
     predictions = collections.defaultdict(list) #it is possible that one example corresponds to multiple features
     Prediction = collections.namedtuple('Prediction', ['text', 'start_logit', 'end_logit'])
 
     if args.version_2_with_negative:
         null_vals = collections.defaultdict(lambda: (float("inf"),0,0))
-    for ex, feat, result in match_results(examples, features, results):
-        start_indices = _get_best_indices(result.start_logits, args.n_best_size)
-        end_indices = _get_best_indices(result.end_logits, args.n_best_size)
-        prelim_predictions = get_valid_prelim_predictions(start_indices, end_indices, feat, result, args)
-        prelim_predictions = sorted(
-                            prelim_predictions,
-                            key=lambda x: (x.start_logit + x.end_logit),
-                            reverse=True)
+    for row, result, prelim_predictions in batched_prelim_predictions(features, results, args, feature_arrays):
+        feat = features[row]
+        ex = examples[feat.example_index]
         if args.version_2_with_negative:
-            score = result.start_logits[0] + result.end_logits[0]
+            start_null, end_null = float(result.start_logits[0]), float(result.end_logits[0])
+            score = start_null + end_null
             if score < null_vals[ex.qas_id][0]:
-                null_vals[ex.qas_id] = (score, result.start_logits[0], result.end_logits[0])
+                null_vals[ex.qas_id] = (score, start_null, end_null)
 
         curr_predictions = []
         seen_predictions = []
@@ -523,10 +745,6 @@ def get_answer_text(example, feature, pred, args):
     return final_text
 
 def get_valid_prelim_predictions(start_indices, end_indices, feature, result, args):
-    
-    _PrelimPrediction = collections.namedtuple(
-        "PrelimPrediction",
-        ["start_index", "end_index", "start_logit", "end_logit"])
     prelim_predictions = []
     for start_index in start_indices:
         for end_index in end_indices:
@@ -664,14 +882,8 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 def _get_best_indices(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indices = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indices.append(index_and_score[i][0])
-    return best_indices
+    # stable, ties keep the lower index first
+    return np.argsort(-np.asarray(logits, dtype=np.float64), kind='stable')[:n_best_size].tolist()
 
 
 def _compute_softmax(scores):
@@ -844,11 +1056,23 @@ def main():
     parser.add_argument("--skip_cache",
                         default=False,
                         action='store_true',
-                        help="Whether to cache train features")
+                        help="Whether to skip reading and writing the features cache")
     parser.add_argument("--cache_dir",
                         default=None,
                         type=str,
-                        help="Location to cache train feaures. Will default to the dataset directory")
+                        help="Location to cache train and eval feaures. Will default to the dataset directory")
+    parser.add_argument("--n_processes",
+                        default=os.cpu_count(),
+                        type=int,
+                        help="Number of processes converting examples to features")
+    parser.add_argument('--length_bucketing',
+                        default=False,
+                        action='store_true',
+                        help="Batch sequences of similar length and trim every batch to its longest sequence")
+    parser.add_argument('--max_tokens_per_batch',
+                        default=None,
+                        type=int,
+                        help="With --length_bucketing, also limit batches to this many (padded) tokens")
 
     args = parser.parse_args()
     args.fp16 = args.fp16 or args.amp    
@@ -914,10 +1138,41 @@ def main():
     if args.do_train:
         train_examples = read_squad_examples(
             input_file=args.train_file, is_training=True, version_2_with_negative=args.version_2_with_negative)
-        num_train_optimization_steps = int(
-            len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+
+        # the main process converts and caches the features, the others then read the cache
+        distributed_cache = args.local_rank != -1 and not args.skip_cache
+        if distributed_cache and not is_main_process():
+            torch.distributed.barrier()
+        train_features = load_or_convert_features(args.train_file, train_examples, tokenizer, args,
+                                                  is_training=True, write_cache=is_main_process())
+        if distributed_cache and is_main_process():
+            torch.distributed.barrier()
+
+        all_input_ids = torch.from_numpy(train_features['input_ids'].astype(np.int64))
+        all_input_mask = torch.from_numpy(train_features['input_mask'].astype(np.int64))
+        all_segment_ids = torch.from_numpy(train_features['segment_ids'].astype(np.int64))
+        all_start_positions = torch.from_numpy(train_features['start_positions'].astype(np.int64))
+        all_end_positions = torch.from_numpy(train_features['end_positions'].astype(np.int64))
+        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
+                                   all_start_positions, all_end_positions)
+        if args.length_bucketing:
+            train_sampler = LengthBucketBatchSampler(sequence_lengths(all_input_mask), args.train_batch_size * n_gpu,
+                                                     max_tokens=args.max_tokens_per_batch, seed=args.seed)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=None,
+                                          collate_fn=TrimPadding())
+            # the token budget decides the number of batches, already split over the ranks
+            num_train_optimization_steps = num_optimization_steps(train_sampler, int(args.num_train_epochs),
+                                                                  args.gradient_accumulation_steps)
+        else:
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size * n_gpu)
+            num_train_optimization_steps = int(
+                len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+            if args.local_rank != -1:
+                num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     # Prepare model
     config = modeling.BertConfig.from_json_file(args.config_file)
@@ -930,9 +1185,10 @@ def main():
     # model = modeling.BertForQuestionAnswering.from_pretrained(args.bert_model,
                 # cache_dir=os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(args.local_rank)))
     dllogger.log(step="PARAMETER", data={"loading_checkpoint": True})
-    model.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu')["model"], strict=False)
-    dllogger.log(step="PARAMETER", data={"loaded_checkpoint": True})
+    # on the device first, memory mapped weights are then copied to it without a host copy
     model.to(device)
+    model.load_state_dict(modeling.load_checkpoint_state_dict(args.init_checkpoint), strict=False)
+    dllogger.log(step="PARAMETER", data={"loaded_checkpoint": True})
     num_weights = sum([p.numel() for p in model.parameters() if p.requires_grad])
     dllogger.log(step="PARAMETER", data={"model_weights_num":num_weights})
 
@@ -986,57 +1242,19 @@ def main():
 
     global_step = 0
     if args.do_train:
-
-        if args.cache_dir is None:
-            cached_train_features_file = args.train_file + '_{0}_{1}_{2}_{3}'.format(
-                list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(args.doc_stride),
-                str(args.max_query_length))
-        else:
-            cached_train_features_file = args.cache_dir.strip('/') + '/' + args.train_file.split('/')[-1] + '_{0}_{1}_{2}_{3}'.format(
-                list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(args.doc_stride),
-                str(args.max_query_length))
-
-        train_features = None
-        try:
-            with open(cached_train_features_file, "rb") as reader:
-                train_features = pickle.load(reader)
-        except:
-            train_features = convert_examples_to_features(
-                examples=train_examples,
-                tokenizer=tokenizer,
-                max_seq_length=args.max_seq_length,
-                doc_stride=args.doc_stride,
-                max_query_length=args.max_query_length,
-                is_training=True)
-
-            if not args.skip_cache and is_main_process():
-                dllogger.log(step="PARAMETER", data={"Cached_train features_file": cached_train_features_file})
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
-
         dllogger.log(step="PARAMETER", data={"train_start": True})
         dllogger.log(step="PARAMETER", data={"training_samples": len(train_examples)})
-        dllogger.log(step="PARAMETER", data={"training_features": len(train_features)})
+        dllogger.log(step="PARAMETER", data={"training_features": len(train_features['unique_ids'])})
         dllogger.log(step="PARAMETER", data={"train_batch_size":args.train_batch_size})
         dllogger.log(step="PARAMETER", data={"steps":num_train_optimization_steps})
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_start_positions = torch.tensor([f.start_position for f in train_features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                   all_start_positions, all_end_positions)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size * n_gpu)
 
         model.train()
         gradClipper = GradientClipper(max_grad_norm=1.0)
         final_loss = None
         train_start = time.time()
         for epoch in range(int(args.num_train_epochs)):
+            if args.length_bucketing:
+                train_sampler.set_epoch(epoch)
             train_iter = tqdm(train_dataloader, desc="Iteration", disable=args.disable_progress_bar) if is_main_process() else train_dataloader
             for step, batch in enumerate(train_iter):
                 # Terminate early for benchmarking
@@ -1106,27 +1324,28 @@ def main():
 
         eval_examples = read_squad_examples(
             input_file=args.predict_file, is_training=False, version_2_with_negative=args.version_2_with_negative)
-        eval_features = convert_examples_to_features(
-            examples=eval_examples,
-            tokenizer=tokenizer,
-            max_seq_length=args.max_seq_length,
-            doc_stride=args.doc_stride,
-            max_query_length=args.max_query_length,
-            is_training=False)
+        eval_arrays = load_or_convert_features(args.predict_file, eval_examples, tokenizer, args, is_training=False)
+        eval_features = arrays_to_features(eval_arrays, tokenizer)
 
         dllogger.log(step="PARAMETER", data={"infer_start": True})
         dllogger.log(step="PARAMETER", data={"eval_samples": len(eval_examples)})
         dllogger.log(step="PARAMETER", data={"eval_features": len(eval_features)})
         dllogger.log(step="PARAMETER", data={"predict_batch_size": args.predict_batch_size})
 
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
+        all_input_ids = torch.from_numpy(eval_arrays['input_ids'].astype(np.int64))
+        all_input_mask = torch.from_numpy(eval_arrays['input_mask'].astype(np.int64))
+        all_segment_ids = torch.from_numpy(eval_arrays['segment_ids'].astype(np.int64))
         all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-        # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size)
+        # Run prediction for full data, results are matched to features by unique_id so the order does not matter
+        if args.length_bucketing:
+            eval_sampler = LengthBucketBatchSampler(sequence_lengths(all_input_mask), args.predict_batch_size,
+                                                    max_tokens=args.max_tokens_per_batch, shuffle=False,
+                                                    num_replicas=1, rank=0)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=None, collate_fn=TrimPadding())
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size)
 
         infer_start = time.time()
         model.eval()
@@ -1140,20 +1359,20 @@ def main():
             segment_ids = segment_ids.to(device)
             with torch.no_grad():
                 batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
-            for i, example_index in enumerate(example_indices):
-                start_logits = batch_start_logits[i].detach().cpu().tolist()
-                end_logits = batch_end_logits[i].detach().cpu().tolist()
-                eval_feature = eval_features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
+            # one device to host copy per batch
+            batch_start_logits = batch_start_logits.float().cpu().numpy()
+            batch_end_logits = batch_end_logits.float().cpu().numpy()
+            for i, example_index in enumerate(example_indices.tolist()):
+                unique_id = int(eval_arrays['unique_ids'][example_index])
                 all_results.append(RawResult(unique_id=unique_id,
-                                             start_logits=start_logits,
-                                             end_logits=end_logits))
+                                             start_logits=batch_start_logits[i],
+                                             end_logits=batch_end_logits[i]))
 
         time_to_infer = time.time() - infer_start
         output_prediction_file = os.path.join(args.output_dir, "predictions.json")
         output_nbest_file = os.path.join(args.output_dir, "nbest_predictions.json")
 
-        answers, nbest_answers = get_answers(eval_examples, eval_features, all_results, args)
+        answers, nbest_answers = get_answers(eval_examples, eval_features, all_results, args, eval_arrays)
         with open(output_prediction_file, "w") as f:
             f.write(json.dumps(answers, indent=4) + "\n")
         with open(output_nbest_file, "w") as f:
@@ -1182,7 +1401,7 @@ def main():
 
         if args.max_steps == -1:
             dllogger.log(step=tuple(), data={"e2e_train_time": time_to_train,
-                                             "training_sequences_per_second": len(train_features) * args.num_train_epochs / time_to_train,
+                                             "training_sequences_per_second": len(train_features['unique_ids']) * args.num_train_epochs / time_to_train,
                                              "final_loss": final_loss})
         else:
             dllogger.log(step=tuple(), data={"e2e_train_time": time_to_train,
@@ -34,6 +34,7 @@ from file_utils import PYTORCH_PRETRAINED_BERT_CACHE
 from modeling import BertForMultipleChoice, BertConfig, WEIGHTS_NAME, CONFIG_NAME
 from optimization import BertAdam, warmup_linear
 from tokenization import BertTokenizer
+from bucketing import LengthBucketBatchSampler, TrimPadding, num_optimization_steps, sequence_lengths
 
 torch._C._jit_set_profiling_mode(False)
 torch._C._jit_set_profiling_executor(False)
@@ -334,6 +335,14 @@ def main():
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
                              "0 (default value): dynamic loss scaling.\n"
                              "Positive power of 2: static loss scaling value.\n")
+    parser.add_argument('--length_bucketing',
+                        default=False,
+                        action='store_true',
+                        help="Batch sequences of similar length and trim every batch to its longest sequence")
+    parser.add_argument('--max_tokens_per_batch',
+                        default=None,
+                        type=int,
+                        help="With --length_bucketing, also limit batches to this many (padded) tokens")
 
     args = parser.parse_args()
     args.fp16 = args.fp16 or args.amp
@@ -376,10 +385,33 @@ def main():
     num_train_optimization_steps = None
     if args.do_train:
         train_examples = read_swag_examples(os.path.join(args.data_dir, 'train.csv'), is_training = True)
-        num_train_optimization_steps = int(
-            len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+        train_features = convert_examples_to_features(
+            train_examples, tokenizer, args.max_seq_length, True)
+        all_input_ids = torch.tensor(select_field(train_features, 'input_ids'), dtype=torch.long)
+        all_input_mask = torch.tensor(select_field(train_features, 'input_mask'), dtype=torch.long)
+        all_segment_ids = torch.tensor(select_field(train_features, 'segment_ids'), dtype=torch.long)
+        all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
+        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
+        if args.length_bucketing:
+            # a feature holds all 4 choices, tokens per batch count every choice
+            max_tokens = args.max_tokens_per_batch // 4 if args.max_tokens_per_batch else None
+            train_sampler = LengthBucketBatchSampler(sequence_lengths(all_input_mask), args.train_batch_size,
+                                                     max_tokens=max_tokens, seed=args.seed)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=None,
+                                          collate_fn=TrimPadding())
+            # the token budget decides the number of batches, already split over the ranks
+            num_train_optimization_steps = num_optimization_steps(train_sampler, int(args.num_train_epochs),
+                                                                  args.gradient_accumulation_steps)
+        else:
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            num_train_optimization_steps = int(
+                len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+            if args.local_rank != -1:
+                num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
 
     # Prepare model
     model = BertForMultipleChoice.from_pretrained(args.bert_model,
@@ -435,25 +467,15 @@ def main():
 
     global_step = 0
     if args.do_train:
-        train_features = convert_examples_to_features(
-            train_examples, tokenizer, args.max_seq_length, True)
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor(select_field(train_features, 'input_ids'), dtype=torch.long)
-        all_input_mask = torch.tensor(select_field(train_features, 'input_mask'), dtype=torch.long)
-        all_segment_ids = torch.tensor(select_field(train_features, 'segment_ids'), dtype=torch.long)
-        all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
 
         model.train()
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            if args.length_bucketing:
+                train_sampler.set_epoch(epoch)
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
@@ -524,8 +546,14 @@ def main():
         all_label = torch.tensor([f.label for f in eval_features], dtype=torch.long)
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        if args.length_bucketing:
+            max_tokens = args.max_tokens_per_batch // 4 if args.max_tokens_per_batch else None
+            eval_sampler = LengthBucketBatchSampler(sequence_lengths(all_input_mask), args.eval_batch_size,
+                                                    max_tokens=max_tokens, shuffle=False, num_replicas=1, rank=0)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=None, collate_fn=TrimPadding())
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
         model.eval()
         eval_loss, eval_accuracy = 0, 0
@@ -18,7 +18,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import functools
 import logging
+import multiprocessing
 import os
 import unicodedata
 import six
@@ -48,6 +50,11 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
 }
 VOCAB_NAME = 'vocab.txt'
 
+# ASCII text only needs control characters removed and \t, \n, \r mapped to a space
+# (the same as `BasicTokenizer._clean_text`), which str.translate does in C
+_ASCII_CLEAN_TABLE = {cp: None for cp in list(range(32)) + [127]}
+_ASCII_CLEAN_TABLE.update({ord("\t"): " ", ord("\n"): " ", ord("\r"): " "})
+
 def convert_to_unicode(text):
   """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
   if six.PY3:
@@ -96,7 +103,7 @@ class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), fast=True):
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path '{}'. To load the vocabulary from a Google pretrained "
@@ -105,8 +112,8 @@ class BertTokenizer(object):
         self.ids_to_tokens = collections.OrderedDict(
             [(ids, tok) for tok, ids in self.vocab.items()])
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case,
-                                              never_split=never_split)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+                                              never_split=never_split, fast=fast)
+        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, fast=fast)
         self.max_len = max_len if max_len is not None else int(1e12)
 
     def tokenize(self, text):
@@ -116,6 +123,13 @@ class BertTokenizer(object):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def tokenize_batch(self, texts, n_processes=1, chunksize=256):
+        """Tokenizes a list of texts, on a pool of `n_processes` processes if > 1."""
+        if n_processes <= 1:
+            return [self.tokenize(text) for text in texts]
+        with multiprocessing.Pool(n_processes, initializer=_init_batch_tokenizer, initargs=(self,)) as pool:
+            return pool.map(_batch_tokenize, texts, chunksize=chunksize)
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -175,22 +189,66 @@ class BertTokenizer(object):
         return tokenizer
 
 
+_batch_tokenizer = None
+
+
+def _init_batch_tokenizer(tokenizer):
+    global _batch_tokenizer
+    _batch_tokenizer = tokenizer
+
+
+def _batch_tokenize(text):
+    return _batch_tokenizer.tokenize(text)
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry, can be shared between threads."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                # evicted by another thread in the meantime
+                pass
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
     def __init__(self,
                  do_lower_case=True,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"),
+                 fast=True,
+                 cache_size=100000):
         """Constructs a BasicTokenizer.
 
         Args:
           do_lower_case: Whether to lower case the input.
+          fast: Clean ASCII text with str.translate and cache the lower cased,
+            accent stripped and punctuation split pieces of every whitespace token.
+            The output is identical.
         """
         self.do_lower_case = do_lower_case
         self.never_split = never_split
+        self.fast = fast
+        self._cache = LRUCache(cache_size) if fast else None
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        if self.fast:
+            return self._tokenize_fast(text)
         text = self._clean_text(text)
         # This was added on November 1st, 2018 for the multilingual and Chinese
         # models. This is also applied to the English models now, but it doesn't
@@ -210,6 +268,27 @@ class BasicTokenizer(object):
         output_tokens = whitespace_tokenize(" ".join(split_tokens))
         return output_tokens
 
+    def _tokenize_fast(self, text):
+        if text.isascii():
+            # no CJK characters in ASCII text
+            text = text.translate(_ASCII_CLEAN_TABLE)
+        else:
+            text = self._clean_text(text)
+            text = self._tokenize_chinese_chars(text)
+        output_tokens = []
+        for token in text.split():
+            pieces = self._cache.get(token)
+            if pieces is None:
+                pieces = token
+                if self.do_lower_case and token not in self.never_split:
+                    pieces = pieces.lower()
+                    pieces = self._run_strip_accents(pieces)
+                # pieces may contain whitespace after accent stripping, split like the slow path
+                pieces = tuple(" ".join(self._run_split_on_punc(pieces)).split())
+                self._cache.put(token, pieces)
+            output_tokens.extend(pieces)
+        return output_tokens
+
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
         text = unicodedata.normalize("NFD", text)
@@ -295,10 +374,51 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, fast=True, cache_size=100000):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.fast = fast
+        if fast:
+            # character tries for pieces at the start of a word and for "##" continuations,
+            # a node maps a character to its child, the "" key marks the end of a piece
+            self._start_trie = {}
+            self._continuation_trie = {}
+            for piece in vocab:
+                self._add_to_trie(self._start_trie, piece)
+                if piece.startswith("##"):
+                    self._add_to_trie(self._continuation_trie, piece[2:])
+            self._cache = LRUCache(cache_size)
+
+    @staticmethod
+    def _add_to_trie(trie, piece):
+        node = trie
+        for char in piece:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def _tokenize_word(self, token):
+        """Greedy longest-match-first by walking the tries, None if a piece cannot be matched"""
+        sub_tokens = []
+        start = 0
+        trie = self._start_trie
+        while start < len(token):
+            node = trie
+            end = None
+            i = start
+            while i < len(token):
+                node = node.get(token[i])
+                if node is None:
+                    break
+                i += 1
+                if "" in node:
+                    end = i
+            if end is None:
+                return None
+            sub_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+            start = end
+            trie = self._continuation_trie
+        return sub_tokens
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -318,6 +438,9 @@ class WordpieceTokenizer(object):
           A list of wordpiece tokens.
         """
 
+        if self.fast:
+            return self._tokenize_fast(text)
+
         output_tokens = []
         for token in whitespace_tokenize(text):
             chars = list(token)
@@ -351,7 +474,22 @@ class WordpieceTokenizer(object):
                 output_tokens.extend(sub_tokens)
         return output_tokens
 
+    def _tokenize_fast(self, text):
+        output_tokens = []
+        for token in text.split():
+            pieces = self._cache.get(token)
+            if pieces is None:
+                if len(token) > self.max_input_chars_per_word:
+                    pieces = (self.unk_token,)
+                else:
+                    sub_tokens = self._tokenize_word(token)
+                    pieces = (self.unk_token,) if sub_tokens is None else tuple(sub_tokens)
+                self._cache.put(token, pieces)
+            output_tokens.extend(pieces)
+        return output_tokens
+
 
+@functools.lru_cache(maxsize=None)
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
@@ -364,6 +502,7 @@ def _is_whitespace(char):
     return False
 
 
+@functools.lru_cache(maxsize=None)
 def _is_control(char):
     """Checks whether `chars` is a control character."""
     # These are technically control characters but we count them as whitespace
@@ -376,6 +515,7 @@ def _is_control(char):
     return False
 
 
+@functools.lru_cache(maxsize=None)
 def _is_punctuation(char):
     """Checks whether `chars` is a punctuation character."""
     cp = ord(char)
@@ -53,8 +53,8 @@ output [
 instance_group [
     {{
         count: {engine_count}
-        kind: KIND_GPU
-        gpus: [ {gpu_list} ]
+        kind: {instance_kind}
+        {gpu_list}
     }}
 ]"""
 
@@ -85,26 +85,20 @@ optimization {{
 }}"""
 
 
+def synchronize():
+    ''' waits for queued cuda work, a no-op on cpu only machines '''
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
 def remove_empty_lines(text):
     ''' removes empty lines from text, returns the result '''
     ret = "".join([s for s in text.strip().splitlines(True) if s.strip()])
     return ret
 
 
-def create_deployer(argv):
-    ''' takes a list of arguments, returns a deployer object and the list of unused arguments '''
-    parser = argparse.ArgumentParser()
-    # required args
-    method = parser.add_mutually_exclusive_group(required=True)
-    method.add_argument('--ts-script',
-                        action='store_true',
-                        help='convert to torchscript using torch.jit.script')
-    method.add_argument('--ts-trace',
-                        action='store_true',
-                        help='convert to torchscript using torch.jit.trace')
-    method.add_argument('--onnx',
-                        action='store_true',
-                        help='convert to onnx using torch.onnx.export')
+def add_triton_arguments(parser):
+    ''' adds the triton related and optimization flags to parser '''
     # triton related args
     arguments = parser.add_argument_group('triton related flags')
     arguments.add_argument('--triton-no-cuda',
@@ -145,8 +139,26 @@ def create_deployer(argv):
                             type=int,
                             default=0,
                             help="capture cuda graph for obtaining speedup. possible values: 0, 1. default: 0 (automatic). ")
+    return parser
+
+
+def create_deployer(argv):
+    ''' takes a list of arguments, returns a deployer object and the list of unused arguments '''
+    parser = argparse.ArgumentParser()
+    # required args
+    method = parser.add_mutually_exclusive_group(required=True)
+    method.add_argument('--ts-script',
+                        action='store_true',
+                        help='convert to torchscript using torch.jit.script')
+    method.add_argument('--ts-trace',
+                        action='store_true',
+                        help='convert to torchscript using torch.jit.trace')
+    method.add_argument('--onnx',
+                        action='store_true',
+                        help='convert to onnx using torch.onnx.export')
+    add_triton_arguments(parser)
     # remainder args
-    arguments.add_argument('model_arguments', nargs=argparse.REMAINDER, help='arguments that will be ignored by deployer lib and will be forwarded to your deployer script')
+    parser.add_argument('model_arguments', nargs=argparse.REMAINDER, help='arguments that will be ignored by deployer lib and will be forwarded to your deployer script')
     # 
     args = parser.parse_args(argv)
     deployer = Deployer(args)
@@ -154,6 +166,27 @@ def create_deployer(argv):
     return deployer, args.model_arguments[1:]
 
 
+class ONNX_model:
+    ''' runs an onnxruntime session on torch tensors, returns torch tensors on device '''
+    def __init__(self, session, input_names, device):
+        self.session = session
+        self.input_names = input_names
+        self.device = device
+    
+    def to_numpy(self, tensor):
+        return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
+    
+    def __call__(self, *inputs):
+        inp = [(input_name, inputs[i]) for i,input_name in enumerate(self.input_names)]
+        inp = {input_name : self.to_numpy(x) for input_name,x in inp}
+        outputs = self.session.run(None, inp)
+        outputs = [torch.from_numpy(output) for output in outputs]
+        outputs = [output.to(self.device) for output in outputs]
+        if len(outputs) == 1:
+            outputs = outputs[0]
+        return outputs
+
+
 class DeployerLibrary:
     def __init__(self, args):
         self.args = args
@@ -245,7 +278,7 @@ class DeployerLibrary:
         ''' run the models on inputs, return the outputs and execution times '''
         ret = []
         for model in models:
-            torch.cuda.synchronize()
+            synchronize()
             time_start = time.time()
             outputs = []
             for input in inputs:
@@ -254,7 +287,7 @@ class DeployerLibrary:
                 if type(output) is torch.Tensor:
                     output = [output]
                 outputs.append(output)
-            torch.cuda.synchronize()
+            synchronize()
             time_end = time.time()
             t = time_end - time_start
             ret.append(outputs)
@@ -282,16 +315,68 @@ class DeployerLibrary:
         print("stddev of L_inf error over output tensors: ", statistics.stdev(Linf_errors))
         print()
     
+    def export_torchscript(self, model, inputs, final_model_path, trace=False):
+        ''' converts the model with torch.jit.trace on inputs[0] or torch.jit.script, 
+            saves it to final_model_path and returns the loaded model '''
+        with torch.no_grad():
+            if trace: # trace it 
+                model_ts = torch.jit.trace(model, inputs[0])
+            else: # script it 
+                model_ts = torch.jit.script(model)
+        
+        # save the model 
+        torch.jit.save(model_ts, final_model_path)
+        
+        # load the model 
+        model_ts = torch.jit.load(final_model_path, map_location=inputs[0][0].device)
+        model_ts.eval() # WAR for bug : by default, model_ts gets loaded in training mode
+        return model_ts
+    
+    def export_onnx(self, model, inputs, final_model_path, input_names, output_names, dynamic_axes, device):
+        ''' exports the model to onnx on inputs[0], checks the graph and returns 
+            the model loaded with onnxruntime, called like the torch model
+            :: dynamic_axes :: the variable dimensions of every input and output name
+        '''
+        import onnx
+        import onnxruntime
+        
+        assert not model.training, "internal error - model should be in eval() mode! "
+        with torch.no_grad():
+            torch.onnx.export(model, inputs[0], final_model_path, verbose=False, 
+                              input_names=input_names, output_names=output_names, 
+                              dynamic_axes=dynamic_axes, opset_version=11)
+        
+        # syntactic error check
+        converted_model = onnx.load(final_model_path)
+        # check that the IR is well formed
+        onnx.checker.check_model(converted_model)
+        
+        # load the model
+        session = onnxruntime.InferenceSession(final_model_path, None)
+        return ONNX_model(session, input_names, device)
+    
     def write_config(self, config_filename, 
                      input_shapes, input_types, 
-                     output_shapes, output_types):
+                     output_shapes, output_types, 
+                     max_batch_size=None, dyn_batching_delay=None, engine_count=None, 
+                     instance_kind="KIND_GPU"):
         ''' writes Triton config file 
             :: config_filename :: the file to write the config file into
             :: input_shapes :: tuple of dynamic shapes of the input tensors
             :: input_types :: tuple of torch types of the input tensors
             :: output_shapes :: tuple of dynamic shapes of the output tensors
             :: output_types :: tuple of torch types of the output tensors
+            :: max_batch_size, dyn_batching_delay, engine_count :: override the 
+               --triton-max-batch-size, --triton-dyn-batching-delay and --triton-engine-count values
+            :: instance_kind :: "KIND_GPU" (on all visible gpus) or "KIND_CPU"
         '''
+        if max_batch_size is None:
+            max_batch_size = self.args.triton_max_batch_size
+        if dyn_batching_delay is None:
+            dyn_batching_delay = self.args.triton_dyn_batching_delay
+        if engine_count is None:
+            engine_count = self.args.triton_engine_count
+        
         assert self.platform is not None, "error - platform is not set"
         
         config_template = CONFIG_TEMPLATE
@@ -322,18 +407,17 @@ class DeployerLibrary:
         spec_outputs = spec_outputs[:-1]
         
         batching_str = ""
-        max_batch_size = self.args.triton_max_batch_size
         
-        if (self.args.triton_dyn_batching_delay > 0):
+        if (dyn_batching_delay > 0):
             # Use only full and half full batches 
-            pref_batch_size = [int(max_batch_size / 2.0), max_batch_size]
+            pref_batch_size = sorted(set(x for x in [int(max_batch_size / 2.0), max_batch_size] if x > 0))
             
             batching_str = r"""
 dynamic_batching {{
     preferred_batch_size: [{0}]
     max_queue_delay_microseconds: {1}
 }}""".format(", ".join([str(x) for x in pref_batch_size]), 
-                        int(self.args.triton_dyn_batching_delay * 1000.0))
+                        int(dyn_batching_delay * 1000.0))
         
         d = {
             "capture_cuda_graph":     str(self.args.capture_cuda_graph)
@@ -348,8 +432,10 @@ dynamic_batching {{
             "spec_outputs":         spec_outputs, 
             "dynamic_batching":     batching_str, 
             "model_optimizations" : optimization_str, 
-            "gpu_list":         ", ".join([str(x) for x in range(torch.cuda.device_count())]), 
-            "engine_count":     self.args.triton_engine_count
+            "instance_kind":    instance_kind, 
+            "gpu_list":         "gpus: [ {} ]".format(", ".join([str(x) for x in range(torch.cuda.device_count())]))
+                                if instance_kind == "KIND_GPU" else "", 
+            "engine_count":     engine_count
         }
         
         # write config 
@@ -380,8 +466,6 @@ class Deployer:
     
     def to_triton_onnx(self, dataloader, model):
         ''' export the model to onnx and test correctness on dataloader '''
-        import onnx
-        import onnxruntime
         # setup device
         if self.args.triton_no_cuda:
             device = torch.device('cpu')
@@ -439,41 +523,10 @@ class Deployer:
         for output_name,output_shape in zip(output_names,output_shapes):
             dynamic_axes[output_name] = [i for i,x in enumerate(output_shape) if x == -1]
         
-        # export the model
+        # export the model and load it with onnxruntime
         assert not model.training, "internal error - model should be in eval() mode! "
-        with torch.no_grad():
-            torch.onnx.export(model, inputs[0], final_model_path, verbose=False, 
-                              input_names=input_names, output_names=output_names, 
-                              dynamic_axes=dynamic_axes, opset_version=11)
-        
-        # syntactic error check
-        converted_model = onnx.load(final_model_path)
-        # check that the IR is well formed
-        onnx.checker.check_model(converted_model)
-        
-        # load the model
-        session = onnxruntime.InferenceSession(final_model_path, None)
-        
-        class ONNX_model:
-            def __init__(self, session, input_names, device):
-                self.session = session
-                self.input_names = input_names
-                        
-            def to_numpy(self, tensor):
-                return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
-            
-            def __call__(self, *inputs):
-                inp = [(input_name, inputs[i]) for i,input_name in enumerate(self.input_names)]
-                inp = {input_name : self.to_numpy(x) for input_name,x in inp}
-                outputs = self.session.run(None, inp)
-                outputs = [torch.from_numpy(output) for output in outputs]
-                outputs = [output.to(device) for output in outputs]
-                if len(outputs) == 1:
-                    outputs = outputs[0]
-                return outputs
-        
-        # switch to eval mode
-        model_onnx = ONNX_model(session, input_names, device)
+        model_onnx = self.lib.export_onnx(model, inputs, final_model_path, 
+                                          input_names, output_names, dynamic_axes, device)
         
         # run both models on inputs
         assert not model.training, "internal error - model should be in eval() mode! "
@@ -522,19 +575,8 @@ class Deployer:
             os.makedirs(version_folder)
         final_model_path = os.path.join(version_folder, 'model.pt')
         
-        # convert the model 
-        with torch.no_grad():
-            if self.args.ts_trace: # trace it 
-                model_ts = torch.jit.trace(model, inputs[0])
-            if self.args.ts_script: # script it 
-                model_ts = torch.jit.script(model)
-        
-        # save the model 
-        torch.jit.save(model_ts, final_model_path)
-        
-        # load the model 
-        model_ts = torch.jit.load(final_model_path)
-        model_ts.eval() # WAR for bug : by default, model_ts gets loaded in training mode
+        # convert, save and load the model 
+        model_ts = self.lib.export_torchscript(model, inputs, final_model_path, trace=self.args.ts_trace)
         
         # run both models on inputs
         assert not model.training, "internal error - model should be in eval() mode! "
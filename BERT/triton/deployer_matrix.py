@@ -0,0 +1,343 @@
+#!/usr/bin/python
+
+# Copyright (c) 2020, NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Exports the model in every variant of a matrix of formats (TorchScript script/trace, ONNX),
+shapes (dynamic or static sequence length) and precisions (fp32/fp16), checks the outputs of
+every variant against the eager fp32 model with compute_errors, times the variants locally over
+a grid of batch sizes and sequence lengths, and deploys the variant and max batch size with the
+highest throughput that meets the latency SLO, with its config.pbtxt and perf_client input data.
+
+    python triton/deployer_matrix.py --save-dir /results/triton_models --triton-model-name bert \
+        --latency-slo 50 --batch-sizes 1 2 4 8 --seq-lengths 128 256 384 \
+        -- --checkpoint checkpoints/bert_qa.pt --config_file bert_config.json \
+        --vocab_file vocab/vocab --predict_file dev-v1.1.json --do_lower_case
+
+The model arguments after '--' are the ones of deployer.py, --fp16 and --batch_size there are
+ignored. All measurements are written to matrix.json next to the exported variants.
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import statistics
+
+import torch
+
+import deployer_lib
+#
+sys.path.append('../')
+sys.path.append('.')
+from deployer import get_model_args, initialize_model, get_dataloader
+
+
+FORMATS = ('ts-script', 'ts-trace', 'onnx')
+SHAPES = ('dynamic', 'static')
+PRECISIONS = ('fp32', 'fp16')
+
+PLATFORMS = {
+    'ts-script': 'pytorch_libtorch',
+    'ts-trace':  'pytorch_libtorch',
+    'onnx':      'onnxruntime_onnx'
+}
+MODEL_FILENAMES = {
+    'ts-script': 'model.pt',
+    'ts-trace':  'model.pt',
+    'onnx':      'model.onnx'
+}
+OUTPUT_TYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16
+}
+
+
+def create_matrix_args(argv):
+    ''' takes a list of arguments, returns the matrix arguments and the list of model arguments '''
+    parser = argparse.ArgumentParser()
+    arguments = parser.add_argument_group('matrix flags')
+    arguments.add_argument('--formats',
+                           nargs='+', choices=FORMATS, default=list(FORMATS),
+                           help='export formats to compare')
+    arguments.add_argument('--shapes',
+                           nargs='+', choices=SHAPES, default=list(SHAPES),
+                           help='dynamic: batch and sequence length vary, static: only the batch size varies \
+                                 and requests are padded to the exported sequence length')
+    arguments.add_argument('--precisions',
+                           nargs='+', choices=PRECISIONS, default=list(PRECISIONS),
+                           help='precisions to compare')
+    arguments.add_argument('--batch-sizes',
+                           nargs='+', type=int, default=[1, 2, 4, 8],
+                           help='batch sizes to time every variant with')
+    arguments.add_argument('--seq-lengths',
+                           nargs='+', type=int, default=[128, 256, 384],
+                           help='sequence lengths to time every variant with, at most the exported length')
+    arguments.add_argument('--latency-slo',
+                           type=float, default=100.0,
+                           help='p99 latency in ms a batch must meet to be deployed')
+    arguments.add_argument('--slo-seq-length',
+                           type=int, default=None,
+                           help='sequence length of the requests the SLO applies to, the exported length by default')
+    arguments.add_argument('--warmup',
+                           type=int, default=3,
+                           help='untimed runs per measurement')
+    arguments.add_argument('--iterations',
+                           type=int, default=20,
+                           help='timed runs per measurement')
+    arguments.add_argument('--max-error-fp32',
+                           type=float, default=1e-3,
+                           help='maximal L_inf error of fp32 variants against the eager model')
+    arguments.add_argument('--max-error-fp16',
+                           type=float, default=5e-2,
+                           help='maximal L_inf error of fp16 variants against the eager model')
+    arguments.add_argument('--profiling-data-dir',
+                           type=str, default=None,
+                           help='write perf_client input data (like triton/profiling_data_int64) of the SLO \
+                                 sequence length to this directory')
+    arguments.add_argument('--work-dir',
+                           type=str, default='./triton_matrix',
+                           help='directory of the exported variants and matrix.json, outside of --save-dir \
+                                 so that Triton does not try to load them')
+    deployer_lib.add_triton_arguments(parser)
+    # remainder args
+    parser.add_argument('model_arguments', nargs=argparse.REMAINDER, help='arguments that will be forwarded to deployer.py get_model_args')
+    #
+    args = parser.parse_args(argv)
+    return args, args.model_arguments[1:]
+
+
+def variant_name(fmt, shape, precision):
+    return "{}_{}_{}".format(fmt, shape, precision)
+
+
+def trim(inputs, seq_length):
+    ''' cuts the sequence dimension of every tensor of the input tuple to seq_length '''
+    return tuple(x[:, :seq_length].contiguous() for x in inputs)
+
+
+def make_batch(pool, batch_size, seq_length):
+    ''' first batch_size samples of pool (repeated if pool is smaller), trimmed to seq_length '''
+    index = torch.arange(batch_size, device=pool[0].device) % pool[0].size(0)
+    return trim(tuple(x.index_select(0, index) for x in pool), seq_length)
+
+
+def time_model(model, inputs, warmup, iterations):
+    ''' returns the latencies in ms of iterations runs of model on inputs '''
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            deployer_lib.synchronize()
+            start = time.perf_counter()
+            model(*inputs)
+            deployer_lib.synchronize()
+            if i >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000.0)
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def triton_shapes(shape, num_tensors, seq_length):
+    ''' shapes written to config.pbtxt, the batch dimension is always variable '''
+    if shape == 'dynamic':
+        return tuple((-1, -1) for _ in range(num_tensors))
+    return tuple((-1, seq_length) for _ in range(num_tensors))
+
+
+class MatrixDeployer:
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+        self.lib = deployer_lib.DeployerLibrary(args)
+        self.work_dir = args.work_dir
+
+    def export(self, model, inputs, fmt, shape, path):
+        ''' exports the model in fmt to path, returns the loaded model '''
+        if fmt == 'onnx':
+            input_names = ["input__" + str(num) for num in range(len(inputs[0]))]
+            output_names = ["output__0", "output__1"]
+            variable = [0, 1] if shape == 'dynamic' else [0]
+            dynamic_axes = {name: variable for name in input_names + output_names}
+            return self.lib.export_onnx(model, inputs, path, input_names, output_names, dynamic_axes, self.device)
+        return self.lib.export_torchscript(model, inputs, path, trace=(fmt == 'ts-trace'))
+
+    def check(self, reference, converted, checks, precision):
+        ''' returns the maximal L_inf error of converted against reference on checks and whether it is tolerated '''
+        outputs = self.lib.run_models((reference, converted), checks)
+        Linf_errors = self.lib.compute_errors(outputs[0], outputs[2])
+        max_error = self.args.max_error_fp16 if precision == 'fp16' else self.args.max_error_fp32
+        return max(Linf_errors), max(Linf_errors) <= max_error
+
+    def profile(self, converted, pool, shape, export_seq_length):
+        ''' returns {batch size: {seq length: (p50, p99)}} in ms, static variants always run
+            the exported sequence length '''
+        timings = {}
+        for batch_size in self.args.batch_sizes:
+            timings[batch_size] = {}
+            if shape == 'static':
+                latencies = time_model(converted, make_batch(pool, batch_size, export_seq_length),
+                                       self.args.warmup, self.args.iterations)
+                stats = (statistics.median(latencies), percentile(latencies, 99))
+            for seq_length in self.args.seq_lengths:
+                if shape == 'dynamic':
+                    latencies = time_model(converted, make_batch(pool, batch_size, seq_length),
+                                           self.args.warmup, self.args.iterations)
+                    stats = (statistics.median(latencies), percentile(latencies, 99))
+                timings[batch_size][seq_length] = stats
+                print("  batch {:3d} seq {:4d}: p50 {:9.2f} ms p99 {:9.2f} ms".format(
+                    batch_size, seq_length, *stats), flush=True)
+        return timings
+
+    def run_variant(self, model, inputs, pool, fmt, shape, precision):
+        ''' exports, checks and times one variant, returns its report entry '''
+        name = variant_name(fmt, shape, precision)
+        export_seq_length = inputs[0][0].size(1)
+        path = os.path.join(self.work_dir, name, MODEL_FILENAMES[fmt])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print("exporting " + name, flush=True)
+
+        variant_model = copy.deepcopy(model).half() if precision == 'fp16' else model
+        converted = self.export(variant_model, inputs, fmt, shape, path)
+
+        # dynamic variants are also checked on shorter sequences
+        checks = list(inputs)
+        if shape == 'dynamic':
+            checks += [trim(inputs[0], seq_length) for seq_length in self.args.seq_lengths
+                       if seq_length < export_seq_length]
+        max_error, passed = self.check(model, converted, checks, precision)
+        print("  maximal absolute error (L_inf): {}{}".format(max_error, "" if passed else " - rejected"), flush=True)
+
+        entry = {'name': name, 'format': fmt, 'shape': shape, 'precision': precision,
+                 'path': path, 'max_error': max_error, 'passed': passed}
+        if passed:
+            entry['timings'] = self.profile(converted, pool, shape, export_seq_length)
+        return entry
+
+    def select(self, report, slo_seq_length):
+        ''' returns (entry, batch size, p50, p99) of the highest throughput within the SLO, None if nothing meets it '''
+        best = None
+        for entry in report:
+            if not entry.get('timings'):
+                continue
+            for batch_size, by_length in entry['timings'].items():
+                p50, p99 = by_length[slo_seq_length]
+                if p99 > self.args.latency_slo:
+                    continue
+                key = (batch_size / p50, -p99)
+                if best is None or key > best[0]:
+                    best = (key, (entry, batch_size, p50, p99))
+        return None if best is None else best[1]
+
+    def deploy(self, entry, batch_size, p99, num_inputs, export_seq_length):
+        ''' copies the selected variant into the Triton model directory and writes its config '''
+        model_folder = os.path.join(self.args.save_dir, self.args.triton_model_name)
+        version_folder = os.path.join(model_folder, str(self.args.triton_model_version))
+        if not os.path.exists(version_folder):
+            os.makedirs(version_folder)
+        shutil.copy(entry['path'], os.path.join(version_folder, MODEL_FILENAMES[entry['format']]))
+
+        # a request may wait in the queue for half of the latency left to the SLO
+        dyn_batching_delay = (self.args.latency_slo - p99) / 2.0 if batch_size > 1 else 0
+        self.lib.set_platform(PLATFORMS[entry['format']])
+        config_filename = os.path.join(model_folder, "config.pbtxt")
+        self.lib.write_config(config_filename,
+                              triton_shapes(entry['shape'], num_inputs, export_seq_length),
+                              [torch.int64] * num_inputs,
+                              triton_shapes(entry['shape'], 2, export_seq_length),
+                              [OUTPUT_TYPES[entry['precision']]] * 2,
+                              max_batch_size=batch_size, dyn_batching_delay=dyn_batching_delay,
+                              instance_kind="KIND_CPU" if self.device.type == 'cpu' else "KIND_GPU")
+        return config_filename, dyn_batching_delay
+
+    def write_profiling_data(self, pool, seq_length):
+        ''' writes the first sample as raw int64 input__<i> files for perf_client --input-data '''
+        os.makedirs(self.args.profiling_data_dir, exist_ok=True)
+        for i, x in enumerate(make_batch(pool, 1, seq_length)):
+            x.cpu().to(torch.int64).numpy().tofile(os.path.join(self.args.profiling_data_dir, "input__" + str(i)))
+
+    def run(self, dataloader, model):
+        model.to(self.device)
+        model.eval()
+        assert not model.training, "internal error - model should be in eval() mode! "
+        inputs = self.lib.prepare_inputs(dataloader, self.device)
+        pool = tuple(torch.cat(x) for x in zip(*inputs))
+        export_seq_length = pool[0].size(1)
+        slo_seq_length = self.args.slo_seq_length or export_seq_length
+        self.args.seq_lengths = sorted(set(x for x in self.args.seq_lengths + [slo_seq_length]
+                                           if x <= export_seq_length))
+        if slo_seq_length > export_seq_length:
+            raise ValueError("--slo-seq-length {} is longer than the exported sequences ({})".format(
+                slo_seq_length, export_seq_length))
+
+        report = []
+        for fmt in self.args.formats:
+            for shape in self.args.shapes:
+                for precision in self.args.precisions:
+                    try:
+                        entry = self.run_variant(model, inputs, pool, fmt, shape, precision)
+                    except Exception as e:
+                        # e.g. fp16 kernels that are missing on the cpu, the other variants still run
+                        print("  failed: {}".format(e), flush=True)
+                        entry = {'name': variant_name(fmt, shape, precision), 'format': fmt, 'shape': shape,
+                                 'precision': precision, 'passed': False, 'error': str(e)}
+                    report.append(entry)
+
+        selected = self.select(report, slo_seq_length)
+        summary = {'latency_slo': self.args.latency_slo, 'slo_seq_length': slo_seq_length,
+                   'device': str(self.device), 'variants': report, 'selected': None}
+        if selected is None:
+            print("no variant meets the latency SLO of {} ms at sequence length {}".format(
+                self.args.latency_slo, slo_seq_length))
+        else:
+            entry, batch_size, p50, p99 = selected
+            config_filename, dyn_batching_delay = self.deploy(entry, batch_size, p99, len(pool), export_seq_length)
+            summary['selected'] = {'name': entry['name'], 'max_batch_size': batch_size, 'p50': p50, 'p99': p99,
+                                   'dyn_batching_delay': dyn_batching_delay, 'config': config_filename}
+            print("selected {} with max_batch_size {}: p50 {:.2f} ms p99 {:.2f} ms, {:.1f} sequences/s".format(
+                entry['name'], batch_size, p50, p99, batch_size / p50 * 1000.0))
+            print("wrote " + config_filename)
+            if self.args.profiling_data_dir is not None:
+                self.write_profiling_data(pool, slo_seq_length)
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        report_filename = os.path.join(self.work_dir, 'matrix.json')
+        with open(report_filename, "w") as f:
+            f.write(json.dumps(summary, indent=4) + "\n")
+        print("wrote " + report_filename)
+        return selected
+
+
+if __name__=='__main__':
+    args, model_argv = create_matrix_args(sys.argv[1:])
+    model_args = get_model_args(model_argv)
+    # the matrix makes its own fp16 copies of the fp32 model
+    model_args.fp16 = False
+    model_args.batch_size = max(args.batch_sizes)
+
+    if args.triton_no_cuda or not torch.cuda.is_available():
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda')
+
+    model = initialize_model(model_args)
+    dataloader = get_dataloader(model_args)
+    MatrixDeployer(args, device).run(dataloader, model)
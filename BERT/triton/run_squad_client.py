@@ -27,26 +27,151 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
-import numpy as np
+import collections
+import json
 import os
 import sys
-from builtins import range
-import collections
-from tqdm import tqdm
+import threading
 import time
-from tensorrtserver.api import *
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from tensorrtserver.api import InferContext, ProtocolType
+except ImportError:
+    # only --mock_server works without the client library
+    InferContext = ProtocolType = None
 
 sys.path.append('.')
-from run_squad import get_answers, convert_examples_to_features, read_squad_examples
+from run_squad import get_answers, read_squad_examples, load_or_convert_features, arrays_to_features
 from tokenization import BertTokenizer
-import json
-import pickle
 
 
-args = None
+RawResult = collections.namedtuple("RawResult",
+                                   ["unique_id", "start_logits", "end_logits"])
+BatchInfo = collections.namedtuple("BatchInfo",
+                                   ["start_time", "batch_size", "start", "unique_ids"])
 
 
-if __name__ == '__main__':
+def pack_inputs(arrays):
+    """Model inputs of all features as contiguous int64 arrays, built once, batches are row slices of them"""
+    return {'input__0': np.ascontiguousarray(arrays['input_ids'], dtype=np.int64),
+            'input__1': np.ascontiguousarray(arrays['segment_ids'], dtype=np.int64),
+            'input__2': np.ascontiguousarray(arrays['input_mask'], dtype=np.int64)}
+
+
+def batches(inputs, unique_ids, batch_size):
+    """Yields (input dict, first feature, unique ids), the inputs of every sample are views into `inputs`"""
+    num_features = len(unique_ids)
+    for start in range(0, num_features, batch_size):
+        end = min(start + batch_size, num_features)
+        # the client takes a list with one array per sample, the rows of a slice are views
+        input_dict = {name: list(array[start:end]) for name, array in inputs.items()}
+        yield input_dict, start, unique_ids[start:end]
+
+
+class MockInferContext(object):
+    """
+    Stands in for InferContext to benchmark the client without a server.
+
+    Requests are answered by `num_instances` threads after `latency_ms` with random
+    logits of the shape the exported model returns, so the measured throughput is
+    bounded by the client alone when the latency is small.
+    """
+
+    def __init__(self, latency_ms=0.0, num_instances=1, seed=0):
+        self.latency = latency_ms / 1000.0
+        self.pool = ThreadPoolExecutor(num_instances)
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.results = {}
+        self.next_id = 0
+
+    def _infer(self, inputs, batch_size):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        seq_length = len(inputs['input__0'][0])
+        with self.lock:
+            logits = self.random.standard_normal([2, batch_size, seq_length]).astype(np.float32)
+        return {'output__0': list(logits[0]), 'output__1': list(logits[1])}
+
+    def run(self, inputs, outputs, batch_size=1):
+        return self._infer(inputs, batch_size)
+
+    def async_run(self, callback, inputs, outputs, batch_size=1):
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+
+        def done(future):
+            with self.lock:
+                self.results[request_id] = future.result()
+            callback(self, request_id)
+
+        self.pool.submit(self._infer, inputs, batch_size).add_done_callback(done)
+        return request_id
+
+    def get_async_run_results(self, request_id):
+        with self.lock:
+            return self.results.pop(request_id)
+
+
+class ResultCollector(object):
+    """
+    Keeps the logits of answered batches as numpy views and bounds the requests in flight.
+
+    `acquire` blocks while `max_in_flight` requests are outstanding, `wait` until all
+    are answered.
+    """
+
+    def __init__(self, max_in_flight, progress):
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Condition()
+        self.outstanding = 0
+        self.progress = progress
+        self.results = []
+        self.latencies = []
+        self.error = None
+
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            self.outstanding += 1
+
+    def add(self, batch_info, result):
+        latency = time.time() - batch_info.start_time
+        for i in range(batch_info.batch_size):
+            self.results.append(RawResult(unique_id=int(batch_info.unique_ids[i]),
+                                          start_logits=result["output__0"][i].reshape(-1),
+                                          end_logits=result["output__1"][i].reshape(-1)))
+        self.latencies.append(latency)
+        self.progress.update(n=batch_info.batch_size)
+
+    def callback(self, batch_info, ctx, request_id):
+        try:
+            result = ctx.get_async_run_results(request_id)
+            with self.lock:
+                self.add(batch_info, result)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                self.lock.notify_all()
+            self.slots.release()
+
+    def wait(self):
+        with self.lock:
+            while self.outstanding > 0:
+                self.lock.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action="store_true", required=False, default=False,
                         help='Enable verbose output')
@@ -60,7 +185,16 @@ if __name__ == '__main__':
                         help='HTTP headers to add to inference server requests. ' +
                         'Format is -H"Header:Value".')
     parser.add_argument('--synchronous', action='store_true', help="Wait for previous request to finish before sending next request.")
-    
+    parser.add_argument('--max_in_flight', default=16, type=int,
+                        help="Maximum number of asynchronous requests sent but not answered yet")
+    parser.add_argument('--mock_server', action='store_true',
+                        help="Answer requests with random logits in process instead of sending them to a server, "
+                             "to benchmark the client itself")
+    parser.add_argument('--mock_latency_ms', default=0.0, type=float,
+                        help="Latency of a request answered by --mock_server")
+    parser.add_argument('--mock_instances', default=1, type=int,
+                        help="Number of requests --mock_server answers concurrently")
+
     parser.add_argument("--model_name",
                         type=str,
                         default='bert',
@@ -101,180 +235,110 @@ if __name__ == '__main__':
     parser.add_argument("--max_answer_length", default=30, type=int,
                         help="The maximum length of an answer that can be generated. This is needed because the start "
                              "and end predictions are not conditioned on one another.")
-    
-    args = parser.parse_args()
-    
+    parser.add_argument("--cache_dir", default=None, type=str,
+                        help="Where to cache the features, next to the predict file by default")
+    parser.add_argument("--skip_cache", action='store_true',
+                        help="Whether to convert the features without reading or writing the cache")
+    parser.add_argument("--n_processes", default=os.cpu_count(), type=int,
+                        help="Number of processes converting examples to features")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
     # TRITON client setup
-    protocol = ProtocolType.from_str(args.protocol)
-    
-    model_version = -1
-    infer_ctx = InferContext(args.url, protocol, args.model_name, model_version,
-                             http_headers=args.http_headers, verbose=args.verbose)
-    
+    if args.mock_server:
+        infer_ctx = MockInferContext(args.mock_latency_ms, args.mock_instances)
+    else:
+        if InferContext is None:
+            raise ImportError("the tensorrtserver client library is required unless --mock_server is given")
+        protocol = ProtocolType.from_str(args.protocol)
+        model_version = -1
+        infer_ctx = InferContext(args.url, protocol, args.model_name, model_version,
+                                 http_headers=args.http_headers, verbose=args.verbose)
+
     # Preprocess input data
     tokenizer = BertTokenizer(args.vocab_file, do_lower_case=args.do_lower_case, max_len=512) # for bert large
-    cached_features_file = args.predict_file + '_{}_{}.bin'.format(args.max_seq_length, args.doc_stride)
 
     eval_examples = read_squad_examples(
         input_file=args.predict_file,
         is_training=False,
         version_2_with_negative=args.version_2_with_negative)
+    eval_arrays = load_or_convert_features(args.predict_file, eval_examples, tokenizer, args, is_training=False)
+    eval_features = arrays_to_features(eval_arrays, tokenizer)
+    num_features = len(eval_features)
+    inputs = pack_inputs(eval_arrays)
+    unique_ids = np.asarray(eval_arrays['unique_ids'])
+
+    sent_prog = tqdm(desc="Sending Requests", total=num_features, file=sys.stdout, unit='sentences')
+    recv_prog = tqdm(desc="Processed Requests", total=num_features, file=sys.stdout, unit='sentences')
+    collector = ResultCollector(args.max_in_flight, recv_prog)
+    outputs_dict = {'output__0': 'RAW', 'output__1': 'RAW'} if args.mock_server else \
+        {'output__0': InferContext.ResultFormat.RAW, 'output__1': InferContext.ResultFormat.RAW}
 
-    try:
-        with open(cached_features_file, "rb") as reader:
-            eval_features = pickle.load(reader)
-    except:
-        eval_features = convert_examples_to_features(
-            examples=eval_examples,
-            tokenizer=tokenizer,
-            max_seq_length=args.max_seq_length,
-            doc_stride=args.doc_stride,
-            max_query_length=args.max_query_length,
-            is_training=False)
-        with open(cached_features_file, "wb") as writer:
-            pickle.dump(eval_features, writer)
-    
-    dtype = np.int64
-    
-    
-    def batch(iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            unique_ids = ()
-            example_indices = ()
-            input_ids_data = ()
-            input_mask_data = ()
-            segment_ids_data = ()
-            for i in range(0, min(n, l-ndx)):
-                unique_ids = unique_ids + (iterable[ndx + i].unique_id,)
-                example_indices = example_indices + (ndx + i,)
-                input_ids_data = input_ids_data + (np.array(iterable[ndx + i].input_ids, dtype=dtype),)
-                input_mask_data = input_mask_data + (np.array(iterable[ndx + i].input_mask, dtype=dtype),)
-                segment_ids_data = segment_ids_data + (np.array(iterable[ndx + i].segment_ids, dtype=dtype),)
-            
-            inputs_dict = {'input__0': input_ids_data,
-                           'input__1': segment_ids_data,
-                           'input__2': input_mask_data}
-            yield inputs_dict, example_indices, unique_ids
-    
-    
-    RawResult = collections.namedtuple("RawResult",
-                                       ["unique_id", "start_logits", "end_logits"])
-    ExampleInfo = collections.namedtuple("ExampleInfo",
-                                   ["start_time", "batch_size", "example_ids", "unique_ids"])
-    all_results = []
-    time_list = []
-    outstanding = 0
-    sent_prog = tqdm(desc="Sending Requests", total=len(eval_features), file=sys.stdout, unit='sentences')
-    recv_prog = tqdm(desc="Processed Requests", total=len(eval_features), file=sys.stdout, unit='sentences')
-    if args.synchronous:
-        raw_results = []
-    
-    
-    def process_result_cb(example_info, ctx, request_id):
-        global outstanding
-        
-        result = infer_ctx.get_async_run_results(request_id)
-        stop = time.time()
-        outstanding -= 1
-        
-        time_list.append(stop - example_info.start_time)
-        
-        batch_count = example_info.batch_size
-        
-        for i in range(batch_count):
-            unique_id = int(example_info.unique_ids[i])
-            start_logits = [float(x) for x in result["output__0"][i].flat]
-            end_logits = [float(x) for x in result["output__1"][i].flat]
-            all_results.append(
-                RawResult(
-                    unique_id=unique_id,
-                    start_logits=start_logits,
-                    end_logits=end_logits))
-        
-        recv_prog.update(n=batch_count)
-    
-    
     all_results_start = time.time()
-    
-    for input_dict, example_indices, unique_ids in batch(eval_features, args.batch_size):
-        current_bs = len(input_dict['input__0'])
-        outputs_dict = {'output__0': InferContext.ResultFormat.RAW,
-                        'output__1': InferContext.ResultFormat.RAW}
-        start = time.time()
-        example_info = ExampleInfo(start_time=start,
-                                   batch_size=current_bs,
-                                   example_ids=example_indices,
-                                   unique_ids=unique_ids
-                                   )
-        if not args.synchronous:
-            outstanding += 1
-            result_id = infer_ctx.async_run(partial(process_result_cb, example_info),
-                                                    input_dict,
-                                                    outputs_dict,
-                                                    batch_size=current_bs)
-        else:
+
+    for input_dict, start, batch_unique_ids in batches(inputs, unique_ids, args.batch_size):
+        current_bs = len(batch_unique_ids)
+        if args.synchronous:
+            batch_info = BatchInfo(start_time=time.time(), batch_size=current_bs, start=start,
+                                   unique_ids=batch_unique_ids)
             result = infer_ctx.run(input_dict, outputs_dict, batch_size=current_bs)
-            raw_results.append((example_info, result))
+            collector.add(batch_info, result)
+        else:
+            # blocks while max_in_flight requests are outstanding
+            collector.acquire()
+            batch_info = BatchInfo(start_time=time.time(), batch_size=current_bs, start=start,
+                                   unique_ids=batch_unique_ids)
+            infer_ctx.async_run(partial(collector.callback, batch_info),
+                                input_dict,
+                                outputs_dict,
+                                batch_size=current_bs)
         sent_prog.update(n=current_bs)
-    
+
     # Make sure that all sent requests have been processed
-    while outstanding > 0:
-        pass
-    
+    collector.wait()
+
     all_results_end = time.time()
     all_results_total = (all_results_end - all_results_start) * 1000.0
-    num_batches = (len(eval_features) + args.batch_size - 1) // args.batch_size
-    
-    if args.synchronous:
-        for result in raw_results:
-            example_info, batch = result
-            for i in range(example_info.batch_size): 
-                unique_id = int(example_info.unique_ids[i])
-                start_logits = [float(x) for x in batch["output__0"][i].flat]
-                end_logits = [float(x) for x in batch["output__1"][i].flat]
-                all_results.append(
-                    RawResult(
-                        unique_id=unique_id,
-                        start_logits=start_logits,
-                        end_logits=end_logits))
-            recv_prog.update(n=example_info.batch_size)
-    
+    num_batches = (num_features + args.batch_size - 1) // args.batch_size
+    time_list = np.array(collector.latencies)
+
     print("-----------------------------")
     print("Individual Time Runs")
     print("Total Time: {} ms".format(all_results_total))
     print("-----------------------------")
-    
+
     print("-----------------------------")
     print("Total Inference Time = %0.2f for"
-          "Sentences processed = %d" % (sum(time_list), len(eval_features)))
-    print("Throughput Average (sentences/sec) = %0.2f" % (len(eval_features) / all_results_total * 1000.0))
+          "Sentences processed = %d" % (time_list.sum(), num_features))
+    print("Throughput Average (sentences/sec) = %0.2f" % (num_features / all_results_total * 1000.0))
     print("Throughput Average (batches/sec) = %0.2f" % (num_batches / all_results_total * 1000.0))
     print("-----------------------------")
-    
-    if not args.synchronous:
-        time_list.sort()
-        
-        avg = np.mean(time_list)
-        cf_95 = max(time_list[:int(len(time_list) * 0.95)])
-        cf_99 = max(time_list[:int(len(time_list) * 0.99)])
-        cf_100 = max(time_list[:int(len(time_list) * 1)])
+
+    if len(time_list) > 0:
         print("-----------------------------")
         print("Summary Statistics")
         print("Batch size =", args.batch_size)
         print("Sequence Length =", args.max_seq_length)
-        print("Latency Confidence Level 95 (ms) =", cf_95 * 1000)
-        print("Latency Confidence Level 99 (ms)  =", cf_99 * 1000)
-        print("Latency Confidence Level 100 (ms)  =", cf_100 * 1000)
-        print("Latency Average (ms)  =", avg * 1000)
+        print("Requests in flight =", 1 if args.synchronous else args.max_in_flight)
+        print("Latency Confidence Level 95 (ms) =", np.percentile(time_list, 95) * 1000)
+        print("Latency Confidence Level 99 (ms)  =", np.percentile(time_list, 99) * 1000)
+        print("Latency Confidence Level 100 (ms)  =", time_list.max() * 1000)
+        print("Latency Average (ms)  =", time_list.mean() * 1000)
         print("-----------------------------")
-    
+
+    postprocess_start = time.time()
     output_prediction_file = os.path.join(args.output_dir, "predictions.json")
     output_nbest_file = os.path.join(args.output_dir, "nbest_predictions.json")
-    output_null_log_odds_file = os.path.join(args.output_dir, "null_odds.json")
-    answers, nbest_answers = get_answers(eval_examples, eval_features, all_results, args)
+    answers, nbest_answers = get_answers(eval_examples, eval_features, collector.results, args, eval_arrays)
+    print("Post-processing Time = %0.2f ms" % ((time.time() - postprocess_start) * 1000.0))
     with open(output_prediction_file, "w") as f:
         f.write(json.dumps(answers, indent=4) + "\n")
     with open(output_nbest_file, "w") as f:
         f.write(json.dumps(nbest_answers, indent=4) + "\n")
 
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Standalone throughput benchmark for torchvision image models.
+
+Runs forward (inference) and forward/backward/step (train) loops over synthetic
+or real ImageNet data for every combination of the requested archs, memory
+formats, AMP settings, batch sizes and compilers, and reports images/sec and
+peak memory. Works on CPU (AMP uses bfloat16 there) so regressions can be
+checked without GPUs, e.g.
+
+    python benchmark.py --device cpu -a resnet18 -b 8 16 --iters 5
+    python benchmark.py -a resnet50 --memory-format channels_last contiguous --amp on off -b 64 128 256
+    python benchmark.py -a resnet50 --data /data/imagenet --compile none jit compile --csv bench.csv
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import resource
+import time
+
+import torch
+import torch.nn as nn
+import torchvision.datasets as datasets
+import torchvision.models as models
+
+from shm_loader import SharedMemoryLoader
+
+if hasattr(models, 'list_models'):
+    # classification models only, without helpers like get_model or list_models
+    model_names = sorted(models.list_models(module=models))
+else:
+    model_names = sorted(name for name in models.__dict__
+                         if name.islower() and not name.startswith("__")
+                         and callable(models.__dict__[name]))
+
+MEMORY_FORMATS = {
+    'contiguous': torch.contiguous_format,
+    'channels_last': torch.channels_last,
+}
+
+RESULT_FIELDS = ['arch', 'mode', 'data', 'device', 'memory_format', 'amp', 'compile', 'batch_size',
+                 'images_per_sec', 'ms_per_batch', 'peak_mem_mb']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='ResNet/torchvision throughput benchmark')
+    parser.add_argument('-a', '--arch', metavar='ARCH', nargs='+', default=['resnet50'],
+                        help='model architectures, "all" for every one of: ' + ' | '.join(model_names) +
+                        ' (default: resnet50)')
+    parser.add_argument('--data', metavar='DIR', default=None,
+                        help='ImageNet style folder, train/ is used if present (default: synthetic data)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        choices=['cpu', 'cuda'], help='device to benchmark on')
+    parser.add_argument('--mode', nargs='+', default=['train', 'inference'], choices=['train', 'inference'],
+                        help='forward/backward/step loop, forward only loop or both')
+    parser.add_argument('-b', '--batch-size', nargs='+', type=int, default=[64], dest='batch_sizes',
+                        help='batch sizes to sweep')
+    parser.add_argument('--memory-format', nargs='+', default=['channels_last', 'contiguous'],
+                        choices=list(MEMORY_FORMATS), dest='memory_formats', help='memory formats to sweep')
+    parser.add_argument('--amp', nargs='+', default=['on', 'off'], choices=['on', 'off'],
+                        help='automatic mixed precision settings to sweep (bfloat16 on CPU)')
+    parser.add_argument('--compile', nargs='+', default=['none'], choices=['none', 'jit', 'compile'],
+                        dest='compilers', help='torch.jit.trace and/or torch.compile the model')
+    parser.add_argument('--image-size', default=224, type=int, help='crop size')
+    parser.add_argument('--warmup', default=5, type=int, help='untimed iterations per config')
+    parser.add_argument('--iters', default=20, type=int, help='timed iterations per config')
+    parser.add_argument('-j', '--workers', default=4, type=int, help='decode workers for --data')
+    parser.add_argument('--csv', default=None, help='also write the results to this csv file')
+    args = parser.parse_args()
+    if args.arch == ['all']:
+        args.arch = model_names
+    for arch in args.arch:
+        if arch not in model_names:
+            parser.error("unknown arch {}".format(arch))
+    if args.device == 'cuda' and not torch.cuda.is_available():
+        parser.error("--device cuda requested but CUDA is not available")
+    return args
+
+
+class SyntheticBatches(object):
+    """The same uint8 batch every iteration, generated once on the device"""
+
+    def __init__(self, batch_size, image_size, device, memory_format):
+        self.images = torch.randint(0, 256, (batch_size, 3, image_size, image_size), dtype=torch.uint8,
+                                    device=device).contiguous(memory_format=memory_format)
+        self.target = torch.randint(0, 1000, (batch_size,), device=device)
+
+    def __iter__(self):
+        while True:
+            yield self.images, self.target
+
+
+class RealBatches(object):
+    """Decoded/augmented batches from the shared-memory loader, restarted when exhausted"""
+
+    def __init__(self, samples, batch_size, image_size, device, memory_format, workers):
+        self.loader = SharedMemoryLoader(samples, batch_size, num_workers=workers, crop_size=image_size,
+                                         train=True, memory_format=memory_format)
+        self.device = device
+
+    def __iter__(self):
+        while True:
+            for images, target in self.loader:
+                yield (images.to(self.device, non_blocking=True),
+                       target.to(self.device, non_blocking=True))
+
+    def shutdown(self):
+        self.loader.shutdown()
+
+
+class Normalize(nn.Module):
+    """uint8 -> normalized float on device, same constants as ``data_prefetcher`` in the trainers"""
+
+    def __init__(self):
+        super(Normalize, self).__init__()
+        self.register_buffer('mean', torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        return (images.float() - self.mean) / self.std
+
+
+def reset_peak_memory(device):
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        return
+    # resets the peak RSS (VmHWM) of the process on linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb(device):
+    """
+    Peak memory since ``reset_peak_memory``. On CPUs without a resettable
+    VmHWM this is the peak RSS of the whole process so far, which later
+    configs only report if they exceed it.
+    """
+    if device == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synchronize(device):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def build_model(arch, device, memory_format, compiler, example, train):
+    model = models.__dict__[arch]()
+    model = model.to(device).to(memory_format=memory_format)
+    model.train(train)
+    if compiler == 'jit':
+        model = torch.jit.trace(model, example, check_trace=False)
+        if not train and hasattr(torch.jit, 'freeze'):
+            model = torch.jit.freeze(model)
+    elif compiler == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError("torch.compile requires PyTorch 2.0 or newer")
+        model = torch.compile(model)
+    return model
+
+
+def run_config(args, arch, mode, batch_size, memory_format_name, amp, compiler, samples):
+    device = args.device
+    memory_format = MEMORY_FORMATS[memory_format_name]
+    train = mode == 'train'
+    amp_dtype = torch.float16 if device == 'cuda' else torch.bfloat16
+
+    if samples is not None:
+        batches = RealBatches(samples, batch_size, args.image_size, device, memory_format, args.workers)
+    else:
+        batches = SyntheticBatches(batch_size, args.image_size, device, memory_format)
+    normalize = Normalize().to(device)
+    batch_iter = iter(batches)
+    images, _ = next(batch_iter)
+    example = normalize(images).contiguous(memory_format=memory_format)
+
+    reset_peak_memory(device)
+    model = build_model(arch, device, memory_format, compiler, example, train)
+    criterion = nn.CrossEntropyLoss().to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9) if train else None
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and device == 'cuda')
+
+    def step():
+        images, target = next(batch_iter)
+        with torch.autocast(device_type=device, dtype=amp_dtype, enabled=amp):
+            if train:
+                output = model(normalize(images))
+                if isinstance(output, tuple):
+                    # inception/googlenet return aux logits in train mode
+                    output = output[0]
+                loss = criterion(output, target)
+            else:
+                with torch.no_grad():
+                    model(normalize(images))
+        if train:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            for param in model.parameters():
+                param.grad = None
+
+    try:
+        for _ in range(args.warmup):
+            step()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            step()
+        synchronize(device)
+        elapsed = time.perf_counter() - start
+    finally:
+        if samples is not None:
+            batches.shutdown()
+
+    return {
+        'arch': arch,
+        'mode': mode,
+        'data': 'real' if samples is not None else 'synthetic',
+        'device': device,
+        'memory_format': memory_format_name,
+        'amp': amp,
+        'compile': compiler,
+        'batch_size': batch_size,
+        'images_per_sec': round(batch_size * args.iters / elapsed, 2),
+        'ms_per_batch': round(1000. * elapsed / args.iters, 3),
+        'peak_mem_mb': round(peak_memory_mb(device), 1),
+    }
+
+
+def main():
+    args = parse_arguments()
+    torch.backends.cudnn.benchmark = True
+
+    samples = None
+    if args.data is not None:
+        data_dir = os.path.join(args.data, 'train')
+        if not os.path.isdir(data_dir):
+            data_dir = args.data
+        samples = datasets.ImageFolder(data_dir).samples
+
+    print(' '.join('{:>14}'.format(f) for f in RESULT_FIELDS))
+    results = []
+    configs = itertools.product(args.arch, args.mode, args.batch_sizes, args.memory_formats,
+                                [a == 'on' for a in args.amp], args.compilers)
+    for arch, mode, batch_size, memory_format, amp, compiler in configs:
+        try:
+            result = run_config(args, arch, mode, batch_size, memory_format, amp, compiler, samples)
+        except Exception as e:
+            # e.g. OOM at large batch sizes or an arch that cannot be traced, keep sweeping
+            message = (str(e).splitlines() or [type(e).__name__])[0]
+            print("skipping {} {} bs={} {} amp={} {}: {}".format(arch, mode, batch_size, memory_format, amp,
+                                                              compiler, message))
+            if args.device == 'cuda':
+                torch.cuda.empty_cache()
+            continue
+        results.append(result)
+        print(' '.join('{:>14}'.format(str(result[f])) for f in RESULT_FIELDS), flush=True)
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as f:
+            csv_writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            csv_writer.writeheader()
+            csv_writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()
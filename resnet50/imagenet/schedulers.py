@@ -0,0 +1,117 @@
+"""
+Learning rate schedules driven by scale invariant steps.
+
+With AdaScale every optimizer step advances training by
+``optimizer.scale_invariant_steps()`` scale-one steps, which is fractional. The
+scheduler consumes that increment as is, looks the LR up in a table precomputed
+over scale-one steps and only writes ``param_groups`` when the LR changes.
+"""
+
+import math
+
+import numpy as np
+
+SCHEDULES = ('step', 'linear', 'cosine', 'poly')
+
+
+class ScaleInvariantLR(object):
+    """
+    Args:
+        optimizer: optimizer (or AdaScale wrapper) whose param groups get the LR
+        schedule: one of 'step', 'linear', 'cosine' or 'poly'
+        base_lr: peak learning rate, reached at the end of warmup
+        total_steps: length of the schedule in scale-one steps
+        warmup_steps: linear warmup from 0 to ``base_lr`` over this many steps
+        milestones: ('step' only) steps at which the LR is multiplied by ``gamma``
+        gamma: ('step' only) decay factor
+        power: ('poly' only) decay exponent
+        min_lr: LR at the end of a 'linear', 'cosine' or 'poly' decay
+    """
+
+    def __init__(self,
+                 optimizer,
+                 schedule,
+                 base_lr,
+                 total_steps,
+                 warmup_steps=0,
+                 milestones=(),
+                 gamma=0.1,
+                 power=2.0,
+                 min_lr=0.0):
+        if schedule not in SCHEDULES:
+            raise ValueError("Unknown LR schedule {}, expected one of {}".format(schedule, SCHEDULES))
+        self.optimizer = optimizer
+        self.schedule = schedule
+        self.base_lr = base_lr
+        self.total_steps = max(int(math.ceil(total_steps)), 1)
+        self.warmup_steps = warmup_steps
+        self.milestones = sorted(milestones)
+        self.gamma = gamma
+        self.power = power
+        self.min_lr = min_lr
+        self.table = self._build_table()
+        self.last_step = 0.0
+        self._last_lr = None
+        self.set_progress(0.0)
+
+    def _build_table(self):
+        steps = np.arange(self.total_steps + 1, dtype=np.float64)
+        if self.schedule == 'step':
+            num_decays = np.searchsorted(np.asarray(self.milestones, dtype=np.float64), steps, side='right')
+            lr = self.base_lr * np.power(self.gamma, num_decays)
+        else:
+            decay_steps = max(self.total_steps - self.warmup_steps, 1)
+            progress = np.clip((steps - self.warmup_steps) / decay_steps, 0.0, 1.0)
+            if self.schedule == 'linear':
+                factor = 1.0 - progress
+            elif self.schedule == 'cosine':
+                factor = 0.5 * (1.0 + np.cos(math.pi * progress))
+            else:
+                factor = np.power(1.0 - progress, self.power)
+            lr = self.min_lr + (self.base_lr - self.min_lr) * factor
+        if self.warmup_steps > 0:
+            warmup = steps < self.warmup_steps
+            lr[warmup] = self.base_lr * steps[warmup] / self.warmup_steps
+        return lr
+
+    def get_lr(self, step=None):
+        """LR at ``step`` scale invariant steps (defaults to the current position)"""
+        step = self.last_step if step is None else step
+        if step >= self.total_steps:
+            return float(self.table[-1])
+        idx = int(step)
+        if self.schedule == 'step':
+            return float(self.table[idx])
+        # interpolate between table entries for fractional progress
+        frac = step - idx
+        return float(self.table[idx] + frac * (self.table[idx + 1] - self.table[idx]))
+
+    def _apply(self, force=False):
+        lr = self.get_lr()
+        if force or lr != self._last_lr:
+            for param_group in self.optimizer.param_groups:
+                param_group['lr'] = lr
+            self._last_lr = lr
+
+    def step(self, si_steps=1.0):
+        """Advance by ``si_steps`` scale invariant steps (fractional with AdaScale)"""
+        self.last_step += float(si_steps)
+        self._apply()
+
+    def set_progress(self, step):
+        """Jump to an absolute position, e.g. the start of an epoch"""
+        self.last_step = float(step)
+        self._apply(force=True)
+
+    def state_dict(self):
+        return {
+            'last_step': self.last_step,
+            'schedule': self.schedule,
+            'base_lr': self.base_lr,
+            'total_steps': self.total_steps,
+        }
+
+    def load_state_dict(self, state_dict):
+        # only the position is restored, the schedule itself comes from the
+        # current arguments so that it can be changed across restarts
+        self.set_progress(state_dict['last_step'])
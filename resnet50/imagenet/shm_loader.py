@@ -0,0 +1,292 @@
+"""
+DALI-free decode/augment pool for ImageNet style folders.
+
+Worker processes decode JPEGs with PIL, fuse the random-resized-crop (or
+resize + center crop) into a single ``Image.resize(box=...)`` call after a
+decode-time DCT downscale (``Image.draft``) and write the uint8 result straight
+into a shared-memory batch ring. The main process hands out views into the ring
+so no image is ever pickled between processes.
+
+Batches come out as uint8 NCHW tensors (channels-last strides unless a
+contiguous memory format is requested), i.e. the same contract as
+``fast_collate`` so ``data_prefetcher`` consumes them unchanged.
+"""
+
+import math
+import random
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from PIL import Image
+
+
+def random_resized_crop_box(width, height, rng, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+    """Same sampling as ``transforms.RandomResizedCrop.get_params``, returns (left, top, right, bottom)"""
+    area = height * width
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+    for _ in range(10):
+        target_area = area * rng.uniform(scale[0], scale[1])
+        aspect_ratio = math.exp(rng.uniform(log_ratio[0], log_ratio[1]))
+        w = int(round(math.sqrt(target_area * aspect_ratio)))
+        h = int(round(math.sqrt(target_area / aspect_ratio)))
+        if 0 < w <= width and 0 < h <= height:
+            left = rng.randint(0, width - w)
+            top = rng.randint(0, height - h)
+            return left, top, left + w, top + h
+
+    # fallback to central crop
+    in_ratio = float(width) / float(height)
+    if in_ratio < min(ratio):
+        w = width
+        h = int(round(w / min(ratio)))
+    elif in_ratio > max(ratio):
+        h = height
+        w = int(round(h * max(ratio)))
+    else:
+        w = width
+        h = height
+    left = (width - w) // 2
+    top = (height - h) // 2
+    return left, top, left + w, top + h
+
+
+def center_crop_box(width, height, resize_size, crop_size):
+    """Box in original coordinates equivalent to ``Resize(resize_size)`` followed by ``CenterCrop(crop_size)``"""
+    scale = resize_size / min(width, height)
+    crop = crop_size / scale
+    left = (width - crop) / 2.
+    top = (height - crop) / 2.
+    return left, top, left + crop, top + crop
+
+
+def decode_crop_resize(path, crop_size, rng=None, resize_size=256):
+    """
+    Decodes ``path`` and returns a (crop_size, crop_size, 3) uint8 array.
+
+    With ``rng`` a random resized crop and horizontal flip are applied (train),
+    otherwise resize to ``resize_size`` then center crop (val).
+    """
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        # header only at this point, size is known before decoding
+        width, height = img.size
+        if rng is not None:
+            box = random_resized_crop_box(width, height, rng)
+        else:
+            box = center_crop_box(width, height, resize_size, crop_size)
+        # ask the JPEG decoder for the smallest DCT scale that still leaves the
+        # crop at least crop_size pixels wide/high
+        box_w, box_h = box[2] - box[0], box[3] - box[1]
+        img.draft('RGB', (int(math.ceil(width * crop_size / box_w)),
+                          int(math.ceil(height * crop_size / box_h))))
+        img = img.convert('RGB')
+    sx = img.size[0] / width
+    sy = img.size[1] / height
+    box = (box[0] * sx, box[1] * sy, box[2] * sx, box[3] * sy)
+    img = img.resize((crop_size, crop_size), Image.BILINEAR, box=box)
+    arr = np.asarray(img, dtype=np.uint8)
+    if rng is not None and rng.random() < 0.5:
+        arr = arr[:, ::-1]
+    return arr
+
+
+def rank_seed(seed, rank, num_workers):
+    """
+    Base seed of the loader of ``rank``, its workers take the next ``num_workers``
+    seeds so no two workers of the data parallel group share a stream. Without a
+    ``seed`` (no --seed) the torch seed of the process is used, as DataLoader does.
+    """
+    if seed is None:
+        seed = torch.initial_seed()
+    return (seed + rank * max(1, num_workers)) % 2 ** 32
+
+
+def worker_seed(seed, worker_id, epoch):
+    """Seed of the crops and flips of a decode worker in an epoch"""
+    return (seed + worker_id + 1000003 * epoch) % 2 ** 32
+
+
+def _worker_loop(worker_id, samples, images, targets, task_queue, done_queue, crop_size, train, seed):
+    torch.set_num_threads(1)
+    rng = None
+    rng_epoch = None
+    images_np = images.numpy()
+    targets_np = targets.numpy()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        batch_id, slot, indices, epoch = task
+        if train and epoch != rng_epoch:
+            rng = random.Random(worker_seed(seed, worker_id, epoch))
+            rng_epoch = epoch
+        try:
+            for j, idx in enumerate(indices):
+                path, target = samples[idx]
+                images_np[slot, j] = decode_crop_resize(path, crop_size, rng)
+                targets_np[slot, j] = target
+            done_queue.put((batch_id, slot, len(indices), None))
+        except Exception:
+            done_queue.put((batch_id, slot, 0, traceback.format_exc()))
+
+
+class SharedMemoryLoader(object):
+    """
+    Drop in replacement for the ImageNet ``DataLoader`` + ``fast_collate`` pair.
+
+    Args:
+        samples: list of (path, class_index), e.g. ``ImageFolder.samples``
+        batch_size: images per batch (per worker process of training)
+        sampler: index sampler, ``set_epoch`` is called on it by the trainer as usual
+        num_workers: decode processes
+        prefetch_factor: batches in flight per worker, ring has
+            ``num_workers * prefetch_factor`` slots
+        train: random resized crop + flip when True, resize + center crop otherwise
+        seed: base seed of the crops and flips, pass a different one per rank
+            (e.g. ``args.seed + rank * num_workers``) and call ``set_epoch`` every
+            epoch so that ranks and epochs do not repeat the same augmentations
+    """
+
+    def __init__(self,
+                 samples,
+                 batch_size,
+                 sampler=None,
+                 num_workers=4,
+                 prefetch_factor=2,
+                 crop_size=224,
+                 train=True,
+                 memory_format=torch.contiguous_format,
+                 seed=0):
+        self.samples = samples
+        self.batch_size = batch_size
+        self.sampler = sampler if sampler is not None else torch.utils.data.RandomSampler(samples)
+        self.num_workers = max(1, num_workers)
+        self.num_slots = self.num_workers * prefetch_factor
+        self.crop_size = crop_size
+        self.train = train
+        self.memory_format = memory_format
+        self.seed = seed
+        self.epoch = 0
+        # NHWC ring, a permuted view of one slot is a channels-last NCHW batch
+        self.images = torch.empty((self.num_slots, batch_size, crop_size, crop_size, 3),
+                                  dtype=torch.uint8).share_memory_()
+        self.targets = torch.empty((self.num_slots, batch_size), dtype=torch.int64).share_memory_()
+        self._workers = None
+        self._iterator = None
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _start_workers(self):
+        self._task_queue = mp.Queue()
+        self._done_queue = mp.Queue()
+        self._workers = []
+        for worker_id in range(self.num_workers):
+            w = mp.Process(target=_worker_loop,
+                           args=(worker_id, self.samples, self.images, self.targets,
+                                 self._task_queue, self._done_queue,
+                                 self.crop_size, self.train, self.seed))
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+
+    def __iter__(self):
+        if self._workers is None:
+            self._start_workers()
+        if self._iterator is not None:
+            # training loop may stop mid epoch, collect what is still in flight
+            self._iterator._drain()
+        self._iterator = _SharedMemoryIter(self)
+        return self._iterator
+
+    def shutdown(self):
+        if self._workers is None:
+            return
+        if self._iterator is not None:
+            self._iterator._drain()
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for w in self._workers:
+            w.join(timeout=5)
+        self._workers = None
+
+    def __del__(self):
+        try:
+            self.shutdown()
+        except Exception:
+            pass
+
+
+class _SharedMemoryIter(object):
+    def __init__(self, loader):
+        self.loader = loader
+        self.batches = self._batches(iter(loader.sampler))
+        self.free_slots = list(range(loader.num_slots))
+        self.ready = {}
+        self.in_flight = 0
+        self.next_submit = 0
+        self.next_yield = 0
+        self.held_slot = None
+        self.exhausted = False
+        self._fill()
+
+    def _batches(self, sampler_iter):
+        batch = []
+        for idx in sampler_iter:
+            batch.append(idx)
+            if len(batch) == self.loader.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _fill(self):
+        while self.free_slots and not self.exhausted:
+            indices = next(self.batches, None)
+            if indices is None:
+                self.exhausted = True
+                return
+            slot = self.free_slots.pop()
+            self.loader._task_queue.put((self.next_submit, slot, indices, self.loader.epoch))
+            self.next_submit += 1
+            self.in_flight += 1
+
+    def _drain(self):
+        while self.in_flight:
+            self.loader._done_queue.get()
+            self.in_flight -= 1
+        self.exhausted = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # the previous batch has been copied out (to device or by .contiguous())
+        # by the time the next one is requested, so its slot can be reused
+        if self.held_slot is not None:
+            self.free_slots.append(self.held_slot)
+            self.held_slot = None
+            self._fill()
+        if self.next_yield == self.next_submit and self.exhausted:
+            raise StopIteration
+        while self.next_yield not in self.ready:
+            batch_id, slot, n, error = self.loader._done_queue.get()
+            self.in_flight -= 1
+            if error is not None:
+                self._drain()
+                raise RuntimeError(f"SharedMemoryLoader worker failed:\n{error}")
+            self.ready[batch_id] = (slot, n)
+        slot, n = self.ready.pop(self.next_yield)
+        self.next_yield += 1
+        self.held_slot = slot
+
+        images = self.loader.images[slot, :n].permute(0, 3, 1, 2)
+        if self.loader.memory_format != torch.channels_last:
+            images = images.contiguous(memory_format=self.loader.memory_format)
+        targets = self.loader.targets[slot, :n].clone()
+        return images, targets
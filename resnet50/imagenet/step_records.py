@@ -0,0 +1,173 @@
+"""
+Structured per-step training records and vectorised analytics on top of them.
+
+Trainers append one record per logging step to a ``StepRecordWriter`` which
+writes columnar NumPy ``.npz`` chunks (``steps-<run_id>-<chunk>.npz``) next to
+the tensorboard files. Every (re)start of a job gets a new ``run_id`` so chunks
+from an elastic run that was resized or restarted several times can be loaded
+together with ``StepRecords`` and stitched into one set of curves.
+"""
+
+import glob
+import os
+import re
+import time
+
+import numpy as np
+
+_CHUNK_RE = re.compile(r'steps-(?P<run_id>\d+)-(?P<chunk>\d+)\.npz$')
+
+
+class StepRecordWriter(object):
+    """
+    Buffers records column wise and writes a chunk every ``chunk_size`` records.
+
+    Args:
+        log_dir: directory the chunks are written to
+        chunk_size: records per ``.npz`` chunk
+        run_id: identifies this (re)start of the job, defaults to the start time in ms
+    """
+
+    def __init__(self, log_dir, chunk_size=500, run_id=None):
+        self.log_dir = log_dir
+        self.chunk_size = chunk_size
+        self.run_id = run_id if run_id is not None else int(time.time() * 1000)
+        self._columns = {}
+        self._num_buffered = 0
+        self._chunk = 0
+        os.makedirs(log_dir, exist_ok=True)
+
+    def append(self, **fields):
+        if self._num_buffered == 0:
+            self._columns = {'time': []}
+            self._columns.update({name: [] for name in fields})
+        self._columns['time'].append(time.time())
+        for name, value in fields.items():
+            self._columns[name].append(float(value))
+        self._num_buffered += 1
+        if self._num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        path = os.path.join(self.log_dir, f'steps-{self.run_id}-{self._chunk:06d}.npz')
+        # write then rename so readers never see a partial chunk
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{name: np.asarray(values, dtype=np.float64) for name, values in self._columns.items()})
+        os.rename(tmp_path, path)
+        self._chunk += 1
+        self._num_buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+class StepRecords(object):
+    """
+    Lazily loaded records of one or more runs.
+
+    Chunk files are only listed on construction; a column is read from every
+    chunk (and concatenated) the first time it is accessed. The synthetic
+    ``run`` column holds the index of the (re)start a record belongs to.
+    """
+
+    def __init__(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(glob.glob(os.path.join(path, '**', 'steps-*.npz'), recursive=True))
+            else:
+                files.append(path)
+        chunks = []
+        for f in files:
+            m = _CHUNK_RE.search(os.path.basename(f))
+            if m:
+                chunks.append((int(m.group('run_id')), int(m.group('chunk')), f))
+        chunks.sort()
+        self.files = [f for _, _, f in chunks]
+        run_ids = [run_id for run_id, _, _ in chunks]
+        self._run_of_chunk = np.unique(run_ids, return_inverse=True)[1] if chunks else np.zeros(0, dtype=np.int64)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self['time'])
+
+    @property
+    def columns(self):
+        if not self.files:
+            return []
+        with np.load(self.files[0]) as f:
+            return ['run'] + list(f.files)
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            if name == 'run':
+                lengths = [len(self._load(f, 'time')) for f in self.files]
+                self._cache[name] = np.repeat(self._run_of_chunk, lengths)
+            else:
+                parts = [self._load(f, name) for f in self.files]
+                self._cache[name] = np.concatenate(parts) if parts else np.zeros(0)
+        return self._cache[name]
+
+    @staticmethod
+    def _load(path, name):
+        with np.load(path) as f:
+            if name in f.files:
+                return f[name]
+            return np.full(len(f['time']), np.nan)
+
+
+def dedupe_restarts(records):
+    """
+    Indices of the records to keep, ordered by optimizer step.
+
+    After a restart from checkpoint the steps since that checkpoint are trained
+    (and logged) again, only the latest record of every optimizer step is kept.
+    """
+    steps = records['optimizer_step']
+    order = np.argsort(records['time'], kind='stable')
+    # np.unique returns the first occurrence, search the reversed order to get the last one
+    reversed_order = order[::-1]
+    _, first = np.unique(steps[reversed_order], return_index=True)
+    return reversed_order[first]
+
+
+def training_curves(records):
+    """
+    Curves over the deduplicated records of an arbitrary number of restarts.
+
+    Returns:
+        dict of equal length arrays: optimizer_step, examples (seen so far),
+        si_step, loss, gain, gns and throughput (examples/sec, NaN across restarts)
+    """
+    keep = dedupe_restarts(records)
+    steps = records['optimizer_step'][keep]
+    examples_per_step = records['examples_per_step'][keep]
+    delta_steps = np.diff(steps, prepend=0)
+    examples = np.cumsum(delta_steps * examples_per_step)
+
+    run = records['run'][keep]
+    delta_time = np.diff(records['time'][keep], prepend=np.nan)
+    same_run = np.concatenate([[False], run[1:] == run[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        throughput = np.where(same_run & (delta_time > 0),
+                              delta_steps * examples_per_step / delta_time, np.nan)
+    return {
+        'optimizer_step': steps,
+        'examples': examples,
+        'si_step': records['si_step'][keep],
+        'loss': records['loss'][keep],
+        'gain': records['gain'][keep],
+        'gns': records['gns'][keep],
+        'throughput': throughput,
+    }
+
+
+def write_csv(curves, path):
+    names = list(curves.keys())
+    np.savetxt(path, np.stack([curves[name] for name in names], axis=1),
+               delimiter=',', header=','.join(names), comments='')
@@ -20,6 +20,7 @@ import torchvision.models as models
 from with_replacement_sampler import ReplacementDistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from utils import upload_dir
+from schedulers import ScaleInvariantLR
 
 
 
@@ -186,6 +187,10 @@ def main_worker(gpu, ngpus_per_node, args):
                                 momentum=args.momentum,
                                 weight_decay=args.weight_decay)
 
+    # epoch granular schedule, LR decayed by 10 every 30 epochs
+    lr_scheduler = ScaleInvariantLR(optimizer, 'step', args.lr, total_steps=args.epochs,
+                                    milestones=range(30, args.epochs, 30))
+
     # optionally resume from a checkpoint
     if args.resume:
         if os.path.isfile(args.resume):
@@ -254,7 +259,7 @@ def main_worker(gpu, ngpus_per_node, args):
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
-        adjust_learning_rate(optimizer, epoch, args)
+        lr_scheduler.set_progress(epoch)
 
         # train for one epoch
         train(train_loader, model, criterion, optimizer,
@@ -440,13 +445,6 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
-def adjust_learning_rate(optimizer, epoch, args):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1 ** (epoch // 30))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():
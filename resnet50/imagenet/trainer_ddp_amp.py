@@ -22,7 +22,10 @@ import numpy as np
 import math
 from automl.autoscaler import AdaScale
 from torch.utils.tensorboard import SummaryWriter
-from utils import upload_dir, make_path_if_not_exists
+from shm_loader import SharedMemoryLoader, rank_seed
+from schedulers import ScaleInvariantLR, SCHEDULES
+from step_records import StepRecordWriter
+from utils import upload_dir_async, make_path_if_not_exists, stratified_subset
 
 
 model_names = sorted(name for name in models.__dict__
@@ -160,6 +163,17 @@ def parse_arguments():
                         metavar='N',
                         help='print frequency (default: 10)')
 
+    parser.add_argument('--val-subset-per-class',
+                        default=0,
+                        type=int,
+                        help='if > 0, evaluate on a fixed stratified subset of this many images per class '
+                             'and run the full validation set only at schedule milestones')
+
+    parser.add_argument('--val-freq-si-steps',
+                        default=0,
+                        type=int,
+                        help='if > 0, evaluate on the validation subset every this many scale invariant steps')
+
     parser.add_argument('--resume',
                         default='',
                         type=str,
@@ -177,6 +191,22 @@ def parse_arguments():
                         action='store_true',
                         help='when enabled we replace step decay with linear decay to enable different batch size runs')
 
+    parser.add_argument('--lr-schedule',
+                        default='step',
+                        choices=SCHEDULES,
+                        help='LR schedule over scale invariant steps (default: step)')
+
+    parser.add_argument('--lr-milestones',
+                        default=[30, 60],
+                        type=int,
+                        nargs='+',
+                        help='epochs at which the step schedule decays the LR by 10 (default: 30 60)')
+
+    parser.add_argument('--warmup-epochs',
+                        default=0,
+                        type=float,
+                        help='linear LR warmup length in epochs (default: 0)')
+
 
     parser.add_argument('--pretrained',
                         dest='pretrained',
@@ -218,6 +248,11 @@ def parse_arguments():
                         action="store_true",
                         help="enable channels last for tensor cores")
 
+    parser.add_argument("--shm-loader",
+                        default=False,
+                        action="store_true",
+                        help="decode/augment train images in a worker pool writing to a shared memory batch ring")
+
     parser.add_argument('--log_dir',
                         default='/shared/logs',
                         type=str,
@@ -235,6 +270,11 @@ def parse_arguments():
                         help='s3 bucket for tensorboard')
 
     args = parser.parse_args()
+    if args.val_freq_si_steps > 0 and args.val_subset_per_class <= 0:
+        parser.error('--val-freq-si-steps requires --val-subset-per-class')
+    if args.run_gns_experiment:
+        # GNS experiments compare different batch sizes, decay LR linearly every step
+        args.lr_schedule = 'linear'
 
     if args.autoscaler_cfg:
         args.enable_autoscaler = True
@@ -306,6 +346,8 @@ def main_worker(args):
 
     # tensorboard summary writer (by default created for all workers)
     writer = SummaryWriter(args.tensorboard_path)
+    # structured per-step records (loss, gain, gns, ...) for offline analysis, see process_logs.py
+    step_records = StepRecordWriter(args.tensorboard_path) if get_rank() == 0 else None
 
     # create model
     if args.pretrained:
@@ -397,14 +439,25 @@ def main_worker(args):
     # adjust batch size per worker
     args.batch_size = args.batch_size // (get_world_size() * args.gradient_accumulation_steps)
 
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                               batch_size=args.batch_size,
-                                               shuffle=(train_sampler is None),
-                                               num_workers=args.workers,
-                                               pin_memory=False,
-                                               sampler=train_sampler,
-                                               prefetch_factor=10,
-                                               collate_fn=collate_fn)
+    if args.shm_loader:
+        train_loader = SharedMemoryLoader(train_dataset.samples,
+                                          batch_size=args.batch_size,
+                                          sampler=train_sampler,
+                                          num_workers=args.workers,
+                                          prefetch_factor=10,
+                                          crop_size=224,
+                                          train=True,
+                                          memory_format=memory_format,
+                                          seed=rank_seed(args.seed, get_rank(), args.workers))
+    else:
+        train_loader = torch.utils.data.DataLoader(train_dataset,
+                                                   batch_size=args.batch_size,
+                                                   shuffle=(train_sampler is None),
+                                                   num_workers=args.workers,
+                                                   pin_memory=False,
+                                                   sampler=train_sampler,
+                                                   prefetch_factor=10,
+                                                   collate_fn=collate_fn)
 
     val_loader = torch.utils.data.DataLoader(val_dataset,
                                              batch_size=64, #HARDCODED TO IMAGES PER GPU FIXME args.batch_size,
@@ -415,6 +468,30 @@ def main_worker(args):
                                              prefetch_factor=10,
                                              collate_fn=collate_fn)
 
+    subset_val_loader = None
+    if args.val_subset_per_class > 0:
+        val_subset = torch.utils.data.Subset(val_dataset,
+                                             stratified_subset(val_dataset.samples, args.val_subset_per_class))
+        subset_val_loader = torch.utils.data.DataLoader(val_subset,
+                                                        batch_size=val_loader.batch_size,
+                                                        shuffle=False,
+                                                        num_workers=val_loader.num_workers,
+                                                        pin_memory=val_loader.pin_memory,
+                                                        sampler=torch.utils.data.distributed.DistributedSampler(
+                                                            val_subset, shuffle=False),
+                                                        prefetch_factor=val_loader.prefetch_factor,
+                                                        collate_fn=collate_fn)
+
+    # LR schedule over scale invariant steps, epoch based arguments are converted with the
+    # scale-one steps per epoch which stay the same when the cluster is resized
+    steps_per_epoch = get_scale_one_steps_per_epoch(train_loader, optimizer, args)
+    lr_scheduler = ScaleInvariantLR(optimizer,
+                                    args.lr_schedule,
+                                    args.lr,
+                                    total_steps=args.epochs * steps_per_epoch,
+                                    warmup_steps=args.warmup_epochs * steps_per_epoch,
+                                    milestones=[m * steps_per_epoch for m in args.lr_milestones])
+
     if args.evaluate:
         validate(val_loader, model, criterion, writer, epoch, args)
         writer.close()
@@ -427,18 +504,27 @@ def main_worker(args):
     for epoch in range(args.start_epoch, args.epochs):
         if args.distributed:
             train_sampler.set_epoch(epoch)
-        if not args.run_gns_experiment:
-            adjust_learning_rate(optimizer, epoch, args)
+        if args.shm_loader:
+            train_loader.set_epoch(epoch)
+        # align the schedule with the start of the epoch
+        lr_scheduler.set_progress(epoch * steps_per_epoch)
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, scaler, writer, epoch,
-              args)
-
-        # evaluate on validation set
-        acc1 = validate(val_loader, model, criterion, writer, epoch, args)
-
-        # remember best acc@1 and save checkpoint
-        is_best = acc1 > best_acc1
-        best_acc1 = max(acc1, best_acc1)
+        train(train_loader, model, criterion, optimizer, lr_scheduler, scaler, writer, epoch,
+              args,
+              step_records=step_records,
+              val_loader=subset_val_loader if args.val_freq_si_steps > 0 else None)
+
+        # evaluate on the full validation set at schedule milestones, otherwise on the
+        # fixed subset unless that already runs every few scale invariant steps
+        is_best = False
+        if subset_val_loader is None or is_schedule_milestone(epoch, args):
+            acc1 = validate(val_loader, model, criterion, writer, epoch, args)
+
+            # remember best acc@1 and save checkpoint
+            is_best = acc1 > best_acc1
+            best_acc1 = max(acc1, best_acc1)
+        elif args.val_freq_si_steps == 0:
+            validate(subset_val_loader, model, criterion, writer, epoch, args, tag='TestSubset')
 
         if get_rank() == 0:
             save_checkpoint(
@@ -448,11 +534,14 @@ def main_worker(args):
                     'state_dict': model.state_dict(),
                     'best_acc1': best_acc1,
                     'optimizer': optimizer.state_dict(),
+                    'lr_scheduler': lr_scheduler.state_dict(),
                 },
                 is_best,
                 filename='checkpoint-{}.pth.tar'.format(epoch+1))
     # close summary writer
     writer.close()
+    if step_records is not None:
+        step_records.close()
 
 
 class data_prefetcher():
@@ -514,14 +603,8 @@ class data_prefetcher():
 
 global_step = 0 
 
-def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args):
-    global global_step
-    batch_time = AverageMeter('Time', ':6.3f')
-    data_time = AverageMeter('Data', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
-    
+def get_scale_one_steps_per_epoch(train_loader, optimizer, args):
+    """Number of optimizer steps an epoch takes at scale one (batch size of the autoscaler config)"""
     lr_scale = 1.0
     if args.enable_autoscaler:
         lr_scale = optimizer.scale
@@ -531,6 +614,19 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args
     scale_one_bs = int(args.batch_size * world_size // lr_scale)
 
     scale_one_steps_per_epoch = int(len(train_loader) * args.batch_size // scale_one_bs)
+    return scale_one_steps_per_epoch
+
+
+def train(train_loader, model, criterion, optimizer, lr_scheduler, scaler, writer, epoch, args,
+          step_records=None, val_loader=None):
+    global global_step
+    batch_time = AverageMeter('Time', ':6.3f')
+    data_time = AverageMeter('Data', ':6.3f')
+    losses = AverageMeter('Loss', ':.4e')
+    top1 = AverageMeter('Acc@1', ':6.2f')
+    top5 = AverageMeter('Acc@5', ':6.2f')
+    
+    scale_one_steps_per_epoch = get_scale_one_steps_per_epoch(train_loader, optimizer, args)
 
     progress = ProgressMeter(scale_one_steps_per_epoch,
                              [batch_time, data_time, losses, top1, top5],
@@ -544,7 +640,6 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args
     images, target = prefetcher.next()
     i = 0
     scheduler_progress = 0
-    total_steps = 90 * scale_one_steps_per_epoch
     accumulate_gradients = args.gradient_accumulation_steps > 1
     curr_epoch_step = 0 # only to track grad accumulation related stuff
     while images is not None:
@@ -584,15 +679,19 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args
             scaler.scale(loss).backward()
             # at the last accum step, take one optim step
             if args.enable_autoscaler:
+                si_steps = optimizer.scale_invariant_steps()
                 scheduler_progress = optimizer.get_step_increment()
                 i += scheduler_progress
                 optimizer.step()
             else:
                 i = global_step % (scale_one_steps_per_epoch+1)
                 scheduler_progress = 1
+                si_steps = 1
                 scaler.step(optimizer)
             # update scaler state machine
             scaler.update()
+            # set LR for the next step, fractional scale invariant progress with AdaScale
+            lr_scheduler.step(si_steps)
             # optimizer.zero_grad()
             for param in model.parameters():
                 param.grad = None
@@ -608,9 +707,11 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args
             # NOTE if writing to S3 directly then make sure that write rate is limited else
             # S3 writes will fail and you will lose TB logs
             tensorboard_step = scale_one_steps_per_epoch * epoch + i
-            if args.run_gns_experiment:
-                # if running GNS experiments then adjust LR every step - instead of step decay
-                linear_decay_learning_rate(optimizer, tensorboard_step, total_steps, args)
+            # periodic evaluation on the fixed validation subset
+            if val_loader is not None and tensorboard_step // args.val_freq_si_steps > \
+                    (tensorboard_step - scheduler_progress) // args.val_freq_si_steps:
+                validate(val_loader, model, criterion, writer, tensorboard_step, args, tag='TestSubset')
+                model.train()
 
             if get_rank() == 0:
                 optimizer.log_to_tensorboard(global_step // args.gradient_accumulation_steps)
@@ -625,23 +726,38 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, args
                 gain = optimizer.gain()
                 effective_lr = gain * optimizer.param_groups[0]['lr'] # assuming that all groups have same LR 
                 print("gain={}\ngns={}\nsi_steps={}\neffective lr={}".format(gain, optimizer.gns(), scheduler_progress, effective_lr))
+                if step_records is not None:
+                    step_records.append(
+                        optimizer_step=global_step // args.gradient_accumulation_steps,
+                        si_step=tensorboard_step,
+                        epoch=epoch,
+                        examples_per_step=args.batch_size * get_world_size() * args.gradient_accumulation_steps,
+                        loss=losses.val,
+                        loss_avg=losses.avg,
+                        top1=top1.avg,
+                        gain=gain,
+                        gns=optimizer.gns(),
+                        lr=optimizer.param_groups[0]['lr'],
+                        batch_time=batch_time.val,
+                        world_size=get_world_size())
                 # flush and push to S3 every 500 iterations FIXME: hardcoded
                 if global_step % 500 == 0:
                     writer.flush()
+                    if step_records is not None:
+                        step_records.flush()
         images, target = prefetcher.next()
 
-def validate(val_loader, model, criterion, writer, epoch, args):
+def validate(val_loader, model, criterion, writer, step, args, tag='Test'):
     batch_time = AverageMeter('Time', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
-    progress = ProgressMeter(len(val_loader), [batch_time, losses, top1, top5],
-                             prefix='Test: ')
+    progress = ProgressMeter(len(val_loader), [batch_time], prefix=f'{tag}: ')
 
     # switch to evaluate mode
     model.eval()
     end = time.perf_counter()
 
+    # loss sum, top1 correct, top5 correct and sample count stay on device and
+    # are all-reduced once at the end instead of syncing on every batch
+    totals = torch.zeros(4, device='cuda')
     prefetcher = data_prefetcher(val_loader)
     images, target = prefetcher.next()
     i = 0
@@ -652,11 +768,13 @@ def validate(val_loader, model, criterion, writer, epoch, args):
             output = model(images)
             loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+            # measure accuracy and record loss
+            _, pred = output.topk(5, 1, True, True)
+            correct = pred.eq(target.view(-1, 1))
+            totals[0] += loss.float() * images.size(0)
+            totals[1] += correct[:, :1].sum()
+            totals[2] += correct.sum()
+            totals[3] += images.size(0)
 
         # measure elapsed time
         batch_time.update(time.perf_counter() - end)
@@ -665,20 +783,25 @@ def validate(val_loader, model, criterion, writer, epoch, args):
         if i % args.print_freq == 0:
             progress.display(i)
         images, target = prefetcher.next()
-    # FIXME: REPORT average OVER ALL WORKERS
 
-    # tensorboard update
-    writer.add_scalar('Test/Accuracy_top1', top1.avg, epoch)
-    writer.add_scalar('Test/Accuracy_top5', top5.avg, epoch)
+    # average over all workers
+    if dist.is_initialized():
+        dist.all_reduce(totals)
+    loss_sum, correct1, correct5, count = totals.tolist()
+    count = max(count, 1)
+    top1 = 100. * correct1 / count
+    top5 = 100. * correct5 / count
+
+    # tensorboard update, logs are pushed to S3 in the background
+    writer.add_scalar(f'{tag}/Loss', loss_sum / count, step)
+    writer.add_scalar(f'{tag}/Accuracy_top1', top1, step)
+    writer.add_scalar(f'{tag}/Accuracy_top5', top5, step)
     writer.flush()
-    upload_dir(f'{args.log_dir}/{args.label}', args.bucket,
-               f'{args.arch}/{args.label}')
+    upload_dir_async(f'{args.log_dir}/{args.label}', args.bucket, f'{args.arch}/{args.label}')
 
-    # TODO: this should also be done with the ProgressMeter
-    print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'.format(top1=top1,
-                                                                top5=top5))
+    print(' * {} Acc@1 {:.3f} Acc@5 {:.3f}'.format(tag, top1, top5))
 
-    return top1.avg
+    return top1
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -728,20 +851,11 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
-def adjust_learning_rate(optimizer, epoch, args):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1**(epoch // 30))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
-def linear_decay_learning_rate(optimizer, step, total_steps, args):
-    """ linear decay for GNS comparisons """
-    base_lr = args.lr
-    progress = step / total_steps
-    lr = base_lr * (1.0 - progress)
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+def is_schedule_milestone(epoch, args):
+    """True for the last epoch before a step decay of the LR and for the final epoch"""
+    if args.lr_schedule == 'step' and epoch + 1 in args.lr_milestones:
+        return True
+    return epoch + 1 == args.epochs
 
 
 def accuracy(output, target, topk=(1, )):
@@ -25,7 +25,10 @@ import numpy as np
 from automl.autoscaler import AdaScale
 from automl.optim.adamw import AdamW
 from torch.utils.tensorboard import SummaryWriter
-from utils import upload_dir, make_path_if_not_exists, read_s3_textfile
+from shm_loader import SharedMemoryLoader, rank_seed
+from schedulers import ScaleInvariantLR, SCHEDULES
+from step_records import StepRecordWriter
+from utils import upload_dir_async, make_path_if_not_exists, read_s3_textfile, stratified_subset
 from datetime import timedelta
 
 
@@ -45,12 +48,13 @@ class State:
     current "state" of the worker. This object is mutable.
     """
 
-    def __init__(self, arch, model, optimizer):
+    def __init__(self, arch, model, optimizer, lr_scheduler=None):
         self.epoch = -1
         self.best_acc1 = 0
         self.arch = arch
         self.model = model
         self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
         self.global_step = 0
 
     def capture_snapshot(self):
@@ -69,7 +73,8 @@ class State:
             "arch": self.arch,
             "state_dict": self.model.state_dict(),
             "optimizer": self.optimizer.state_dict(),
-            "global_step": self.global_step
+            "global_step": self.global_step,
+            "lr_scheduler": self.lr_scheduler.state_dict() if self.lr_scheduler else None,
         }
 
     def apply_snapshot(self, obj, device_id):
@@ -84,6 +89,8 @@ class State:
         self.model.load_state_dict(obj["state_dict"])
         self.optimizer.load_state_dict(obj["optimizer"])
         self.global_step = obj["global_step"]
+        if self.lr_scheduler and obj.get("lr_scheduler"):
+            self.lr_scheduler.load_state_dict(obj["lr_scheduler"])
 
     def save(self, f):
         torch.save(self.capture_snapshot(), f)
@@ -230,6 +237,17 @@ def parse_arguments():
                         metavar='N',
                         help='print frequency (default: 10)')
 
+    parser.add_argument('--val-subset-per-class',
+                        default=0,
+                        type=int,
+                        help='if > 0, evaluate on a fixed stratified subset of this many images per class '
+                             'and run the full validation set only at schedule milestones')
+
+    parser.add_argument('--val-freq-si-steps',
+                        default=0,
+                        type=int,
+                        help='if > 0, evaluate on the validation subset every this many scale invariant steps')
+
     parser.add_argument('--ckpt-s3-sync-freq',
                         default=500,
                         type=int,
@@ -251,6 +269,22 @@ def parse_arguments():
                         action='store_true',
                         help='when enabled we replace step decay with linear decay to enable different batch size runs')
 
+    parser.add_argument('--lr-schedule',
+                        default='step',
+                        choices=SCHEDULES,
+                        help='LR schedule over scale invariant steps (default: step)')
+
+    parser.add_argument('--lr-milestones',
+                        default=[30, 60],
+                        type=int,
+                        nargs='+',
+                        help='epochs at which the step schedule decays the LR by 10 (default: 30 60)')
+
+    parser.add_argument('--warmup-epochs',
+                        default=0,
+                        type=float,
+                        help='linear LR warmup length in epochs (default: 0)')
+
     parser.add_argument('--enable-autoscaler',
                         action='store_true',
                         help='when enabled we start measuring gradient stats')
@@ -296,6 +330,11 @@ def parse_arguments():
                         action="store_true",
                         help="enable channels last for tensor cores")
 
+    parser.add_argument("--shm-loader",
+                        default=False,
+                        action="store_true",
+                        help="decode/augment train images in a worker pool writing to a shared memory batch ring")
+
     parser.add_argument('--log_dir',
                         default='/shared/export/logs',
                         type=str,
@@ -318,6 +357,11 @@ def parse_arguments():
                         help="checkpoint file path, to load and save to")
 
     args = parser.parse_args()
+    if args.val_freq_si_steps > 0 and args.val_subset_per_class <= 0:
+        parser.error('--val-freq-si-steps requires --val-subset-per-class')
+    if args.run_gns_experiment:
+        # GNS experiments compare different batch sizes, decay LR linearly every step
+        args.lr_schedule = 'linear'
     args.checkpoint_file = f'/shared/export/elastic/{args.label}/checkpoint.pth.tar'
     # if gradient accumulation file is found in S3 (written by autoscaler service,)
     # then use that file to update accumulation steps else use value passed in args
@@ -415,6 +459,8 @@ def main_worker(args):
 
     # tensorboard summary writer (by default created for all workers)
     writer = SummaryWriter(args.tensorboard_path)
+    # structured per-step records (loss, gain, gns, ...) for offline analysis, see process_logs.py
+    step_records = StepRecordWriter(args.tensorboard_path) if get_rank() == 0 else None
 
     # create model
     if args.pretrained:
@@ -492,14 +538,25 @@ def main_worker(args):
         train_sampler = None
         val_sampler = None
 
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                               batch_size=args.batch_size,
-                                               shuffle=(train_sampler is None),
-                                               num_workers=args.workers,
-                                               pin_memory=True,
-                                               sampler=train_sampler,
-                                               prefetch_factor=2,
-                                               collate_fn=collate_fn)
+    if args.shm_loader:
+        train_loader = SharedMemoryLoader(train_dataset.samples,
+                                          batch_size=args.batch_size,
+                                          sampler=train_sampler,
+                                          num_workers=args.workers,
+                                          prefetch_factor=2,
+                                          crop_size=224,
+                                          train=True,
+                                          memory_format=memory_format,
+                                          seed=rank_seed(args.seed, get_rank(), args.workers))
+    else:
+        train_loader = torch.utils.data.DataLoader(train_dataset,
+                                                   batch_size=args.batch_size,
+                                                   shuffle=(train_sampler is None),
+                                                   num_workers=args.workers,
+                                                   pin_memory=True,
+                                                   sampler=train_sampler,
+                                                   prefetch_factor=2,
+                                                   collate_fn=collate_fn)
 
     val_loader = torch.utils.data.DataLoader(val_dataset,
                                              batch_size=args.batch_size,
@@ -510,6 +567,30 @@ def main_worker(args):
                                              prefetch_factor=2,
                                              collate_fn=collate_fn)
 
+    subset_val_loader = None
+    if args.val_subset_per_class > 0:
+        val_subset = torch.utils.data.Subset(val_dataset,
+                                             stratified_subset(val_dataset.samples, args.val_subset_per_class))
+        subset_val_loader = torch.utils.data.DataLoader(val_subset,
+                                                        batch_size=val_loader.batch_size,
+                                                        shuffle=False,
+                                                        num_workers=val_loader.num_workers,
+                                                        pin_memory=val_loader.pin_memory,
+                                                        sampler=torch.utils.data.distributed.DistributedSampler(
+                                                            val_subset, shuffle=False),
+                                                        prefetch_factor=val_loader.prefetch_factor,
+                                                        collate_fn=collate_fn)
+
+    # LR schedule over scale invariant steps, epoch based arguments are converted with the
+    # scale-one steps per epoch which stay the same when the cluster is resized
+    steps_per_epoch = get_scale_one_steps_per_epoch(train_loader, optimizer, args)
+    lr_scheduler = ScaleInvariantLR(optimizer,
+                                    args.lr_schedule,
+                                    args.lr,
+                                    total_steps=args.epochs * steps_per_epoch,
+                                    warmup_steps=args.warmup_epochs * steps_per_epoch,
+                                    milestones=[m * steps_per_epoch for m in args.lr_milestones])
+
     if args.evaluate:
         validate(val_loader, model, criterion, writer, epoch, args)
         writer.close()
@@ -519,7 +600,7 @@ def main_worker(args):
     args.print_freq = args.print_freq * args.gradient_accumulation_steps
 
     # for elastic we always resume from the latest checkpoint if one exists;
-    state = load_checkpoint(args.checkpoint_file, device_id, args.arch, model, optimizer)
+    state = load_checkpoint(args.checkpoint_file, device_id, args.arch, model, optimizer, lr_scheduler)
 
     start_epoch = state.epoch + 1
     global global_step
@@ -536,19 +617,28 @@ def main_worker(args):
 
         if args.distributed:
             train_sampler.set_epoch(epoch)
+        if args.shm_loader:
+            train_loader.set_epoch(epoch)
 
-        if not args.run_gns_experiment:
-            adjust_learning_rate(optimizer, epoch, args)
+        # align the schedule with the start of the epoch
+        lr_scheduler.set_progress(epoch * steps_per_epoch)
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, scaler, writer, epoch, state, args)
-
-        # evaluate on validation set
-        acc1 = validate(val_loader, model, criterion, writer, epoch, args)
-
-        # remember best acc@1 and save checkpoint
-        is_best = acc1 > state.best_acc1
-        state.best_acc1 = max(acc1, state.best_acc1)
+        train(train_loader, model, criterion, optimizer, lr_scheduler, scaler, writer, epoch, state, args,
+              step_records=step_records,
+              val_loader=subset_val_loader if args.val_freq_si_steps > 0 else None)
+
+        # evaluate on the full validation set at schedule milestones, otherwise on the
+        # fixed subset unless that already runs every few scale invariant steps
+        is_best = False
+        if subset_val_loader is None or is_schedule_milestone(epoch, args):
+            acc1 = validate(val_loader, model, criterion, writer, epoch, args)
+
+            # remember best acc@1 and save checkpoint
+            is_best = acc1 > state.best_acc1
+            state.best_acc1 = max(acc1, state.best_acc1)
+        elif args.val_freq_si_steps == 0:
+            validate(subset_val_loader, model, criterion, writer, epoch, args, tag='TestSubset')
 
         if get_rank() == 0:
             save_checkpoint(state, is_best, args.checkpoint_file)
@@ -559,6 +649,8 @@ def main_worker(args):
 
     # close summary writer
     writer.close()
+    if step_records is not None:
+        step_records.close()
 
 
 class data_prefetcher():
@@ -614,7 +706,19 @@ class data_prefetcher():
         return input, target
 
 
-def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, state, args):
+def get_scale_one_steps_per_epoch(train_loader, optimizer, args):
+    """Number of optimizer steps an epoch takes at scale one (batch size of the autoscaler config)"""
+    effective_world_size = get_world_size() * args.gradient_accumulation_steps
+    scale_one_gbs = int(args.batch_size * effective_world_size // optimizer.scale)
+    # SAMPLING WITH REPLACEMENT
+    # scale_one_steps_per_epoch = int(len(train_loader) * args.batch_size // scale_one_gbs)
+    scale_one_ws = scale_one_gbs // args.batch_size
+    scale_one_steps_per_epoch = int(len(train_loader) * get_world_size() // scale_one_ws)
+    return scale_one_steps_per_epoch
+
+
+def train(train_loader, model, criterion, optimizer, lr_scheduler, scaler, writer, epoch, state, args,
+          step_records=None, val_loader=None):
     global global_step
     batch_time = AverageMeter('Time', ':6.3f')
     data_time = AverageMeter('Data', ':6.3f')
@@ -622,14 +726,9 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
     top1 = AverageMeter('Acc@1', ':6.2f')
     top5 = AverageMeter('Acc@5', ':6.2f')
  
-    effective_world_size = get_world_size() * args.gradient_accumulation_steps
-    scale_one_gbs = int(args.batch_size * effective_world_size // optimizer.scale)
-    # SAMPLING WITH REPLACEMENT
-    # scale_one_steps_per_epoch = int(len(train_loader) * args.batch_size // scale_one_gbs)
-    scale_one_ws = scale_one_gbs // args.batch_size
-    scale_one_steps_per_epoch = int(len(train_loader) * get_world_size() // scale_one_ws)
+    scale_one_steps_per_epoch = get_scale_one_steps_per_epoch(train_loader, optimizer, args)
 
-    print("==>", effective_world_size, len(train_loader), scale_one_gbs, scale_one_steps_per_epoch, global_step)
+    print("==>", len(train_loader), scale_one_steps_per_epoch, global_step)
 
     progress = ProgressMeter(scale_one_steps_per_epoch,
                              [batch_time, data_time, losses, top1, top5],
@@ -643,7 +742,6 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
     images, target = prefetcher.next()
     i = 0
     scheduler_progress = 0
-    total_steps = 90 * scale_one_steps_per_epoch
     accumulate_gradients = args.gradient_accumulation_steps > 1
     curr_epoch_step = 0 # only to track grad accumulation related stuff
     is_last_accumulation_step = False
@@ -692,15 +790,19 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
             scaler.scale(loss).backward()
             # at the last accum step, take one optim step
             if args.enable_autoscaler:
+                si_steps = optimizer.scale_invariant_steps()
                 scheduler_progress = optimizer.get_step_increment()
                 i += scheduler_progress
                 optimizer.step()
             else:
                 i = global_step % (scale_one_steps_per_epoch+1)
                 scheduler_progress = 1
+                si_steps = 1
                 scaler.step(optimizer)
             # update scaler state machine
             scaler.update()
+            # set LR for the next step, fractional scale invariant progress with AdaScale
+            lr_scheduler.step(si_steps)
             # optimizer.zero_grad()
             for param in model.parameters():
                 param.grad = None
@@ -716,9 +818,11 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
             # NOTE if writing to S3 directly then make sure that write rate is limited else
             # S3 writes will fail and you will lose TB logs
             tensorboard_step = scale_one_steps_per_epoch * epoch + i
-            if args.run_gns_experiment:
-                # if running GNS experiments then adjust LR every step - instead of step decay
-                linear_decay_learning_rate(optimizer, tensorboard_step, total_steps, args)
+            # periodic evaluation on the fixed validation subset
+            if val_loader is not None and tensorboard_step // args.val_freq_si_steps > \
+                    (tensorboard_step - scheduler_progress) // args.val_freq_si_steps:
+                validate(val_loader, model, criterion, writer, tensorboard_step, args, tag='TestSubset')
+                model.train()
 
             if get_rank() == 0 and args.enable_autoscaler:
                 optimizer.log_to_tensorboard(global_step)
@@ -734,12 +838,28 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
                     effective_lr = gain * optimizer.param_groups[0]['lr'] # assuming that all groups have same LR
                     gns = optimizer.gns()
                     print("gain={}\ngns={}\nsi_steps={}\neffective lr={}".format(gain, gns, scheduler_progress, effective_lr))
+                if step_records is not None:
+                    step_records.append(
+                        optimizer_step=global_step,
+                        si_step=tensorboard_step,
+                        epoch=epoch,
+                        examples_per_step=args.batch_size * get_world_size() * args.gradient_accumulation_steps,
+                        loss=losses.val,
+                        loss_avg=losses.avg,
+                        top1=top1.avg,
+                        gain=optimizer.gain() if args.enable_autoscaler else 1.0,
+                        gns=optimizer.gns() if args.enable_autoscaler else float('nan'),
+                        lr=optimizer.param_groups[0]['lr'],
+                        batch_time=batch_time.val,
+                        world_size=get_world_size())
                 # save checkpoint, flush and push to S3
                 if global_step % args.ckpt_s3_sync_freq == 0:
                     save_checkpoint(state, False, args.checkpoint_file)
                     if args.enable_autoscaler:
                         optimizer.check_for_cluster_resize()
                     writer.flush()
+                    if step_records is not None:
+                        step_records.flush()
         images, target = prefetcher.next()
     # if we ended at a point where training pipeline ran out before we called final step for grad accum then we force a sync to allow autoscaler to checkpoint
     if not is_last_accumulation_step:
@@ -749,18 +869,17 @@ def train(train_loader, model, criterion, optimizer, scaler, writer, epoch, stat
             optimizer.step()
 
 
-def validate(val_loader, model, criterion, writer, epoch, args):
+def validate(val_loader, model, criterion, writer, step, args, tag='Test'):
     batch_time = AverageMeter('Time', ':6.3f')
-    losses = AverageMeter('Loss', ':.4e')
-    top1 = AverageMeter('Acc@1', ':6.2f')
-    top5 = AverageMeter('Acc@5', ':6.2f')
-    progress = ProgressMeter(len(val_loader), [batch_time, losses, top1, top5],
-                             prefix='Test: ')
+    progress = ProgressMeter(len(val_loader), [batch_time], prefix=f'{tag}: ')
 
     # switch to evaluate mode
     model.eval()
     end = time.perf_counter()
 
+    # loss sum, top1 correct, top5 correct and sample count stay on device and
+    # are all-reduced once at the end instead of syncing on every batch
+    totals = torch.zeros(4, device='cuda')
     prefetcher = data_prefetcher(val_loader)
     images, target = prefetcher.next()
     i = 0
@@ -771,17 +890,13 @@ def validate(val_loader, model, criterion, writer, epoch, args):
             output = model(images)
             loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        # print(type(acc1), type(acc5[0]), acc1)
-        # average across world size
-        acc1 = reduce_tensor(acc1)
-        acc5 = reduce_tensor(acc5)
-        loss = reduce_tensor(loss)
-
-        losses.update(loss.item(), images.size(0))
-        top1.update(acc1[0], images.size(0))
-        top5.update(acc5[0], images.size(0))
+            # measure accuracy and record loss
+            _, pred = output.topk(5, 1, True, True)
+            correct = pred.eq(target.view(-1, 1))
+            totals[0] += loss.float() * images.size(0)
+            totals[1] += correct[:, :1].sum()
+            totals[2] += correct.sum()
+            totals[3] += images.size(0)
 
         # measure elapsed time
         batch_time.update(time.perf_counter() - end)
@@ -791,16 +906,24 @@ def validate(val_loader, model, criterion, writer, epoch, args):
             progress.display(i)
         images, target = prefetcher.next()
 
-    # tensorboard update
-    writer.add_scalar('Test/Accuracy_top1', top1.avg, epoch)
-    writer.add_scalar('Test/Accuracy_top5', top5.avg, epoch)
+    # average over all workers
+    if dist.is_initialized():
+        dist.all_reduce(totals)
+    loss_sum, correct1, correct5, count = totals.tolist()
+    count = max(count, 1)
+    top1 = 100. * correct1 / count
+    top5 = 100. * correct5 / count
+
+    # tensorboard update, logs are pushed to S3 in the background
+    writer.add_scalar(f'{tag}/Loss', loss_sum / count, step)
+    writer.add_scalar(f'{tag}/Accuracy_top1', top1, step)
+    writer.add_scalar(f'{tag}/Accuracy_top5', top5, step)
     writer.flush()
-    upload_dir(f'{args.logs_basedir}', args.bucket, f'{args.arch}/{args.label}')
+    upload_dir_async(args.logs_basedir, args.bucket, f'{args.arch}/{args.label}')
 
-    # TODO: this should also be done with the ProgressMeter
-    print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'.format(top1=top1, top5=top5))
+    print(' * {} Acc@1 {:.3f} Acc@5 {:.3f}'.format(tag, top1, top5))
 
-    return top1.avg
+    return top1
 
 
 def save_checkpoint(state: State, is_best: bool, filename: str):
@@ -825,8 +948,9 @@ def load_checkpoint(
     arch: str,
     model: DDP,
     optimizer,
+    lr_scheduler=None,
 ) -> State:
-    state = State(arch, model, optimizer)
+    state = State(arch, model, optimizer, lr_scheduler)
     if os.path.isfile(checkpoint_file):
         print(f"=> loading checkpoint file: {checkpoint_file}")
         state.load(checkpoint_file, device_id)
@@ -875,20 +999,11 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
-def adjust_learning_rate(optimizer, epoch, args):
-    """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
-    lr = args.lr * (0.1**(epoch // 30))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-
-
-def linear_decay_learning_rate(optimizer, step, total_steps, args):
-    """ linear decay for GNS comparisons """
-    base_lr = args.lr
-    progress = step / total_steps
-    lr = base_lr * (1.0 - progress)
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
+def is_schedule_milestone(epoch, args):
+    """True for the last epoch before a step decay of the LR and for the final epoch"""
+    if args.lr_schedule == 'step' and epoch + 1 in args.lr_milestones:
+        return True
+    return epoch + 1 == args.epochs
 
 
 def accuracy(output, target, topk=(1, )):
@@ -3,6 +3,7 @@ import boto3
 from botocore.exceptions import ClientError
 import torch
 import os
+import threading
 
 def upload_dir(file_dir, bucket, s3_prefix):
     """Upload a file to an S3 bucket
@@ -48,6 +49,44 @@ def upload_file(filepath, bucket, s3_prefix):
     return True
 
 
+_upload_threads = {}
+
+
+def upload_dir_async(file_dir, bucket, s3_prefix):
+    """Upload a dir to an S3 bucket from a background thread
+
+    A previous upload of the same dir is waited on first so that uploads never overlap.
+
+    :param file_dir: File dir to upload
+    :param bucket: Bucket to upload to
+    :param s3_prefix: s3 path prefix
+    :return: the upload thread
+    """
+    previous = _upload_threads.get(file_dir)
+    if previous is not None:
+        previous.join()
+    thread = threading.Thread(target=upload_dir, args=(file_dir, bucket, s3_prefix), daemon=True)
+    thread.start()
+    _upload_threads[file_dir] = thread
+    return thread
+
+
+def stratified_subset(samples, per_class):
+    """Indices of the first ``per_class`` samples of every class, fixed across runs and restarts
+
+    :param samples: list of (path, class_index), e.g. ``ImageFolder.samples``
+    :param per_class: number of samples to keep per class
+    :return: list of indices into ``samples``
+    """
+    counts = {}
+    indices = []
+    for idx, (_, target) in enumerate(samples):
+        if counts.get(target, 0) < per_class:
+            counts[target] = counts.get(target, 0) + 1
+            indices.append(idx)
+    return indices
+
+
 def is_global_rank_zero():
     if torch.distributed.get_rank() == 0:
         return True